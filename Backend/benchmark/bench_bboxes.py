@@ -0,0 +1,129 @@
+"""
+Benchmark of the bboxes of a request: one pydantic `BoundingBox` per element vs the columnar
+`BBoxTable`, on the demo bboxes replicated to the size of a busy page.
+
+Measures the decode (JSON -> validated bboxes) time, the memory peak and the memory retained
+by the decoded bboxes, and the time of the viewport filter and the coordinates lookup (brute
+force and through the SpatialIndex of the turn).
+
+Usage (from Backend/src):
+    python ../benchmark/bench_bboxes.py --n_elements 1000 5000 10000
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+from pathlib import Path
+from pydantic import TypeAdapter
+from typing import Dict
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from weblinx.processing.outputs import get_element_uid_by_coords  # noqa: E402
+from weblinx.utils.html import filter_bboxes  # noqa: E402
+
+from BBoxTable import COLUMNS, BBoxTable  # noqa: E402
+from schema import BoundingBox  # noqa: E402
+from SpatialIndex import SpatialIndex  # noqa: E402
+
+DEMO_BBOXES = Path(__file__).parents[1] / "src" / "ckmtdoi" / "bboxes" / "bboxes-2.json"
+
+
+class FakeTurn:
+    def __init__(self, bboxes):
+        self.bboxes = bboxes
+
+
+def make_bboxes(n_elements: int) -> Dict[str, Dict]:
+    with open(DEMO_BBOXES) as f:
+        demo = list(json.load(f).values())
+    return {f"{i:08x}-bench": demo[i % len(demo)] for i in range(n_elements)}
+
+
+def timeit(fn, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def measure_memory(fn):
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained, peak
+
+
+def run(n_elements: int, repeats: int) -> Dict:
+    bboxes = make_bboxes(n_elements)
+    payload = json.dumps(bboxes)
+    columnar_payload = json.dumps(
+        {
+            "uids": list(bboxes),
+            "values": [[b[c] for c in COLUMNS] for b in bboxes.values()],
+        }
+    )
+
+    models_adapter = TypeAdapter(Dict[str, BoundingBox])
+    table_adapter = TypeAdapter(BBoxTable)
+
+    decoders = {
+        "models": lambda: models_adapter.validate_json(payload),
+        "table": lambda: table_adapter.validate_json(payload),
+        "table_columnar": lambda: table_adapter.validate_json(columnar_payload),
+    }
+
+    results = {"n_elements": n_elements}
+    for name, decode in decoders.items():
+        retained, peak = measure_memory(decode)
+        results[name] = {
+            "decode_ms": 1000 * timeit(decode, repeats),
+            "retained_kb": retained / 1024,
+            "peak_kb": peak / 1024,
+        }
+
+    models = decoders["models"]()
+    table = decoders["table"]()
+    results["models"]["filter_ms"] = 1000 * timeit(
+        lambda: filter_bboxes(models, viewport_height=651, viewport_width=1366),
+        repeats,
+    )
+    results["table"]["filter_ms"] = 1000 * timeit(
+        lambda: table.visible_mask(viewport_height=651, viewport_width=1366),
+        repeats,
+    )
+    results["models"]["uid_by_coords_ms"] = 1000 * timeit(
+        lambda: get_element_uid_by_coords(FakeTurn(models), 300, 160), repeats
+    )
+
+    index = SpatialIndex(table)
+    results["spatial_index"] = {
+        "build_ms": 1000 * timeit(lambda: SpatialIndex(table), repeats),
+        "uid_by_coords_ms": 1000 * timeit(lambda: index.uid_at(300, 160), repeats),
+        "rect_ms": 1000 * timeit(lambda: index.uids_in_rect(0, 0, 400, 300), repeats),
+    }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--n_elements", type=int, nargs="+", default=[1000, 5000, 10000]
+    )
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    print(json.dumps([run(n, args.repeats) for n in args.n_elements], indent=2))
+
+
+if __name__ == "__main__":
+    main()
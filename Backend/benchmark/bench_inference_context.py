@@ -0,0 +1,151 @@
+"""
+Benchmark of the per-call settings of the model calls: the previous CUDA autocast &
+`torch.cuda.empty_cache()` around every call vs the `InferenceContext` picked at startup.
+
+Runs the DMR encoder on the demo-sized batches of records and, optionally, a few greedy
+decoding steps of the action model, alternating the two settings, and reports the median
+latency of a call in each.
+
+Usage (from Backend/src):
+    python ../benchmark/bench_inference_context.py
+    python ../benchmark/bench_inference_context.py --action_model HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+
+import argparse
+import contextlib
+import json
+import statistics
+import sys
+import time
+import torch
+
+from pathlib import Path
+from typing import Callable, Dict
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from InferenceContext import InferenceContext  # noqa: E402
+
+SENTENCE = "[[tag]] button [[xpath]] /html/body/div[2]/form/button [[text]] Search flights"
+
+
+@contextlib.contextmanager
+def legacy_call(dtype: torch.dtype, enabled: bool = True):
+    """
+    Settings of the calls before the inference context.
+    """
+    with torch.cuda.amp.autocast(enabled=enabled, dtype=dtype):
+        yield
+    torch.cuda.empty_cache()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn: Callable, device: torch.device, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def compare(call: Callable, legacy, context, device, repeats: int) -> Dict[str, float]:
+    def run(settings):
+        with settings():
+            call()
+
+    # Warm up the kernels & the allocator with both settings
+    run(legacy)
+    run(context)
+
+    legacy_ms = 1000 * timeit(lambda: run(legacy), device, repeats)
+    context_ms = 1000 * timeit(lambda: run(context), device, repeats)
+    return {
+        "legacy_ms": legacy_ms,
+        "context_ms": context_ms,
+        "change": (context_ms - legacy_ms) / legacy_ms,
+    }
+
+
+def bench_dmr(model_name: str, batch_sizes, repeats: int) -> Dict:
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name)
+    device = model.device
+    # Same settings as `DMR` (bf16: no autocast, in the dtype of the weights)
+    context = InferenceContext(device=device, weights_dtype=torch.float32)
+
+    results = {"model": model_name, "device": str(device)}
+    for batch_size in batch_sizes:
+        sentences = [f"{SENTENCE} {i}" for i in range(batch_size)]
+        results[f"encode_{batch_size}"] = compare(
+            lambda: model.encode(sentences, batch_size=64, show_progress_bar=False),
+            legacy=lambda: legacy_call(torch.float32, enabled=False),
+            context=context,
+            device=device,
+            repeats=repeats,
+        )
+    return results
+
+
+def bench_action(model_name: str, new_tokens: int, repeats: int) -> Dict:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype)
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    # Same settings as `ActionAgent`
+    context = InferenceContext(
+        device=model.device, weights_dtype=model.dtype, compute_dtype=dtype
+    )
+
+    inputs = tokenizer(SENTENCE * 20, return_tensors="pt").to(model.device)
+
+    def generate():
+        model.generate(
+            **inputs,
+            max_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+
+    return {
+        "model": model_name,
+        "device": str(model.device),
+        "prompt_tokens": inputs.input_ids.shape[1],
+        f"generate_{new_tokens}": compare(
+            generate,
+            legacy=lambda: legacy_call(dtype),
+            context=context,
+            device=model.device,
+            repeats=repeats,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dmr_model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 256, 1024])
+    parser.add_argument("--action_model", default=None)
+    parser.add_argument("--new_tokens", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    results = {"dmr": bench_dmr(args.dmr_model, args.batch_sizes, args.repeats)}
+    if args.action_model is not None:
+        results["action"] = bench_action(
+            args.action_model, args.new_tokens, args.repeats
+        )
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
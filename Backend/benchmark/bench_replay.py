@@ -0,0 +1,448 @@
+"""
+Replays the ckmtdoi demonstration through the `/v1/get_next_action` handler of the server and
+records per-stage timings and memory for each turn.
+
+Each navigator turn of the demo is predicted once, the way the extension would drive the
+backend: an instructor utterance is sent as a `say` user intent, consecutive navigator turns as
+`continue`, and the previous navigator action as `prev_turn` with the page (HTML, bboxes and
+metadata) of the demo at that point. Navigator actions the extension does not support (e.g.
+`copy`) cannot be sent back, so the turn following them is skipped.
+
+Stages (see `Profiling.timed`, they nest): validation, html_parse, build_records, encode,
+prompt_build, tokenization, generation (with prefill when the prefix cache is enabled) and
+element_inference. The token cache lookups and prefix cache reuse of each turn are recorded
+too. The results (per turn and summary, with the config and
+environment) are written as JSON.
+
+Usage (from Backend/src):
+    python ../benchmark/bench_replay.py
+    python ../benchmark/bench_replay.py --small  # CPU-sized stand-in models
+    python ../benchmark/bench_replay.py --override dmr.model=... --override action.model=...
+    python ../benchmark/bench_replay.py --compare ../benchmark/results/replay-<before>.json
+    python ../benchmark/bench_replay.py --override action.prefix_cache.enabled=True
+    python ../benchmark/bench_replay.py --override action.constrained_decoding.enabled=True
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SRC_DIR = Path(__file__).parents[1] / "src"
+sys.path.insert(0, str(SRC_DIR))
+
+from Profiling import collect_timings  # noqa: E402
+from RuntimeConfig import OVERRIDES_ENV, encode_config_overrides  # noqa: E402
+from schema import RequestBody  # noqa: E402
+from TokenCache import TOKEN_CACHE_LOOKUPS  # noqa: E402
+
+DEMO_DIR = SRC_DIR / "ckmtdoi"
+RESULTS_DIR = Path(__file__).parent / "results"
+UID_KEY = "data-webtasks-id"
+
+# Stand-in models small enough to run the replay on a CPU
+SMALL_MODEL_OVERRIDES = [
+    "dmr.model=sentence-transformers/all-MiniLM-L6-v2",
+    "dmr.dtype=float32",
+    "action.model=HuggingFaceTB/SmolLM2-135M-Instruct",
+    "action.use_rope=False",
+    "action.use_flash_attention_2=False",
+]
+
+# Demo intents the extension can send back as `prev_turn`
+PREV_TURN_INTENTS = {
+    "change": "change",
+    "click": "click",
+    "load": "load",
+    "scroll": "scroll",
+    "submit": "submit",
+    "textInput": "textinput",
+}
+ELEMENT_FIELDS = ["attributes", "bbox", "tagName", "xpath", "textContent"]
+
+
+def load_demo(demo_dir: Path) -> List[Dict]:
+    with open(demo_dir / "replay.json") as f:
+        return json.load(f)["data"]
+
+
+def is_navigator(turn: Dict) -> bool:
+    return turn["type"] == "browser" or turn.get("speaker") == "navigator"
+
+
+def get_intent(turn: Dict) -> str:
+    return "say" if turn["type"] == "chat" else turn["action"]["intent"]
+
+
+def get_page_state(demo: List[Dict], index: int, demo_dir: Path) -> Optional[Dict]:
+    """
+    Page open when the demo reaches `index`: the page recorded by the next browser turn
+    (pages only change through browser actions), or the last recorded one.
+    """
+    candidates = list(range(index, len(demo))) + list(range(index - 1, -1, -1))
+    for i in candidates:
+        turn = demo[i]
+        if turn["type"] != "browser":
+            continue
+        page = (turn.get("state") or {}).get("page")
+        if page is None:
+            continue
+
+        page_index = page.split("-")[1]
+        bboxes_path = demo_dir / "bboxes" / f"bboxes-{page_index}.json"
+        if not bboxes_path.exists():
+            continue
+
+        with open(bboxes_path) as f:
+            bboxes = json.load(f)
+        html = (demo_dir / "pages" / page).read_text(encoding="utf-8")
+        metadata = turn["action"]["arguments"]["metadata"]
+        return {"html": html, "bboxes": bboxes, "metadata": metadata, "page": page}
+
+    return None
+
+
+def to_prev_turn(turn: Dict) -> Optional[Dict]:
+    """
+    The navigator turn as the extension sends it back, `None` if it cannot be sent.
+    """
+    if turn["type"] == "chat":
+        return {"intent": "say", "utterance": turn["utterance"]}
+
+    intent = PREV_TURN_INTENTS.get(turn["action"]["intent"])
+    if intent is None:
+        return None
+
+    args = turn["action"]["arguments"]
+    prev_turn = {"intent": intent}
+    if "element" in args:
+        prev_turn["element"] = {k: args["element"][k] for k in ELEMENT_FIELDS}
+    if intent == "load":
+        props = args.get("properties", {})
+        prev_turn["properties"] = {
+            "transitionType": props.get("transitionType"),
+            "transitionQualifiers": props.get("transitionQualifiers"),
+            "url": props.get("url") or args.get("url"),
+        }
+    if intent == "scroll":
+        prev_turn["scrollX"] = int(args.get("scrollX", 0))
+        prev_turn["scrollY"] = int(args.get("scrollY", 0))
+    return prev_turn
+
+
+def build_requests(
+    demo: List[Dict], demo_dir: Path = DEMO_DIR, session_id: str = "bench-ckmtdoi"
+) -> List[Dict]:
+    """
+    Builds the requests replaying the demo, each with the JSON body sent to the server and
+    the intent of the demo turn it predicts.
+    """
+    requests = []
+    pending = None  # last navigator turn, not yet sent back as `prev_turn`
+
+    for index, turn in enumerate(demo):
+        if not is_navigator(turn):
+            requests.append(
+                make_request(
+                    demo, demo_dir, index, session_id, pending, turn["utterance"]
+                )
+            )
+            pending = None
+            continue
+
+        # A navigator turn following an utterance is predicted by the `say` request
+        follows_navigator = (index > 0) and is_navigator(demo[index - 1])
+        if follows_navigator:
+            if pending is None:
+                requests.append({"index": index, "skipped": True})
+            else:
+                requests.append(
+                    make_request(demo, demo_dir, index, session_id, pending, None)
+                )
+
+        pending = to_prev_turn(turn)
+
+    return requests
+
+
+def make_request(
+    demo: List[Dict],
+    demo_dir: Path,
+    index: int,
+    session_id: str,
+    prev_turn: Optional[Dict],
+    utterance: Optional[str],
+) -> Dict:
+    body = {"sessionID": session_id, "uid_key": UID_KEY, "prev_turn": prev_turn}
+    if utterance is not None:
+        body["user_intent"] = {"intent": "say", "utterance": utterance}
+        target = index + 1
+    else:
+        body["user_intent"] = {"intent": "continue"}
+        target = index
+
+    state = get_page_state(demo, target, demo_dir)
+    if state is not None:
+        body.update(
+            html=state["html"], bboxes=state["bboxes"], metadata=state["metadata"]
+        )
+
+    expected = get_intent(demo[target]) if target < len(demo) else None
+    if (expected is not None) and (not is_navigator(demo[target])):
+        expected = None
+
+    return {
+        "index": index,
+        "user_intent": body["user_intent"]["intent"],
+        "prev_turn_intent": prev_turn["intent"] if prev_turn else None,
+        "page": state["page"] if state else None,
+        "expected_intent": expected,
+        "body": json.dumps(body),
+    }
+
+
+def get_rss_mb() -> float:
+    # Peak resident set size of the process (KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_token_cache_lookups() -> Dict[str, float]:
+    return {
+        result: TOKEN_CACHE_LOOKUPS.get(result=result)
+        for result in ["request_hit", "session_hit", "miss"]
+    }
+
+
+def get_prefix_cache_tokens(server) -> Optional[Dict[str, int]]:
+    prefix_cache = server.action_loader.get().prefix_cache
+    if prefix_cache is None:
+        return None
+    stats = prefix_cache.get_stats()
+    return {k: stats[k] for k in ["reused_tokens", "prefilled_tokens"]}
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "total_s": sum(values),
+        "mean_s": statistics.fmean(values),
+        "p50_s": values[len(values) // 2],
+        "p95_s": values[min(len(values) - 1, int(0.95 * len(values)))],
+        "max_s": values[-1],
+    }
+
+
+async def replay_requests(
+    server, requests: List[Dict], trace_memory: bool
+) -> List[Dict]:
+    from fastapi import HTTPException
+
+    results = []
+    for request in requests:
+        if request.get("skipped"):
+            results.append(request)
+            continue
+
+        result = {k: v for k, v in request.items() if k != "body"}
+        result["request_bytes"] = len(request["body"])
+        if trace_memory:
+            tracemalloc.reset_peak()
+
+        lookups_before = get_token_cache_lookups()
+        prefix_before = get_prefix_cache_tokens(server)
+        started = time.perf_counter()
+        with collect_timings() as timings:
+            validation_started = time.perf_counter()
+            body = RequestBody.model_validate_json(request["body"])
+            timings["validation"] = [time.perf_counter() - validation_started]
+
+            try:
+                response = await server.get_next_action(body)
+                result["status"] = 200
+                result["predicted_intent"] = str(response.intent.value)
+            except HTTPException as e:
+                result["status"] = e.status_code
+                result["error"] = str(e.detail)[-500:]
+        result["total_s"] = time.perf_counter() - started
+
+        result["stages"] = {stage: sum(t) for stage, t in timings.items()}
+        result["stage_calls"] = {stage: len(t) for stage, t in timings.items()}
+        result["token_cache"] = {
+            k: v - lookups_before[k] for k, v in get_token_cache_lookups().items()
+        }
+        if prefix_before is not None:
+            result["prefix_cache"] = {
+                k: v - prefix_before[k]
+                for k, v in get_prefix_cache_tokens(server).items()
+            }
+        result["peak_rss_mb"] = get_rss_mb()
+        if trace_memory:
+            result["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+
+        logging.info(
+            f"Turn {result['index']}: {result.get('predicted_intent')} "
+            f"(expected {result['expected_intent']}) in {result['total_s']:.3f}s"
+        )
+        results.append(result)
+
+    return results
+
+
+def build_summary(results: List[Dict]) -> Dict[str, Any]:
+    ran = [r for r in results if not r.get("skipped")]
+    ok = [r for r in ran if r.get("status") == 200]
+
+    stages = {}
+    for r in ran:
+        for stage, seconds in r["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    with_expected = [r for r in ok if r["expected_intent"] is not None]
+    matched = [
+        r
+        for r in with_expected
+        if r["predicted_intent"].lower() == r["expected_intent"].lower()
+    ]
+
+    return {
+        "requests": len(ran),
+        "skipped": len(results) - len(ran),
+        "succeeded": len(ok),
+        "intent_match_rate": (
+            len(matched) / len(with_expected) if with_expected else None
+        ),
+        "total": summarize([r["total_s"] for r in ran]) if ran else None,
+        "stages": {stage: summarize(v) for stage, v in sorted(stages.items())},
+        "token_cache_hit_rate": get_hit_rate(ran),
+        "peak_rss_mb": get_rss_mb(),
+    }
+
+
+def get_hit_rate(results: List[Dict]) -> Optional[float]:
+    lookups = {"request_hit": 0, "session_hit": 0, "miss": 0}
+    for r in results:
+        for k, v in r.get("token_cache", {}).items():
+            lookups[k] += v
+    total = sum(lookups.values())
+    return (lookups["request_hit"] + lookups["session_hit"]) / total if total else None
+
+
+def get_environment() -> Dict[str, Any]:
+    env = {"python": sys.version.split()[0], "platform": platform.platform()}
+    try:
+        import torch
+
+        env["torch"] = torch.__version__
+        env["device"] = (
+            torch.cuda.get_device_name(0) if torch.cuda.is_available() else "cpu"
+        )
+        if torch.cuda.is_available():
+            env["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+    except ImportError:
+        pass
+    return env
+
+
+def compare(current: Dict, baseline_path: Path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\n{'stage':<20}{'base p50 (s)':>14}{'p50 (s)':>12}{'change':>10}")
+    base_stages = baseline["summary"]["stages"]
+    for stage, stats in current["summary"]["stages"].items():
+        if stage not in base_stages:
+            continue
+        base, new = base_stages[stage]["p50_s"], stats["p50_s"]
+        change = f"{100 * (new - base) / base:+.1f}%" if base else "-"
+        print(f"{stage:<20}{base:>14.4f}{new:>12.4f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--small", action="store_true", help="Use CPU-sized models.")
+    parser.add_argument(
+        "--override",
+        action="append",
+        default=[],
+        help="Hydra override of the server config (repeatable).",
+    )
+    parser.add_argument("--max_requests", type=int, default=None)
+    parser.add_argument(
+        "--trace_memory",
+        action="store_true",
+        help="Track Python allocations with tracemalloc (slows down the run).",
+    )
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None)
+    parser.add_argument("--log_level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    overrides = (SMALL_MODEL_OVERRIDES if args.small else []) + args.override
+    os.environ[OVERRIDES_ENV] = encode_config_overrides(overrides)
+
+    demo = load_demo(DEMO_DIR)
+    requests = build_requests(demo)[: args.max_requests]
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    # Loads the models of the server config
+    started = time.perf_counter()
+    import server
+    from omegaconf import OmegaConf
+
+    for loader in server.model_loaders:
+        loader.get()
+    startup_s = time.perf_counter() - started
+
+    results = asyncio.run(replay_requests(server, requests, args.trace_memory))
+    server.executor.shutdown(wait=True)
+
+    output = {
+        "created_at": datetime.now().isoformat(),
+        "overrides": overrides,
+        "config": OmegaConf.to_container(server.cfg, resolve=True),
+        "environment": get_environment(),
+        "startup_s": startup_s,
+        "startup_phases": server.startup.get_stats(),
+        "summary": build_summary(results),
+        "turns": results,
+    }
+    if args.trace_memory:
+        output["summary"]["tracemalloc_peak_mb"] = max(
+            r.get("tracemalloc_peak_mb", 0) for r in results
+        )
+    prefix_cache = server.action_loader.get().prefix_cache
+    if prefix_cache is not None:
+        output["summary"]["prefix_cache"] = prefix_cache.get_stats()
+
+    path = args.output or (
+        RESULTS_DIR / f"replay-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+
+    print(json.dumps(output["summary"], indent=2))
+    print(f"Results written to {path}")
+
+    if args.compare is not None:
+        compare(output, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,22 +18,25 @@ from functools import partial
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
+    Cache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
     pipeline,
 )
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
 from weblinx.processing.dom import clean_and_prune_tree
 from weblinx.processing.outputs import (
     parse_predicted_output_string,
     sanitize_args,
     # infer_element_for_action,
-    get_element_uid_by_coords,
     get_xy_coords_corners,
     dict_has_keys,
     # get_element_info,
 )
 from weblinx.processing.prompt import (
-    find_turns_with_instructor_chat,
     format_candidates,
     format_utterances,
     format_utterances_truncated,
@@ -45,6 +48,23 @@ from weblinx.processing.truncation import (
     multi_attempt_truncate_dom_tree,
 )
 
+from ActionGrammar import ActionGrammar, TokenConstraint, build_token_texts
+from Batching import DynamicBatcher
+from InferenceContext import InferenceContext
+from PrefixCache import PrefixCache
+from Profiling import TimedTokenizer, timed
+from PromptState import PromptState, get_prompt_state
+from PromptTruncation import (
+    count_head_tokens,
+    scale_section_budgets,
+    truncate_prompt_tokens,
+)
+from RemoteClient import RemoteClient, TextGenerationClient
+from Streaming import ActionStreamMonitor
+from TokenCache import CachedTokenizer, TokenCache
+from Tracing import set_attributes
+from WebLinxHelper import get_element_uid_by_coords, get_parsed_page
+
 
 class BaseActionAgent(metaclass=abc.ABCMeta):
     """
@@ -77,6 +97,7 @@ class BaseActionAgent(metaclass=abc.ABCMeta):
         raise NotImplementedError
 
     @abc.abstractmethod
+    @timed("next_action")
     def next_action(
         self,
         turn: wl.Turn,
@@ -102,7 +123,150 @@ class BaseActionAgent(metaclass=abc.ABCMeta):
         """
 
 
-class ActionAgent(BaseActionAgent):
+class LlamaPromptActionAgent(BaseActionAgent):
+    """
+    Builds the (truncated) weblinx prompts of a Llama chat model with its tokenizer & parses
+    the generated actions. Subclasses run the model.
+    """
+
+    def __init__(
+        self,
+        tokenizer: str,
+        max_out_len: int = 256,
+        max_inp_len: int = None,
+        num_candidates: int = 20,
+    ):
+        """
+        Parameters:
+        -------------
+        tokenizer: str
+            Name of the tokenizer of the model.
+        max_out_len: int
+            Maximum number of generated tokens.
+        max_inp_len: int
+            Maximum number of tokens of the prompt, `None` keeps it whole. The prompt sections
+            are truncated to fit, and longer prompts are cut from the middle.
+        num_candidates: int
+            Best ranked candidates shown in the prompt.
+        """
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer, padding_side="left")
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.max_out_len = max_out_len
+        self.max_inp_len = max_inp_len
+        self.num_prompt_candidates = num_candidates
+
+        # Set by the `enable_*` methods of the subclasses that support them
+        self.batcher = None
+        self.prefix_cache = None
+
+        # Token budgets of the prompt sections, scaled down to fit in `max_inp_len`
+        self.section_budgets = {}
+        if max_inp_len is not None:
+            self.section_budgets = scale_section_budgets(
+                max_inp_len, count_fixed_prompt_tokens(self.tokenizer)
+            )
+
+        format_intent = build_formatter_for_multichoice()
+        self.build_prompt_fn = partial(
+            build_prompt_records_for_llama_truncated,
+            format_intent=format_intent,
+            **self.section_budgets,
+        )
+
+    def select_prompt_candidates(self, cands_turn: List[Dict] = None) -> List[Dict]:
+        """
+        Best ranked candidates, the ones shown in the prompt.
+        """
+        if not cands_turn:
+            return []
+        cands_turn = sorted(cands_turn, key=lambda c: c["rank"])
+        return cands_turn[: self.num_prompt_candidates]
+
+    @timed("prompt_build")
+    def build_prompt(
+        self,
+        replay: wl.Replay,
+        turn: wl.Turn,
+        cands_turn: List[Dict] = None,
+        token_cache: TokenCache = None,
+    ) -> List[Dict]:
+        """
+        Builds the (truncated) prompt of the turn.
+
+        Parameters:
+        -------------
+        token_cache: TokenCache
+            Tokenizations of the session, reused across its turns. Tokenizations are always
+            memoized for the duration of the call.
+        """
+
+        # Change final_user_message if it was actually from the user.
+        final_user_message = None
+        if (turn.type == "chat") and (turn["speaker"] == "instructor"):
+            final_user_message = turn["utterance"]
+
+        tokenizer = CachedTokenizer(self.tokenizer, session_cache=token_cache)
+        timed_tokenizer = TimedTokenizer(tokenizer)
+        model_prompt = self.build_prompt_fn(
+            replay=replay,
+            turn=turn,
+            tokenizer=timed_tokenizer,
+            cands_turn=self.select_prompt_candidates(cands_turn),
+            final_user_message=final_user_message,
+        )
+        timed_tokenizer.report()
+        stats = tokenizer.report()
+        set_attributes(
+            token_cache_hit_rate=stats["hit_rate"], token_cache_misses=stats["misses"]
+        )
+
+        insert_empty_user_content_at_first(model_prompt)
+        return model_prompt
+
+    def tokenize_prompt(self, model_prompt: List[Dict]) -> Tuple[str, int]:
+        """
+        Applies the chat template to the prompt and cuts it to `max_inp_len` tokens, from its
+        middle: the template header & the system prompt, and the last turns are kept.
+
+        Returns:
+        --------
+        The model input & its number of tokens.
+        """
+        with timed("tokenization"):
+            model_input = self.tokenizer.apply_chat_template(
+                model_prompt, tokenize=False, add_generation_prompt=False
+            )
+            tokens = self.tokenizer.tokenize(model_input)
+            if self.max_inp_len is not None and len(tokens) > self.max_inp_len:
+                set_attributes(truncated_tokens=len(tokens) - self.max_inp_len)
+                num_head_tokens = count_head_tokens(
+                    self.tokenizer, model_prompt[0]["content"]
+                )
+                tokens = truncate_prompt_tokens(
+                    tokens, self.max_inp_len, num_head_tokens
+                )
+                model_input = self.tokenizer.convert_tokens_to_string(tokens)
+            num_tokens = len(tokens)
+        set_attributes(prompt_tokens=num_tokens)
+        return model_input, num_tokens
+
+    def parse_action(self, pred: str, turn: wl.Turn, uid_key: str):
+        """
+        Parses the generated text into the action & infers the element it is performed on.
+        """
+        # Could have unknown intent
+        intent, args = parse_predicted_output_string(pred)
+        args = sanitize_args(args)
+
+        with timed("element_inference"):
+            infered_element = infer_element_for_action(
+                intent=intent, args=args, turn=turn, uid_key=uid_key
+            )
+        return {"intent": intent, "args": args, "element": infered_element}
+
+
+class ActionAgent(LlamaPromptActionAgent):
     """
     Agent to choose the next action based on the user input.
     """
@@ -115,48 +279,87 @@ class ActionAgent(BaseActionAgent):
         use_flash_attention_2: bool = True,
         max_out_len=256,
         batch_size_per_device=2,
+        max_inp_len: int = None,
+        num_candidates: int = 20,
+        dtype: str = "bfloat16",
+        device_map: str = "auto",
+        memory_threshold: float = 0.9,
+        min_release_interval_s: float = 5.0,
     ):
         """
         Initializes the agent.
+
+        Parameters:
+        -------------
+        max_out_len: int
+            Maximum number of generated tokens.
+        batch_size_per_device: int
+            Batch size of the pipeline (without cross-session batching).
+        max_inp_len: int
+            Maximum number of tokens of the prompt, `None` keeps it whole. The prompt sections
+            are truncated to fit, and longer prompts are cut from the middle.
+        num_candidates: int
+            Best ranked candidates shown in the prompt.
+        dtype: str
+            Torch dtype of the weights & of the autocast, e.g. `bfloat16`.
+        device_map: str
+            Placement of the model (`auto`, `cpu`, `cuda:0`, ...).
+        memory_threshold: float
+            Fraction of the GPU memory reserved above which the allocator cache is released.
+        min_release_interval_s: float
+            Minimum time between two releases of the allocator cache.
         """
-        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer, padding_side="left")
-        self.tokenizer.pad_token = self.tokenizer.eos_token
+        super().__init__(
+            tokenizer=tokenizer,
+            max_out_len=max_out_len,
+            max_inp_len=max_inp_len,
+            num_candidates=num_candidates,
+        )
 
         self.name = model
         self.use_rope = use_rope
         self.use_flash_attention_2 = use_flash_attention_2
 
-        self.max_out_len = 256
-        self.batch_size_per_device = 2
+        self.batch_size_per_device = batch_size_per_device
+        self.torch_dtype = getattr(torch, dtype)
+        self.device_map = device_map
 
         # Setup model
-        model_kwargs = dict(device_map="auto", torch_dtype=torch.bfloat16)
+        model_kwargs = dict(device_map=device_map, torch_dtype=self.torch_dtype)
         if use_rope:
             model_kwargs["rope_scaling"] = {"type": "dynamic", "factor": 2.0}
         if use_flash_attention_2:
             model_kwargs["use_flash_attention_2"] = True
         self.model = AutoModelForCausalLM.from_pretrained(self.name, **model_kwargs)
+        # Weights are loaded in `dtype`, so no autocast is needed
+        self.inference = InferenceContext(
+            device=self.model.device,
+            weights_dtype=self.model.dtype,
+            compute_dtype=self.torch_dtype,
+            memory_threshold=memory_threshold,
+            min_release_interval_s=min_release_interval_s,
+        )
 
         # Setup our pipeline we use to run
         self.pipeline = pipeline(
             "text-generation",
             model=self.model,
             tokenizer=self.tokenizer,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=self.torch_dtype,
         )
         self.pipe_kwargs = dict(
             max_new_tokens=max_out_len,
             return_full_text=False,
             batch_size=batch_size_per_device,
             pad_token_id=self.tokenizer.eos_token_id,
+            # Greedy like the other generation paths (the pipeline samples by default)
+            do_sample=False,
         )
 
-        format_intent = build_formatter_for_multichoice()
-        self.build_prompt_fn = partial(
-            build_prompt_records_for_llama_truncated,
-            format_intent=format_intent,
-            tokenizer=self.tokenizer,
-        )
+        # Set by `enable_constrained_decoding`
+        self.grammar_kwargs = None
+        self.grammar_top_k = None
+        self.token_texts = None
 
         logging.info(f"Finished Initializing Action Agent ...\n{self}")
 
@@ -165,39 +368,107 @@ class ActionAgent(BaseActionAgent):
         str_rep += f"Use Rope: {self.use_rope}\n"
         str_rep += f"Use Flash Attention 2: {self.use_flash_attention_2}\n"
         str_rep += f"Batch Size: {self.batch_size_per_device}\n"
-        str_rep += f"Max Output Length: {self.max_out_len}"
+        str_rep += f"Max Input Length: {self.max_inp_len}\n"
+        str_rep += f"Max Output Length: {self.max_out_len}\n"
+        str_rep += f"Prompt Candidates: {self.num_prompt_candidates}\n"
+        str_rep += f"Dtype: {self.torch_dtype}\n"
+        str_rep += f"Device Map: {self.device_map}\n"
+        str_rep += f"Cross-session Batching: {self.batcher is not None}\n"
+        str_rep += f"Prefix Cache: {self.prefix_cache is not None}\n"
+        str_rep += f"Constrained Decoding: {self.grammar_kwargs is not None}"
         return str_rep
 
-    def build_prompt(
+    def enable_batching(
         self,
-        replay: wl.Replay,
-        turn: wl.Turn,
-        cands_turn: List[Dict] = None,
-    ) -> List[Dict]:
+        max_wait_ms: float = 10,
+        max_batch_size: int = 8,
+        max_batch_tokens: int = None,
+    ):
+        """
+        Coalesces the prompts of concurrent `next_action` calls into left-padded batches.
 
-        # Change final_user_message if it was actually from the user.
-        final_user_message = None
-        if (turn.type == "chat") and (turn["speaker"] == "instructor"):
-            final_user_message = turn["utterance"]
+        Parameters:
+        -------------
+        max_wait_ms: float
+            How long the first prompt of a batch waits for prompts from other sessions.
+        max_batch_size: int
+            Maximum number of prompts in a batch.
+        max_batch_tokens: int
+            Maximum number of (padded) input tokens in a batch, i.e. longest prompt x batch size.
+        """
+        self.batcher = DynamicBatcher(
+            name="generation",
+            process_fn=self.generate,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_batch_cost=max_batch_tokens,
+            batch_cost_fn=lambda costs: max(costs) * len(costs),
+        )
 
-        # Sort candidates
-        cands_turn = sorted(cands_turn, key=lambda c: c["rank"])
+    def enable_prefix_cache(
+        self,
+        max_bytes: int,
+        max_sessions: int = None,
+        min_prefix_tokens: int = 16,
+    ):
+        """
+        Keeps the KV cache of the last prompt of each session to only prefill what changed on
+        its next turn. Generations with a session ID then run one at a time per prompt instead
+        of going through the batcher.
 
-        model_prompt = self.build_prompt_fn(
-            replay=replay,
-            turn=turn,
-            cands_turn=cands_turn[:20],  # Select top 20 candidates
-            final_user_message=final_user_message,
+        Parameters:
+        -------------
+        max_bytes: int
+            Memory cap of the cached keys & values.
+        max_sessions: int
+            Maximum number of sessions with a cache.
+        min_prefix_tokens: int
+            Shorter common prefixes are prefilled from scratch.
+        """
+        self.prefix_cache = PrefixCache(
+            max_bytes=max_bytes,
+            max_sessions=max_sessions,
+            min_prefix_tokens=min_prefix_tokens,
         )
 
-        insert_empty_user_content_at_first(model_prompt)
-        return model_prompt
+    def enable_constrained_decoding(self, top_k: int = 64, max_str_len: int = 200):
+        """
+        Restricts the generated text to the action forms of the system prompt, with the `uid`
+        values limited to the candidates of the prompt, and stops at the closing bracket.
+        Constrained generations run one prompt at a time instead of going through the batcher.
+
+        Parameters:
+        -------------
+        top_k: int
+            Highest scoring tokens checked against the grammar at each step. The rest of the
+            vocabulary is only scanned when none of them is valid.
+        max_str_len: int
+            Longest string value (utterance, text, url, ...).
+        """
+        self.grammar_top_k = top_k
+        self.grammar_kwargs = dict(max_str_len=max_str_len)
+        with timed("token_texts"):
+            self.token_texts = build_token_texts(self.tokenizer)
+
+    def build_constraint(self, cands_turn: List[Dict] = None) -> TokenConstraint:
+        """
+        Grammar state of a generation whose prompt shows the candidates of `cands_turn`.
+        Without candidates, the `uid` values are not restricted.
+        """
+        cands = self.select_prompt_candidates(cands_turn)
+        uids = [c["uid"] for c in cands] if cands else None
+        grammar = ActionGrammar(uids=uids, **self.grammar_kwargs)
+        return TokenConstraint(grammar, self.token_texts, self.tokenizer.eos_token_id)
 
+    @timed("next_action")
     def next_action(
         self,
         turn: wl.Turn,
         uid_key: str,
         model_prompt: List[Dict],
+        session_id: str = None,
+        on_text: Callable[[str], None] = None,
+        cands_turn: List[Dict] = None,
     ):
         """
         Runs the action model to predict the next action.
@@ -206,34 +477,417 @@ class ActionAgent(BaseActionAgent):
         -------------
         model_prompt: List[Dict]
             The prompt of the model
+        session_id: str
+            Session of the prompt, to reuse the KV cache of its previous prompt (if the prefix
+            cache is enabled).
+        on_text: Callable[[str], None]
+            Called (from the generation thread) with the text generated since the last call.
+            The generation then stops as soon as the action is complete, and does not go
+            through the batcher.
+        cands_turn: List[Dict]
+            The candidates the prompt was built with, the only `uid` values allowed when the
+            decoding is constrained.
+
+        Returns:
+        --------
+        pred_action: Dict[str, Any]
+            The predicted action in the format of `intent`, `args` and `element`.
+        """
+
+        model_input, num_tokens = self.tokenize_prompt(model_prompt)
+        monitor = ActionStreamMonitor(on_text) if on_text is not None else None
+
+        pred = self.complete(model_input, num_tokens, session_id, monitor, cands_turn)
+
+        return self.parse_action(pred=pred, turn=turn, uid_key=uid_key)
+
+    def complete(
+        self,
+        model_input: str,
+        num_tokens: int,
+        session_id: str = None,
+        monitor: ActionStreamMonitor = None,
+        cands_turn: List[Dict] = None,
+    ) -> str:
+        """
+        Generates the text of a model input (with the chat template applied), through the
+        prefix cache, the streaming generation or the batcher as enabled. Also serves the
+        prompts of the workers in the multi-process mode (see `inference_server.py`).
+        """
+        constraint = None
+        if self.grammar_kwargs is not None:
+            constraint = self.build_constraint(cands_turn)
+            # The grammar only ends with the action, stop there
+            monitor = monitor or ActionStreamMonitor()
+
+        if self.prefix_cache is not None and session_id is not None:
+            pred = self.generate_with_prefix_cache(
+                model_input, session_id, monitor, constraint
+            )
+        elif monitor is not None:
+            pred = self.generate_streaming(model_input, monitor, constraint)
+        elif self.batcher is not None:
+            pred = self.batcher.submit(model_input, cost=num_tokens).result()
+        else:
+            pred = self.generate([model_input])[0]
+        set_attributes(
+            generated_tokens=len(self.tokenizer.tokenize(pred)),
+            stopped_early=monitor is not None and monitor.complete,
+        )
+        return pred
+
+    @timed("generation")
+    def generate(self, model_inputs: List[str]) -> List[str]:
+        """
+        Runs the pipeline on a (left-padded) batch of model inputs.
+
+        Returns:
+        --------
+        The generated text of each model input, in the same order.
+        """
+        pipe_kwargs = dict(self.pipe_kwargs, batch_size=len(model_inputs))
+
+        with self.inference():
+            outs = self.pipeline(model_inputs, **pipe_kwargs)
+            preds = [out[0]["generated_text"] for out in outs]
+
+        return preds
+
+    @timed("generation")
+    def generate_streaming(
+        self,
+        model_input: str,
+        monitor: ActionStreamMonitor,
+        constraint: TokenConstraint = None,
+    ) -> str:
+        """
+        Generates for a single model input, passing the text to the monitor after each token
+        and stopping once it holds a complete action. With a constraint, only the tokens
+        following the action grammar can be generated.
+        """
+        inputs = self.tokenizer(model_input, return_tensors="pt").to(self.model.device)
+        prompt_length = inputs.input_ids.shape[1]
+        stopping_criteria = StoppingCriteriaList(
+            [ActionStoppingCriteria(self.tokenizer, prompt_length, monitor)]
+        )
+        logits_processor = LogitsProcessorList()
+        if constraint is not None:
+            logits_processor.append(
+                ActionGrammarLogitsProcessor(
+                    constraint, prompt_length, top_k=self.grammar_top_k
+                )
+            )
+
+        with self.inference():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_out_len,
+                pad_token_id=self.tokenizer.eos_token_id,
+                stopping_criteria=stopping_criteria,
+                logits_processor=logits_processor,
+            )
+
+        return self.tokenizer.decode(
+            outputs[0, prompt_length:], skip_special_tokens=True
+        )
+
+    @timed("generation")
+    def generate_with_prefix_cache(
+        self,
+        model_input: str,
+        session_id: str,
+        monitor: ActionStreamMonitor = None,
+        constraint: TokenConstraint = None,
+    ) -> str:
+        """
+        Greedy generation reusing the KV cache of the session's previous prompt for the
+        longest common token prefix. The cache left by the generation (prompt & generated
+        tokens) is stored back for the next turn. With a constraint, the best token following
+        the action grammar is generated.
+        """
+        input_ids = self.tokenizer(model_input, return_tensors="pt").input_ids
+        input_ids = input_ids.to(self.model.device)
+        token_ids = input_ids[0].tolist()
+
+        past_key_values, prefix_length = self.prefix_cache.take(session_id, token_ids)
+        if past_key_values is not None:
+            past_key_values = crop_past_key_values(past_key_values, prefix_length)
+        set_attributes(reused_tokens=prefix_length)
+
+        generated = []
+        # Tokens the keys & values of the cache are for
+        cached_ids = list(token_ids)
+        with self.inference():
+            with timed("prefill"):
+                out = self.model(
+                    input_ids=input_ids[:, prefix_length:],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                next_token = select_next_token(
+                    out.logits[:, -1, :], constraint, self.grammar_top_k
+                )
+
+            for _ in range(self.max_out_len):
+                token = next_token.item()
+                if token == self.tokenizer.eos_token_id:
+                    break
+                generated.append(token)
+                if monitor is not None and monitor.update(
+                    self.tokenizer.decode(generated, skip_special_tokens=True)
+                ):
+                    break
+                out = self.model(
+                    input_ids=next_token[:, None],
+                    past_key_values=out.past_key_values,
+                    use_cache=True,
+                )
+                cached_ids.append(token)
+                next_token = select_next_token(
+                    out.logits[:, -1, :], constraint, self.grammar_top_k
+                )
+
+        past_key_values = out.past_key_values
+        self.prefix_cache.put(
+            session_id,
+            cached_ids,
+            past_key_values,
+            nbytes=past_key_values_nbytes(past_key_values),
+        )
+
+        return self.tokenizer.decode(generated, skip_special_tokens=True)
+
+class RemoteActionAgent(LlamaPromptActionAgent):
+    """
+    Agent sending its prompts to a text-generation server (text-generation-inference format)
+    instead of running the model in-process: the API replicas only load the tokenizer, which
+    builds & truncates the prompts the same way as `ActionAgent`.
+    """
+
+    def __init__(
+        self,
+        tokenizer: str,
+        model: str,
+        api_url: str,
+        auth_token: str = None,
+        max_out_len: int = 256,
+        max_inp_len: int = None,
+        num_candidates: int = 20,
+        **client_kwargs,
+    ):
+        """
+        Initializes the agent.
+
+        Parameters:
+        -------------
+        model: str
+            Name of the model served at `api_url`, for the logs.
+        api_url: str
+            Base URL of the text-generation server.
+        auth_token: str
+            Value of the `Authorization` header, `None` to send none.
+        max_out_len: int
+            Maximum number of generated tokens.
+        max_inp_len: int
+            Maximum number of tokens of the prompt, `None` keeps it whole. The prompt sections
+            are truncated to fit, and longer prompts are cut from the middle.
+        num_candidates: int
+            Best ranked candidates shown in the prompt.
+        client_kwargs:
+            Timeouts, pool size, concurrency, retries & circuit breaker of the `RemoteClient`
+        """
+        super().__init__(
+            tokenizer=tokenizer,
+            max_out_len=max_out_len,
+            max_inp_len=max_inp_len,
+            num_candidates=num_candidates,
+        )
+
+        self.name = model
+        self.api_url = api_url
+
+        headers = {"Authorization": auth_token} if auth_token else None
+        self.client = RemoteClient(
+            name="generation", base_url=api_url, headers=headers, **client_kwargs
+        )
+        self.generation = TextGenerationClient(self.client)
+        # Greedy, as the local pipeline
+        self.parameters = dict(
+            max_new_tokens=max_out_len, do_sample=False, return_full_text=False
+        )
+
+        logging.info(f"Finished Initializing Remote Action Agent ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Model Name - {self.name}\n"
+        str_rep += f"Model hosted @ URL - {self.api_url}\n"
+        str_rep += f"Max Input Length: {self.max_inp_len}\n"
+        str_rep += f"Max Output Length: {self.max_out_len}\n"
+        str_rep += f"Prompt Candidates: {self.num_prompt_candidates}\n"
+        str_rep += f"Max Concurrency: {self.client.max_concurrency}"
+        return str_rep
+
+    @timed("next_action")
+    def next_action(
+        self,
+        turn: wl.Turn,
+        uid_key: str,
+        model_prompt: List[Dict],
+        session_id: str = None,
+        on_text: Callable[[str], None] = None,
+        cands_turn: List[Dict] = None,
+    ):
+        """
+        Sends the prompt to the server to predict the next action. Same arguments as
+        `ActionAgent.next_action`, `session_id` & `cands_turn` are unused: the server keeps no
+        KV cache of the sessions and does not constrain the decoding.
+
+        Parameter:
+        -------------
+        on_text: Callable[[str], None]
+            Called (from the client's thread) with the text generated since the last call.
+            The generation is then streamed and cancelled as soon as the action is complete.
 
         Returns:
         --------
         pred_action: Dict[str, Any]
             The predicted action in the format of `intent`, `args` and `element`.
         """
+        model_input, _ = self.tokenize_prompt(model_prompt)
 
-        model_input = self.tokenizer.apply_chat_template(
-            model_prompt, tokenize=False, add_generation_prompt=False
+        monitor = ActionStreamMonitor(on_text) if on_text is not None else None
+        if monitor is not None:
+            pred = self.generate_streaming(model_input, monitor)
+        else:
+            pred = self.generate([model_input])[0]
+        set_attributes(
+            generated_tokens=len(self.tokenizer.tokenize(pred)),
+            stopped_early=monitor is not None and monitor.complete,
         )
 
-        ################
-        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-            out = self.pipeline(model_input, **self.pipe_kwargs)
-            pred = out[0]["generated_text"]
+        return self.parse_action(pred=pred, turn=turn, uid_key=uid_key)
 
-            # Could have unknown intent
-            intent, args = parse_predicted_output_string(pred)
-            args = sanitize_args(args)
+    @timed("generation")
+    def generate(self, model_inputs: List[str]) -> List[str]:
+        """
+        Sends the model inputs in parallel, the server batches them with its other requests.
 
-            infered_element = infer_element_for_action(
-                intent=intent, args=args, turn=turn, uid_key=uid_key
+        Returns:
+        --------
+        The generated text of each model input, in the same order.
+        """
+        return self.generation.generate(model_inputs, self.parameters)
+
+    @timed("generation")
+    def generate_streaming(self, model_input: str, monitor: ActionStreamMonitor) -> str:
+        """
+        Streams the generation of a single model input to the monitor, cancelling it once the
+        monitor holds a complete action.
+        """
+        return self.generation.generate_stream(
+            model_input, self.parameters, on_text=monitor.update
+        )
+
+
+####################### Generation ###########################
+
+
+class ActionStoppingCriteria(StoppingCriteria):
+    """
+    Stops the generation (of a single sequence) once its text holds a complete action.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, monitor: ActionStreamMonitor):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.monitor = monitor
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        text = self.tokenizer.decode(
+            input_ids[0, self.prompt_length :], skip_special_tokens=True
+        )
+        return self.monitor.update(text)
+
+
+class ActionGrammarLogitsProcessor(LogitsProcessor):
+    """
+    Masks the tokens that do not follow the action grammar (for a single sequence).
+    """
+
+    def __init__(self, constraint: TokenConstraint, prompt_length: int, top_k: int = 64):
+        self.constraint = constraint
+        self.prompt_length = prompt_length
+        self.top_k = top_k
+
+    def __call__(self, input_ids, scores):
+        # Catch up with the tokens generated since the last call
+        generated = input_ids[0, self.prompt_length :].tolist()
+        for token in generated[self.constraint.num_tokens :]:
+            self.constraint.consume(token)
+
+        allowed = find_allowed_tokens(scores[0], self.constraint, self.top_k)
+        mask = torch.full_like(scores, float("-inf"))
+        mask[0, allowed] = 0
+        return scores + mask
+
+
+def find_allowed_tokens(
+    scores, constraint: TokenConstraint, top_k: int, max_tokens: Optional[int] = None
+) -> List[int]:
+    """
+    Valid tokens by decreasing score. Only the `top_k` best tokens are checked, unless none
+    of them is valid (e.g. the model wants to close a `uid` that is not a candidate).
+    """
+    top = scores.topk(min(top_k, scores.shape[-1])).indices.tolist()
+    allowed = constraint.allowed_tokens(top, max_tokens=max_tokens)
+    if not allowed:
+        ranked = scores.argsort(descending=True).tolist()
+        allowed = constraint.allowed_tokens(ranked, max_tokens=max_tokens or top_k)
+    return allowed or [constraint.eos_token_id]
+
+
+def select_next_token(logits, constraint: TokenConstraint = None, top_k: int = 64):
+    """
+    Greedy choice of the next token (batch of one), among the valid ones with a constraint.
+    """
+    if constraint is None:
+        return logits.argmax(dim=-1)
+    token = find_allowed_tokens(logits[0], constraint, top_k, max_tokens=1)[0]
+    constraint.consume(token)
+    return torch.tensor([token], device=logits.device)
+
+
+####################### KV Cache ###########################
+
+
+def crop_past_key_values(past_key_values, length: int):
+    """
+    Keeps the keys & values of the first `length` tokens. A `Cache` object (what recent
+    transformers models return) is cropped in place, the legacy format (a `(key, value)`
+    tuple per layer, of shape `(batch, heads, tokens, head_dim)`) is sliced.
+    """
+    if isinstance(past_key_values, Cache):
+        if not getattr(past_key_values, "is_croppable", True):
+            raise ValueError(
+                f"The prefix cache can't reuse a {type(past_key_values).__name__} (e.g. "
+                "of sliding window layers), disable `action.prefix_cache`"
             )
-            pred_action = {"intent": intent, "args": args, "element": infered_element}
+        num_removed = past_key_values.get_seq_length() - length
+        if num_removed > 0:
+            # A negative size removes that many tokens (a positive one is deprecated)
+            past_key_values.crop(-num_removed)
+        return past_key_values
+
+    return tuple(
+        (key[:, :, :length, :], value[:, :, :length, :])
+        for key, value in past_key_values
+    )
 
-        torch.cuda.empty_cache()
 
-        return pred_action
+def past_key_values_nbytes(past_key_values) -> int:
+    return sum(
+        t.numel() * t.element_size() for layer in past_key_values for t in layer[:2]
+    )
 
 
 ####################### Prompt Builder ###########################
@@ -309,6 +963,28 @@ def get_final_user_message():
     return "Please select the best action using the correct format, do not provide any other information or explanation."
 
 
+def count_fixed_prompt_tokens(tokenizer) -> int:
+    """
+    Number of tokens of a prompt with empty sections (no DOM tree, utterances, previous turns
+    nor candidates): the chat template, the instructions & the final user message.
+    """
+    sys_prompt = get_system_prompt_template_for_llama_mc_concise().format(
+        num_utterances=0, utterance_context="", height=0, width=0, num_prev_turns=0
+    )
+    sys_prompt += "\n" + get_candidate_prompt_template_for_llama().format(
+        candidate_str=""
+    )
+    model_input = tokenizer.apply_chat_template(
+        [
+            {"role": "system", "content": sys_prompt},
+            {"role": "user", "content": get_final_user_message()},
+        ],
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+    return len(tokenizer.tokenize(model_input))
+
+
 def merge_prev_turns(prev_turns_text_list, final_user_message):
     prev_turns_merged = []
 
@@ -360,6 +1036,7 @@ def build_prompt_records_for_llama_truncated(
     add_unused_len_to_cands=True,
     allow_iterative_reduction=False,
     parser=None,
+    prompt_state: PromptState = None,
 ):
     """
     Parameters
@@ -373,6 +1050,9 @@ def build_prompt_records_for_llama_truncated(
         tokens from the input. For example, if we remove a token that is part of a word, but
         the updated text is retokenized to the same number of tokens, then we will continue
         to remove tokens until we reach the max_tokens limit.
+    prompt_state : PromptState
+        Incremental state of the replay (instructor chat turns, formatted turns, utterance
+        context). Defaults to the state kept by the replay.
     """
     if system_prompt_template is None:
         system_prompt_template = get_system_prompt_template_for_llama_mc_concise()
@@ -383,21 +1063,35 @@ def build_prompt_records_for_llama_truncated(
     if final_user_message is None:
         final_user_message = get_final_user_message()
 
-    instructor_chat_turns = find_turns_with_instructor_chat(replay, turn)
-
-    utterance_context = format_utterances_truncated(
-        instructor_chat_turns,
-        tokenizer=tokenizer,
-        max_tokens=max_utterance_tokens,
-        num_utterances=num_utterances,
-        format_utterances_fn=format_utterances,
-        allow_iterative_reduction=allow_iterative_reduction,
+    if prompt_state is None:
+        prompt_state = get_prompt_state(replay)
+
+    # Only changes when an instructor utterance leaves the previous turns
+    instructor_chat_turns = prompt_state.find_turns_with_instructor_chat(turn)
+    utterance_context = prompt_state.get_context(
+        "prompt_utterance_context",
+        key=(
+            prompt_state.chat_key(instructor_chat_turns),
+            max_utterance_tokens,
+            num_utterances,
+            allow_iterative_reduction,
+        ),
+        build=lambda: format_utterances_truncated(
+            instructor_chat_turns,
+            tokenizer=tokenizer,
+            max_tokens=max_utterance_tokens,
+            num_utterances=num_utterances,
+            format_utterances_fn=format_utterances,
+            allow_iterative_reduction=allow_iterative_reduction,
+        ),
     )
 
     prev_turns_text_list = multi_attempt_format_prev_turns_truncated(
         replay=replay,
         turn=turn,
-        format_intent=partial(format_intent, return_as=dict),
+        format_intent=partial(
+            prompt_state.cached_format(format_intent), return_as=dict
+        ),
         tokenizer=tokenizer,
         num_prev_turns=num_prev_turns,
         turn_sep=None,  # output list
@@ -422,7 +1116,11 @@ def build_prompt_records_for_llama_truncated(
 
     html = ""
     if include_html and turn.html not in ["", None] and cands_turn is not None:
-        dom_tree_raw = lxml.html.fromstring(turn.html, parser=parser)
+        if parser is None:
+            # Shared parse of the turn, `clean_and_prune_tree` prunes a copy of it
+            dom_tree_raw = get_parsed_page(turn).root
+        else:
+            dom_tree_raw = lxml.html.fromstring(turn.html, parser=parser)
         dom_tree_pruned = clean_and_prune_tree(dom_tree_raw, cands_turn=cands_turn)
         trunc = multi_attempt_truncate_dom_tree(
             dom_tree=dom_tree_pruned,
@@ -0,0 +1,239 @@
+"""
+Grammar of the actions the model can generate, for constrained decoding.
+
+The system prompt lists the only forms an action can take (`click(uid=[str])`,
+`text_input(text=[str], uid=[str])`, ...). `ActionGrammar` accepts exactly the prefixes of
+these forms, written the way the previous turns of the prompt are formatted
+(`click(uid="12")`), with the `uid` values limited to the candidates of the prompt.
+
+`TokenConstraint` applies the grammar to the tokens of one generation: it tracks the state of
+the text generated so far and filters the tokens that keep it valid, only allowing the end of
+the sequence once the closing bracket was generated.
+"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+STRING = "str"
+INTEGER = "int"
+UID = "uid"
+
+# Literal parts & value slots of each action, as formatted in the previous turns
+ACTION_FORMS = {
+    "change": ['change(value="', STRING, '", uid="', UID, '")'],
+    "click": ['click(uid="', UID, '")'],
+    "load": ['load(url="', STRING, '")'],
+    "say": ['say(speaker="navigator", utterance="', STRING, '")'],
+    "scroll": ["scroll(x=", INTEGER, ", y=", INTEGER, ")"],
+    "submit": ['submit(uid="', UID, '")'],
+    "text_input": ['text_input(text="', STRING, '", uid="', UID, '")'],
+}
+
+SLOTS = {STRING, INTEGER, UID}
+
+# One way the text can be parsed so far: (form, segment, offset in the literal, slot value)
+Alternative = Tuple[int, int, int, str]
+# (leading whitespace, alternatives), `-1` leading whitespace once the action started
+State = Tuple[int, Tuple[Alternative, ...]]
+
+
+class ActionGrammar:
+    """
+    Prefix automaton of the action forms.
+
+    Parameters:
+    -----------------
+    uids: Iterable[str]
+        UIDs the actions can refer to. `None` accepts any string.
+    forms: Dict[str, List[str]]
+        Literal parts & slots of each action.
+    max_str_len: int
+        Longest string value (utterance, text, url, ...), then the value has to be closed.
+    max_int_len: int
+        Most digits of an integer value.
+    max_leading_spaces: int
+        Whitespace accepted before the action (e.g. the space of the first sentencepiece).
+    """
+
+    def __init__(
+        self,
+        uids: Optional[Iterable[str]] = None,
+        forms: Dict[str, List[str]] = ACTION_FORMS,
+        max_str_len: int = 200,
+        max_int_len: int = 6,
+        max_leading_spaces: int = 2,
+    ):
+        self.forms = list(forms.values())
+        self.max_str_len = max_str_len
+        self.max_int_len = max_int_len
+        self.max_leading_spaces = max_leading_spaces
+
+        self.uids = None
+        self.uid_prefixes = None
+        if uids is not None:
+            self.uids = {str(uid) for uid in uids}
+            self.uid_prefixes = {
+                uid[:i] for uid in self.uids for i in range(len(uid) + 1)
+            }
+
+    def initial_state(self) -> State:
+        return 0, tuple((f, 0, 0, "") for f in range(len(self.forms)))
+
+    def is_complete(self, state: State) -> bool:
+        return any(s == len(self.forms[f]) for f, s, _, _ in state[1])
+
+    def advance(self, state: State, text: str) -> Optional[State]:
+        """
+        State after `text`, or `None` if `text` cannot continue the action.
+        """
+        leading, alternatives = state
+        for char in text:
+            if leading >= 0 and char in " \n":
+                if leading >= self.max_leading_spaces:
+                    return None
+                leading += 1
+                continue
+            leading = -1
+
+            alternatives = tuple(
+                next_alt
+                for alt in alternatives
+                for next_alt in self._advance_char(alt, char)
+            )
+            if not alternatives:
+                return None
+
+        return leading, alternatives
+
+    def _advance_char(self, alt: Alternative, char: str) -> List[Alternative]:
+        f, s, pos, value = alt
+        segments = self.forms[f]
+        if s == len(segments):
+            # Nothing can follow the closing bracket
+            return []
+
+        segment = segments[s]
+        if segment not in SLOTS:
+            if segment[pos] != char:
+                return []
+            if pos + 1 < len(segment):
+                return [(f, s, pos + 1, "")]
+            return [self._next_segment(f, s)]
+
+        results = []
+        if self._can_extend(segment, value, char):
+            results.append((f, s, 0, value + char))
+        if self._can_close(segment, value):
+            # The slot ends where the next literal starts
+            closing = segments[s + 1]
+            if closing[0] == char:
+                if len(closing) > 1:
+                    results.append((f, s + 1, 1, ""))
+                else:
+                    results.append(self._next_segment(f, s + 1))
+        return results
+
+    def _next_segment(self, f: int, s: int) -> Alternative:
+        return (f, s + 1, 0, "")
+
+    def _can_extend(self, slot: str, value: str, char: str) -> bool:
+        if slot == UID and self.uid_prefixes is not None:
+            return value + char in self.uid_prefixes
+        if slot == INTEGER:
+            digits = value.lstrip("-")
+            if char == "-":
+                return value == ""
+            return char.isdigit() and len(digits) < self.max_int_len
+        # Strings are quoted without escaping, so they cannot hold quotes
+        return char not in '"\n' and len(value) < self.max_str_len
+
+    def _can_close(self, slot: str, value: str) -> bool:
+        if slot == UID and self.uids is not None:
+            return value in self.uids
+        if slot == INTEGER:
+            return value.lstrip("-") != ""
+        return True
+
+
+def build_token_texts(tokenizer) -> List[Optional[str]]:
+    """
+    Text of each token of the vocabulary as it appears in a decoded sequence (with the space
+    sentencepiece marks with `▁`). Special tokens are `None`, bytes that are part of a
+    multi-byte character are a replacement character (only accepted inside strings).
+    """
+    special_ids = set(tokenizer.all_special_ids)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+    texts = []
+    for token_id, token in enumerate(tokens):
+        if token is None or token_id in special_ids:
+            texts.append(None)
+        elif len(token) == 6 and token.startswith("<0x") and token.endswith(">"):
+            byte = int(token[3:5], 16)
+            texts.append(chr(byte) if byte < 128 else "�")
+        elif "▁" in token:
+            texts.append(token.replace("▁", " "))
+        else:
+            texts.append(tokenizer.convert_tokens_to_string([token]))
+    return texts
+
+
+class TokenConstraint:
+    """
+    Grammar state of one generation (a single sequence).
+
+    Parameters:
+    -----------------
+    grammar: ActionGrammar
+        Grammar the generated text follows.
+    token_texts: Sequence[Optional[str]]
+        Text of each token, see `build_token_texts`.
+    eos_token_id: int
+        Only token allowed once the action is complete.
+    """
+
+    def __init__(
+        self,
+        grammar: ActionGrammar,
+        token_texts: Sequence[Optional[str]],
+        eos_token_id: int,
+    ):
+        self.grammar = grammar
+        self.token_texts = token_texts
+        self.eos_token_id = eos_token_id
+        self.state = grammar.initial_state()
+        self.num_tokens = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.state is not None and self.grammar.is_complete(self.state)
+
+    def allowed_tokens(
+        self, token_ids: Iterable[int], max_tokens: Optional[int] = None
+    ) -> List[int]:
+        """
+        Filters the tokens that keep the text valid, in the given order (e.g. by score), up
+        to `max_tokens` of them.
+        """
+        if self.state is None or self.complete:
+            return [self.eos_token_id]
+
+        allowed = []
+        for token_id in token_ids:
+            text = self.token_texts[token_id] if token_id < len(self.token_texts) else None
+            if not text:
+                continue
+            if self.grammar.advance(self.state, text) is not None:
+                allowed.append(token_id)
+                if max_tokens is not None and len(allowed) >= max_tokens:
+                    break
+        return allowed
+
+    def consume(self, token_id: int):
+        """
+        Advances the state with a generated token.
+        """
+        self.num_tokens += 1
+        if token_id == self.eos_token_id or self.state is None:
+            return
+        text = self.token_texts[token_id] if token_id < len(self.token_texts) else None
+        self.state = self.grammar.advance(self.state, text) if text else None
@@ -0,0 +1,200 @@
+"""
+Columnar bounding boxes of a page.
+
+Busy pages have thousands of tagged elements. Instead of one `BoundingBox` model per element,
+the bboxes of a page are held as an array of uids and a packed `(n, 8)` float array, validated in
+bulk. The table still reads like the `{uid -> bbox}` dict the weblinx helpers expect.
+"""
+
+import numpy as np
+
+from collections.abc import Mapping
+from pydantic_core import core_schema
+from typing import Any, Dict, Iterator, List, Optional
+
+# Order of the packed columns
+COLUMNS = ("x", "y", "width", "height", "top", "bottom", "left", "right")
+X, Y, WIDTH, HEIGHT, TOP, BOTTOM, LEFT, RIGHT = range(len(COLUMNS))
+
+
+class BBoxTable(Mapping):
+    """
+    Read-only `{uid -> bbox dict}` mapping backed by a uid array and a `(n, 8)` float array.
+
+    Accepted inputs (see `validate`):
+    * the legacy `{uid: {"x": .., "y": .., ...}}` dict sent by the extension,
+    * the columnar `{"uids": [...], "values": [[x, y, width, height, top, bottom, left, right], ...]}`.
+    """
+
+    def __init__(self, uids: np.ndarray, values: np.ndarray):
+        """
+        Parameters:
+        -----------------
+        uids: np.ndarray
+            UIDs of the elements, shape `(n,)`.
+        values: np.ndarray
+            Bboxes of the elements, shape `(n, 8)`, columns in the `COLUMNS` order.
+        """
+        self.uids = uids
+        self.values = values
+        self._index = None
+
+    def __repr__(self):
+        return f"BBoxTable({len(self)} elements)"
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.uids.tolist())
+
+    def __contains__(self, uid) -> bool:
+        return uid in self.index
+
+    def __getitem__(self, uid: str) -> Dict[str, float]:
+        return self.row(self.index[uid])
+
+    def __getstate__(self):
+        # The index is rebuilt on demand
+        return {"uids": self.uids, "values": self.values}
+
+    def __setstate__(self, state):
+        self.__init__(state["uids"], state["values"])
+
+    @property
+    def index(self) -> Dict[str, int]:
+        # Built on the first lookup by uid, first occurrence wins
+        if self._index is None:
+            index = {}
+            for i, uid in enumerate(self.uids.tolist()):
+                index.setdefault(uid, i)
+            self._index = index
+        return self._index
+
+    @property
+    def nbytes(self) -> int:
+        return self.uids.nbytes + self.values.nbytes
+
+    def row(self, i: int) -> Dict[str, float]:
+        return dict(zip(COLUMNS, self.values[i].tolist()))
+
+    def column(self, name: str) -> np.ndarray:
+        return self.values[:, COLUMNS.index(name)]
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        return {uid: self.row(i) for uid, i in self.index.items()}
+
+    def updated(self, changes: Dict[str, Optional[Any]]) -> "BBoxTable":
+        """
+        Returns a new table with the bboxes of `changes` set, or removed when `None`.
+        """
+        removed = {uid for uid, bbox in changes.items() if bbox is None}
+        changed = {uid: bbox for uid, bbox in changes.items() if bbox is not None}
+
+        keep = np.fromiter(
+            (uid not in removed and uid not in changed for uid in self.uids.tolist()),
+            dtype=bool,
+            count=len(self),
+        )
+        new = BBoxTable.from_dict(changed)
+
+        return BBoxTable(
+            uids=np.concatenate([self.uids[keep], new.uids]),
+            values=np.concatenate([self.values[keep], new.values]),
+        )
+
+    def visible_mask(
+        self,
+        min_height: float = 10,
+        min_width: float = 10,
+        viewport_height: Optional[float] = None,
+        viewport_width: Optional[float] = None,
+    ) -> np.ndarray:
+        """
+        Vectorized `weblinx.utils.html.filter_bboxes`: mask of the bboxes with a positive size,
+        not smaller than the minimum height and width, and not past the viewport.
+        """
+        width, height = self.values[:, WIDTH], self.values[:, HEIGHT]
+
+        mask = (width > 0) & (height > 0)
+        mask &= (width >= min_width) | (height >= min_height)
+        if viewport_height is not None:
+            mask &= self.values[:, Y] <= viewport_height
+        if viewport_width is not None:
+            mask &= self.values[:, X] <= viewport_width
+
+        return mask
+
+    @classmethod
+    def from_dict(cls, bboxes: Dict[str, Any]) -> "BBoxTable":
+        """
+        Builds the table from `{uid -> bbox}`, the bbox being a dict or a `BoundingBox`.
+        """
+        uids = np.array(list(bboxes.keys()), dtype=str)
+        try:
+            rows = [[b[c] for c in COLUMNS] for b in bboxes.values()]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Each bbox should have the fields {COLUMNS}: {e}")
+        return cls(uids=uids, values=cls._check_values(rows, len(uids)))
+
+    @classmethod
+    def from_columns(cls, uids: List[str], values: List[List[float]]) -> "BBoxTable":
+        uids = np.array(uids, dtype=str)
+        return cls(uids=uids, values=cls._check_values(values, len(uids)))
+
+    @staticmethod
+    def _check_values(values, n: int) -> np.ndarray:
+        try:
+            values = np.asarray(values, dtype=np.float64).reshape(n, len(COLUMNS))
+        except (TypeError, ValueError) as e:
+            raise ValueError(
+                f"Bboxes should be {n} rows of {len(COLUMNS)} numbers {COLUMNS}: {e}"
+            )
+        if not np.isfinite(values).all():
+            raise ValueError("Bboxes should only contain finite numbers.")
+        return values
+
+    @classmethod
+    def validate(cls, value: Any) -> "BBoxTable":
+        if isinstance(value, cls):
+            return value
+        if not isinstance(value, Mapping):
+            raise ValueError("Bboxes should be a mapping.")
+        if "uids" in value and "values" in value:
+            return cls.from_columns(value["uids"], value["values"])
+        return cls.from_dict(value)
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        bbox_schema = core_schema.typed_dict_schema(
+            {c: core_schema.typed_dict_field(core_schema.float_schema()) for c in COLUMNS}
+        )
+        input_schema = core_schema.union_schema(
+            [
+                core_schema.dict_schema(core_schema.str_schema(), bbox_schema),
+                core_schema.typed_dict_schema(
+                    {
+                        "uids": core_schema.typed_dict_field(
+                            core_schema.list_schema(core_schema.str_schema())
+                        ),
+                        "values": core_schema.typed_dict_field(
+                            core_schema.list_schema(
+                                core_schema.list_schema(
+                                    core_schema.float_schema(),
+                                    min_length=len(COLUMNS),
+                                    max_length=len(COLUMNS),
+                                )
+                            )
+                        ),
+                    }
+                ),
+            ]
+        )
+        # The input schema only documents the accepted formats, validation is done in bulk
+        return core_schema.no_info_plain_validator_function(
+            cls.validate,
+            json_schema_input_schema=input_schema,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda table: table.to_dict()
+            ),
+        )
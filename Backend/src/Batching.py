@@ -0,0 +1,243 @@
+"""
+Request coalescing for the models.
+
+Concurrent sessions each submit a single item (a prompt, a list of sentences, ...). A background
+thread collects the pending items within a short time window, or until the batch is full, runs
+them through the model as one batch and routes each result back to its caller.
+"""
+
+import logging
+import queue
+import time
+
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+
+from Tracing import attach_trace, current_span, detached_trace
+
+
+# Put in the queue to stop the background thread
+_SHUTDOWN = object()
+
+
+class _PendingItem:
+    def __init__(self, item: Any, cost: int):
+        self.item = item
+        self.cost = cost
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+        # Span of the caller, the spans of the batch are added to its trace
+        self.parent_span = current_span()
+
+
+class BatchStats:
+    """
+    Thread-safe metrics of the batches run, grouped by batch size.
+    """
+
+    def __init__(self, max_batch_size: int, max_batch_cost: Optional[int] = None):
+        self._lock = Lock()
+        self.max_batch_size = max_batch_size
+        self.max_batch_cost = max_batch_cost
+        self.by_size = {}
+
+    def record(self, batch_size: int, cost: int, run: float, waits: List[float]):
+        with self._lock:
+            stats = self.by_size.setdefault(
+                batch_size,
+                {"batches": 0, "items": 0, "cost": 0, "run_s": 0.0, "wait_s": 0.0},
+            )
+            stats["batches"] += 1
+            stats["items"] += batch_size
+            stats["cost"] += cost
+            stats["run_s"] += run
+            stats["wait_s"] += sum(waits)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            by_size = {}
+            total_batches, total_items, total_cost = 0, 0, 0
+            for size, s in sorted(self.by_size.items()):
+                total_batches += s["batches"]
+                total_items += s["items"]
+                total_cost += s["cost"]
+                by_size[size] = {
+                    "batches": s["batches"],
+                    "items": s["items"],
+                    "avg_cost": s["cost"] / s["batches"],
+                    "avg_batch_latency_s": s["run_s"] / s["batches"],
+                    "avg_queue_wait_s": s["wait_s"] / s["items"],
+                    "throughput_items_per_s": (
+                        s["items"] / s["run_s"] if s["run_s"] > 0 else None
+                    ),
+                }
+
+            stats = {
+                "batches": total_batches,
+                "items": total_items,
+                "avg_batch_size": total_items / max(total_batches, 1),
+                "avg_batch_fill": total_items
+                / max(total_batches * self.max_batch_size, 1),
+            }
+            if self.max_batch_cost:
+                stats["avg_cost_fill"] = total_cost / max(
+                    total_batches * self.max_batch_cost, 1
+                )
+            stats["by_batch_size"] = by_size
+
+            return stats
+
+
+class DynamicBatcher:
+    """
+    Collects items submitted from several threads into batches and runs `process_fn` on them
+    from a single background thread.
+
+    A batch is flushed when either:
+    * `max_wait_ms` has passed since its first item was submitted,
+    * it holds `max_batch_size` items,
+    * adding the next item would make `batch_cost_fn` exceed `max_batch_cost`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int,
+        max_wait_ms: float,
+        max_batch_cost: Optional[int] = None,
+        batch_cost_fn: Callable[[List[int]], int] = sum,
+    ):
+        """
+        Parameters:
+        -----------------
+        name: str
+            Name of the batcher, used in logs and thread names.
+        process_fn: Callable[[List[Any]], List[Any]]
+            Runs a batch of items and returns one result per item, in the same order.
+        max_batch_size: int
+            Maximum number of items per batch.
+        max_wait_ms: float
+            Maximum time the first item of a batch waits for other items.
+        max_batch_cost: int
+            Maximum cost of a batch (e.g. number of padded tokens). `None` means no limit.
+        batch_cost_fn: Callable[[List[int]], int]
+            Computes the cost of a batch from the costs of its items.
+        """
+        self.name = name
+        self.process_fn = process_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_cost = max_batch_cost
+        self.batch_cost_fn = batch_cost_fn
+
+        self.stats = BatchStats(self.max_batch_size, self.max_batch_cost)
+        self._queue = queue.Queue()
+        self._carry = None
+        self._thread = Thread(target=self._loop, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+        logging.info(f"Finished Initializing Dynamic Batcher ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Batcher: {self.name}\n"
+        str_rep += f"Max Batch Size: {self.max_batch_size}\n"
+        str_rep += f"Max Wait (ms): {self.max_wait * 1000}\n"
+        str_rep += f"Max Batch Cost: {self.max_batch_cost}"
+        return str_rep
+
+    def submit(self, item: Any, cost: int = 1) -> Future:
+        """
+        Queues an item for the next batch. The returned future resolves to its result.
+        """
+        pending = _PendingItem(item, cost)
+        self._queue.put(pending)
+        return pending.future
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"queue_depth": self._queue.qsize(), **self.stats.to_dict()}
+
+    def shutdown(self):
+        self._queue.put(_SHUTDOWN)
+        self._thread.join()
+
+    def _fits(self, batch: List[_PendingItem], pending: _PendingItem) -> bool:
+        if len(batch) >= self.max_batch_size:
+            return False
+        if self.max_batch_cost is None:
+            return True
+        costs = [p.cost for p in batch] + [pending.cost]
+        return self.batch_cost_fn(costs) <= self.max_batch_cost
+
+    def _collect(self) -> Optional[List[_PendingItem]]:
+        first = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        if first is _SHUTDOWN:
+            return None
+
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                pending = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+
+            if (pending is _SHUTDOWN) or (not self._fits(batch, pending)):
+                # Goes first in the next batch (or stops the loop)
+                self._carry = pending
+                break
+
+            batch.append(pending)
+
+        return batch
+
+    @staticmethod
+    def _attach_traces(batch: List[_PendingItem], batch_span, waits: List[float]):
+        for p, wait in zip(batch, waits):
+            attach_trace(batch_span.trace, p.parent_span, queue_wait_s=wait)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            started_at = time.perf_counter()
+            waits = [started_at - p.enqueued_at for p in batch]
+
+            try:
+                with detached_trace(
+                    f"{self.name}.batch", batch_size=len(batch)
+                ) as batch_span:
+                    results = self.process_fn([p.item for p in batch])
+                    if len(results) != len(batch):
+                        raise RuntimeError(
+                            f"{self.name} returned {len(results)} results for {len(batch)} items."
+                        )
+            except Exception as e:
+                logging.error(f"Batch of {len(batch)} failed in {self.name}: {e}")
+                self._attach_traces(batch, batch_span, waits)
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+
+            # Before the results, the callers' traces may end as soon as they get them
+            self._attach_traces(batch, batch_span, waits)
+
+            for p, result in zip(batch, results):
+                p.future.set_result(result)
+
+            self.stats.record(
+                batch_size=len(batch),
+                cost=self.batch_cost_fn([p.cost for p in batch]),
+                run=time.perf_counter() - started_at,
+                waits=waits,
+            )
@@ -6,24 +6,31 @@ For faster inferences, we remove attributes that are not needed for inference.
 
 import abc
 import logging
-import lxml.html
-import requests
+import numpy as np
 import torch
 import weblinx as wl
-import weblinx.utils.html as wh
 import weblinx.utils.format as wf
 
 from copy import deepcopy
 from functools import partial
 from sentence_transformers import SentenceTransformer
 from sentence_transformers.util import cos_sim, dot_score
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from weblinx.processing.prompt import (
     format_prev_turns,
-    find_turns_with_instructor_chat,
     format_utterances,
 )
 
+from Batching import DynamicBatcher
+from EmbeddingCache import EmbeddingCache
+from InferenceContext import InferenceContext
+from Profiling import timed
+from PromptState import get_prompt_state
+from RemoteClient import RemoteClient, RemoteError, SentenceSimilarityClient
+from Ranking import rank_scores, select_top_k
+from Tracing import set_attributes
+from WebLinxHelper import get_parsed_page, get_spatial_index
+
 
 class BaseDMR(metaclass=abc.ABCMeta):
     """
@@ -85,6 +92,39 @@ class BaseDMR(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    @timed("rank_records")
+    def rank_top_k(
+        self,
+        query: str,
+        records: List[Dict],
+        k: Optional[int] = None,
+        full_ranks: bool = False,
+    ) -> List[Dict]:
+        """
+        Returns the `k` best records sorted by rank, only they get a `score` and a `rank`.
+
+        Parameters:
+        -----------
+        k: int
+            Number of records to return, `None` returns all of them.
+        full_ranks: bool
+            Ranks & returns every record whatever `k` (for debugging).
+        """
+        scores = self.score_records(query, records)
+
+        top = select_top_k(scores, None if full_ranks else k).tolist()
+        for rank, i in enumerate(top, start=1):
+            records[i]["score"] = float(scores[i])
+            records[i]["rank"] = rank
+
+        return [records[i] for i in top]
+
+    def score_records(self, query: str, records: List[Dict]) -> np.ndarray:
+        """
+        Similarity score of each record to the query, in the order of the records.
+        """
+        raise NotImplementedError
+
 
 class DMR(BaseDMR):
     """
@@ -97,6 +137,10 @@ class DMR(BaseDMR):
         sim_method: str,
         use_bf16: bool = True,
         batch_size_per_device: int = 64,
+        max_seq_length: int = None,
+        device: str = None,
+        memory_threshold: float = 0.9,
+        min_release_interval_s: float = 5.0,
     ):
         """
         Initializes the DMR model.
@@ -108,20 +152,43 @@ class DMR(BaseDMR):
         sim_method: str
             Method to compare similarity to
         use_bf16: bool
-            Whether to use bf16 tensor type
+            Whether to run the encoder in bf16 (autocast, on CUDA only)
         batch_size_per_device: int
             Batch size to run the model
+        max_seq_length: int
+            Tokens kept of each sentence, defaults to the model's
+        device: str
+            Device to run the model on, defaults to the first GPU if any
+        memory_threshold: float
+            Fraction of the GPU memory reserved above which the allocator cache is released
+        min_release_interval_s: float
+            Minimum time between two releases of the allocator cache
         """
 
         self.name = name
         self.sim_method = sim_method
 
-        self.use_amp = not use_bf16
         self.torch_dtype = torch.bfloat16 if use_bf16 else torch.float32
         self.batch_size_per_device = batch_size_per_device
 
         # Setup model
-        self.model = SentenceTransformer(self.name)
+        self.model = SentenceTransformer(self.name, device=device)
+        if max_seq_length is not None:
+            self.model.max_seq_length = max_seq_length
+
+        # The weights stay in float32 and the encoder runs under a bf16 autocast on CUDA (layer
+        # norms run in float32 under autocast, so are the embeddings). CPU hosts run in float32
+        self.inference = InferenceContext(
+            device=self.model.device,
+            weights_dtype=next(self.model.parameters()).dtype,
+            compute_dtype=self.torch_dtype,
+            memory_threshold=memory_threshold,
+            min_release_interval_s=min_release_interval_s,
+        )
+
+        # Set by `enable_batching` and `enable_cache`
+        self.batcher = None
+        self.cache = None
 
         # Setup similarity method
         # Use cos_sim as similarity function as default
@@ -136,43 +203,132 @@ class DMR(BaseDMR):
     def __str__(self):
         str_rep = f"Model Name - {self.name}\n"
         str_rep += f"Similarity Method: {self.sim_method}\n"
-        str_rep += f"Loaded model with bf16: {not self.use_amp}\n"
-        str_rep += f"Batch Size: {self.batch_size_per_device}"
+        str_rep += f"Dtype: {self.inference.effective_dtype}\n"
+        str_rep += f"Batch Size: {self.batch_size_per_device}\n"
+        str_rep += f"Max Sequence Length: {self.model.max_seq_length}\n"
+        str_rep += f"Device: {self.model.device}\n"
+        str_rep += f"Cross-session Batching: {self.batcher is not None}\n"
+        str_rep += f"Embedding Cache: {self.cache is not None}"
         return str_rep
 
+    def enable_batching(
+        self,
+        max_wait_ms: float = 5,
+        max_batch_size: int = 16,
+        max_batch_sentences: int = None,
+    ):
+        """
+        Merges the sentences of concurrent `rank_records` calls into shared encoder batches.
+
+        Parameters:
+        -----------------
+        max_wait_ms: float
+            How long the first request of a batch waits for requests from other sessions.
+        max_batch_size: int
+            Maximum number of requests merged into one batch.
+        max_batch_sentences: int
+            Maximum number of sentences (query + docs) in a merged batch.
+        """
+        self.batcher = DynamicBatcher(
+            name="dmr",
+            process_fn=self.encode_many,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            max_batch_cost=max_batch_sentences,
+        )
+
+    def enable_cache(self, max_bytes: int, max_entries: int = None):
+        """
+        Caches embeddings by content so repeated records are not re-encoded.
+
+        Parameters:
+        -----------------
+        max_bytes: int
+            Memory cap of the cache.
+        max_entries: int
+            Maximum number of cached embeddings.
+        """
+        self.cache = EmbeddingCache(max_bytes=max_bytes, max_entries=max_entries)
+
     def build_query(self, replay: wl.Replay, turn: wl.Turn):
         return build_query(replay=replay, turn=turn)
 
     def build_records(self, turn: wl.Turn, uid_key: str) -> List[Dict]:
         return build_records(turn=turn, uid_key=uid_key)
 
-    def rank_records(self, query: str, records: List[Dict]) -> List[Dict]:
+    def encode_cached(self, sentences: List[str]) -> np.ndarray:
+        """
+        Encodes the sentences, only running the model on the ones missing from the cache.
+        """
+        if self.cache is None:
+            return self.encode(sentences)
 
-        with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.torch_dtype):
-            docs = [r["doc"] for r in records]
+        keys = [EmbeddingCache.make_key(self.name, s) for s in sentences]
+        vectors = self.cache.get_many(keys)
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            encoded = self.encode([sentences[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], encoded)
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+
+        return np.stack(vectors)
+
+    def encode(self, sentences: List[str]):
+        """
+        Encodes the sentences, through the shared batcher if batching is enabled.
+        """
+        if self.batcher is not None:
+            return self.batcher.submit(sentences, cost=len(sentences)).result()
+        return self.encode_many([sentences])[0]
+
+    @timed("encode")
+    def encode_many(self, sentences_list: List[List[str]]) -> List[Any]:
+        """
+        Encodes several lists of sentences as one batch and splits the embeddings back per list.
+        """
+        flat = [s for sentences in sentences_list for s in sentences]
+        set_attributes(sentences=len(flat))
+
+        with self.inference():
             encoded = self.model.encode(
-                [query] + docs,
+                flat,
                 batch_size=self.batch_size_per_device,
                 show_progress_bar=False,
             )
-            query_vector, doc_vectors = encoded[0], encoded[1:]
-            scores = self.sim_func(query_vector, doc_vectors).cpu().squeeze().tolist()
-            if isinstance(scores, float):
-                scores = [scores]
 
-            for i, r in enumerate(records):
-                r["score"] = scores[i]
+        outputs = []
+        start = 0
+        for sentences in sentences_list:
+            outputs.append(encoded[start : start + len(sentences)])
+            start += len(sentences)
+
+        return outputs
 
-        torch.cuda.empty_cache()
+    @timed("rank_records")
+    def rank_records(self, query: str, records: List[Dict]) -> List[Dict]:
+        scores = self.score_records(query, records)
 
-        # Add rank
-        scores = {r["uid"]: r["score"] for r in records}
-        ranks = get_ranks_from_scores(scores)
-        for r in records:
-            r["rank"] = ranks[r["uid"]]
+        ranks = rank_scores(scores)
+        for r, score, rank in zip(records, scores.tolist(), ranks.tolist()):
+            r["score"] = score
+            r["rank"] = rank
 
         return records
 
+    def score_records(self, query: str, records: List[Dict]) -> np.ndarray:
+        set_attributes(records=len(records))
+        if not records:
+            return np.zeros(0, dtype=np.float32)
+
+        docs = [r["doc"] for r in records]
+        encoded = self.encode_cached([query] + docs)
+
+        query_vector, doc_vectors = encoded[0], encoded[1:]
+        scores = self.sim_func(query_vector, doc_vectors)
+        return scores.float().cpu().numpy().reshape(-1)
+
 
 class HF_DMR(BaseDMR):
     """
@@ -184,6 +340,8 @@ class HF_DMR(BaseDMR):
         api_url: str,
         auth_token: str,
         sim_method: str,
+        chunk_size: int = 256,
+        **client_kwargs,
     ):
         """
         Initializes the DMR model.
@@ -196,14 +354,22 @@ class HF_DMR(BaseDMR):
             Authentication token to pass in the headers for the inference api.
         sim_method: str
             Method to compare similarity to
-        batch_size_per_device: int
-            Batch size to run the model
+        chunk_size: int
+            Maximum number of records scored by one call, larger pages are split into calls
+            sent in parallel
+        client_kwargs:
+            Timeouts, pool size, concurrency, retries & circuit breaker of the `RemoteClient`
         """
 
         self.api_url = api_url
         self.headers = {"Authorization": auth_token}
         self.sim_method = sim_method
 
+        self.client = RemoteClient(
+            name="dmr", base_url=api_url, headers=self.headers, **client_kwargs
+        )
+        self.similarity = SentenceSimilarityClient(self.client, chunk_size=chunk_size)
+
         # Setup similarity method
         # Use cos_sim as similarity function as default
         self.sim_func = cos_sim
@@ -217,6 +383,7 @@ class HF_DMR(BaseDMR):
     def __str__(self):
         str_rep = f"Model hosted @ URL - {self.api_url}\n"
         str_rep += f"Similarity Method: {self.sim_method}\n"
+        str_rep += f"Chunk Size: {self.similarity.chunk_size}\n"
         return str_rep
 
     def build_query(self, replay: wl.Replay, turn: wl.Turn):
@@ -225,49 +392,36 @@ class HF_DMR(BaseDMR):
     def build_records(self, turn: wl.Turn, uid_key: str) -> List[Dict]:
         return build_records(turn=turn, uid_key=uid_key)
 
-    def _query_api(self, payload):
-        response = requests.post(self.api_url, headers=self.headers, json=payload)
-        response.raise_for_status()
-        return response.json()
-
+    @timed("rank_records")
     def rank_records(self, query: str, records: List[Dict]) -> List[Dict]:
+        scores = self.score_records(query, records)
 
-        try:
-
-            docs = [r["doc"] for r in records]
-            payload = {
-                "inputs": {
-                    "source_sentence": query,
-                    "sentences": docs,
-                }
-            }
+        ranks = rank_scores(scores)
+        for r, score, rank in zip(records, scores.tolist(), ranks.tolist()):
+            r["score"] = score
+            r["rank"] = rank
 
-            scores = self._query_api(payload)
+        return records
 
-            if isinstance(scores, float):
-                scores = [scores]
+    def score_records(self, query: str, records: List[Dict]) -> np.ndarray:
+        set_attributes(records=len(records))
 
-            for i, r in enumerate(records):
-                r["score"] = scores[i]
+        try:
 
-            scores = {r["uid"]: r["score"] for r in records}
-            ranks = get_ranks_from_scores(scores)
-            for r in records:
-                r["rank"] = ranks[r["uid"]]
+            docs = [r["doc"] for r in records]
+            scores = self.similarity.get_scores(query, docs)
+            return np.asarray(scores, dtype=np.float32)
 
-        except requests.exceptions.RequestException as e:
+        except RemoteError as e:
 
             error_msg = f"Trouble requesting from URL: {self.api_url}\n"
             error_msg += "Providing rank based on the order in the HTML page.\n"
             error_msg += f"Error:\n{e}"
             logging.error(error_msg)
+            set_attributes(dmr_fallback=type(e).__name__)
 
-            # Candidates are just ranked & scored in the order they came in
-            for rank, r in enumerate(records, start=1):
-                r["rank"] = rank
-                r["score"] = -1
-
-        return records
+            # Candidates are just ranked in the order they came in, with a score of -1
+            return -np.ones(len(records), dtype=np.float32)
 
 
 ############ Helper Functions ##############################
@@ -380,6 +534,7 @@ def build_formatters():
 format_intent_input, _ = build_formatters()
 
 
+@timed("build_query")
 def build_query(
     replay,
     turn,
@@ -395,18 +550,24 @@ def build_query(
 
     If return_str is True, then the output is a string. Otherwise, it returns two strings: the utterance context and the previous turns.
     """
+    prompt_state = get_prompt_state(replay)
+
     prev_turns_text = format_prev_turns(
         replay=replay,
         turn=turn,
-        format_intent=format_intent_input,
+        format_intent=prompt_state.cached_format(format_intent_input),
         turn_sep=turn_sep,
         num_prev_turns=num_prev_turns,
     )
-    instructor_chat_turns = find_turns_with_instructor_chat(
-        replay, turn, num_prev_turns=num_prev_turns
+    instructor_chat_turns = prompt_state.find_turns_with_instructor_chat(
+        turn, num_prev_turns=num_prev_turns
     )
-    utterance_context = format_utterances(
-        instructor_chat_turns, num_utterances=num_utterances
+    utterance_context = prompt_state.get_context(
+        "query_utterance_context",
+        key=(prompt_state.chat_key(instructor_chat_turns), num_utterances),
+        build=lambda: format_utterances(
+            instructor_chat_turns, num_utterances=num_utterances
+        ),
     )
 
     if not return_str:
@@ -554,6 +715,7 @@ def convert_elem_dict_to_str_legacy(elem_dict: dict):
     return element_str
 
 
+@timed("build_records")
 def build_records(
     turn: wl.Turn,
     uid_key: str,
@@ -578,24 +740,30 @@ def build_records(
     A list of dictionary containing only visible elements with its UID, and shortened element representation.
     """
 
-    # Load HTML and get all elements we tagged
-    root = lxml.html.fromstring(turn.html)
-    root_tree = root.getroottree()
-    elements = root.xpath(f"//*[@{uid_key}]")
+    # Load HTML (parsed once per turn) and get all elements we tagged
+    page = get_parsed_page(turn)
+    root_tree = page.root_tree
+    elements = page.get_elements(uid_key)
 
     # Filter to elements within our viewport
-    bboxes_filt = wh.filter_bboxes(
-        turn.bboxes,
-        viewport_height=turn.viewport_height,
-        viewport_width=turn.viewport_width,
+    index = get_spatial_index(turn)
+    bboxes = index.bboxes
+    uids_filt = set(
+        index.visible_uids(
+            viewport_height=turn.viewport_height,
+            viewport_width=turn.viewport_width,
+        )
+    )
+    elements_filt = [p for p in elements if p.attrib[uid_key] in uids_filt]
+    set_attributes(
+        html_bytes=len(turn.html or ""), elements=len(elements), visible_elements=len(elements_filt)
     )
-    elements_filt = [p for p in elements if p.attrib[uid_key] in bboxes_filt]
 
     output_records = []
 
     # Create a record per element?
     for elem in elements_filt:
-        bbox = turn.bboxes[elem.attrib[uid_key]]
+        bbox = bboxes[elem.attrib[uid_key]]
         elem_dict = represent_element_as_dict(elem, bbox, root_tree)
         elem_str = convert_elem_dict_to_str_legacy(elem_dict)
 
@@ -610,15 +778,4 @@ def build_records(
     return output_records
 
 
-def get_ranks_from_scores(scores: Dict[Any, float], starts_at=1) -> Dict[Any, int]:
-    """
-    Given a dictionary of key -> scores, return a dictionary of key -> ranks.
-    """
-    # Get sorted keys
-    keys = sorted(scores.keys(), key=lambda k: scores[k], reverse=True)
-    ranks = {k: i + starts_at for i, k in enumerate(keys)}
-
-    return ranks
-
-
 ###############################################################################
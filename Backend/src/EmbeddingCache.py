@@ -0,0 +1,118 @@
+"""
+Content-addressed cache of sentence embeddings.
+
+Consecutive turns of a session usually send the same page, so most DMR records are identical
+from one turn to the next. Embeddings are keyed by a hash of the model name and the text,
+so only new or changed elements have to be encoded.
+"""
+
+import hashlib
+import logging
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+# Rough per-entry overhead on top of the vector (key, OrderedDict node, array header)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class EmbeddingCache:
+    """
+    LRU cache of embeddings bounded by memory (and optionally by number of entries).
+    """
+
+    def __init__(self, max_bytes: int, max_entries: Optional[int] = None):
+        """
+        Parameters:
+        -----------------
+        max_bytes: int
+            Memory cap of the cached embeddings, including a per-entry overhead estimate.
+        max_entries: int
+            Maximum number of cached embeddings. `None` means only the memory cap applies.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        logging.info(f"Finished Initializing Embedding Cache ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Max Bytes: {self.max_bytes}\n"
+        str_rep += f"Max Entries: {self.max_entries}"
+        return str_rep
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> bytes:
+        return hashlib.blake2b(
+            f"{model_name}\0{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        """
+        Looks up the keys, returning `None` for the ones not cached.
+        """
+        results = []
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                results.append(vector)
+        return results
+
+    def put_many(self, keys: List[bytes], vectors: List[np.ndarray]):
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                # Copy so that a slice does not keep the whole encoded batch alive
+                vector = np.array(vector, copy=True)
+                size = vector.nbytes + ENTRY_OVERHEAD_BYTES
+                if size > self.max_bytes:
+                    continue
+
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= old.nbytes + ENTRY_OVERHEAD_BYTES
+
+                self._entries[key] = vector
+                self.nbytes += size
+                self._evict()
+
+    def _evict(self):
+        while (self.nbytes > self.max_bytes) or (
+            self.max_entries is not None and len(self._entries) > self.max_entries
+        ):
+            _, vector = self._entries.popitem(last=False)
+            self.nbytes -= vector.nbytes + ENTRY_OVERHEAD_BYTES
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
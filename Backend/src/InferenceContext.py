@@ -0,0 +1,119 @@
+"""
+Device-aware context of the model calls.
+
+The settings of a call (autocast or not, inference mode) only depend on the device & dtypes of
+the model, so they are picked once when the model is loaded instead of on every request:
+    - inference mode (no autograd tracking) always;
+    - autocast only on CUDA, when the weights are float32 and a lower compute dtype is asked
+      for. Weights already loaded in bfloat16 gain nothing from it, and CPU hosts never go
+      through the CUDA autocast;
+    - the allocator cache is released under memory pressure (see `MemoryPressurePolicy`), or
+      when a call runs out of memory, instead of after every call.
+"""
+
+import contextlib
+import logging
+import torch
+
+from typing import Any, Dict, Iterator, Optional
+
+from MemoryPolicy import MemoryPressurePolicy
+
+
+class InferenceContext:
+    """
+    Context manager factory for the calls of a model.
+
+    Parameters:
+    -----------------
+    device: torch.device
+        Device of the model (of its first parameters for a model spread over devices).
+    weights_dtype: torch.dtype
+        Dtype the weights were loaded with.
+    compute_dtype: torch.dtype
+        Dtype to run the model in. `None` runs it in the dtype of the weights.
+    memory_threshold: float
+        Fraction of the device memory reserved above which its allocator cache is released.
+    min_release_interval_s: float
+        Minimum time between two releases under pressure.
+    """
+
+    def __init__(
+        self,
+        device,
+        weights_dtype: torch.dtype = torch.float32,
+        compute_dtype: Optional[torch.dtype] = None,
+        memory_threshold: float = 0.9,
+        min_release_interval_s: float = 5.0,
+    ):
+        self.device = torch.device(device)
+        self.weights_dtype = weights_dtype
+        self.compute_dtype = compute_dtype
+
+        self.use_autocast = (
+            self.device.type == "cuda"
+            and compute_dtype is not None
+            and compute_dtype != weights_dtype
+            and weights_dtype == torch.float32
+        )
+
+        self.memory_policy = None
+        if self.device.type == "cuda":
+            index = (
+                self.device.index
+                if self.device.index is not None
+                else torch.cuda.current_device()
+            )
+            total = torch.cuda.get_device_properties(index).total_memory
+            self.memory_policy = MemoryPressurePolicy(
+                device=f"cuda:{index}",
+                read_memory=lambda: (torch.cuda.memory_reserved(index), total),
+                release=torch.cuda.empty_cache,
+                threshold=memory_threshold,
+                min_interval_s=min_release_interval_s,
+            )
+
+        logging.info(f"Finished Initializing Inference Context ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Device: {self.device}\n"
+        str_rep += f"Weights Dtype: {self.weights_dtype}\n"
+        str_rep += f"Autocast: {self.compute_dtype if self.use_autocast else None}\n"
+        str_rep += f"Effective Dtype: {self.effective_dtype}\n"
+        str_rep += f"Memory Policy: {self.memory_policy is not None}"
+        return str_rep
+
+    @property
+    def effective_dtype(self) -> torch.dtype:
+        """
+        Dtype the model actually runs in: the compute dtype under autocast, the dtype of the
+        weights otherwise (e.g. on CPU).
+        """
+        return self.compute_dtype if self.use_autocast else self.weights_dtype
+
+    @contextlib.contextmanager
+    def __call__(self) -> Iterator[None]:
+        try:
+            with torch.inference_mode():
+                if self.use_autocast:
+                    with torch.autocast(device_type="cuda", dtype=self.compute_dtype):
+                        yield
+                else:
+                    yield
+        except torch.cuda.OutOfMemoryError:
+            if self.memory_policy is not None:
+                self.memory_policy.release(reason="oom")
+            raise
+
+        if self.memory_policy is not None:
+            self.memory_policy.check()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {
+            "device": str(self.device),
+            "autocast": self.use_autocast,
+            "dtype": str(self.effective_dtype).replace("torch.", ""),
+        }
+        if self.memory_policy is not None:
+            stats["memory"] = self.memory_policy.get_stats()
+        return stats
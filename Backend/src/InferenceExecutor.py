@@ -0,0 +1,148 @@
+"""
+Execution layer for the CPU/GPU-bound stages of a request.
+
+Each stage (DMR ranking, prompt building, generation) gets its own worker pool so a long
+generation never blocks the asyncio event loop, and stages of different sessions can overlap.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict
+
+from Tracing import span
+
+
+class StageStats:
+    """
+    Thread-safe counters for a single stage.
+    * `queued` are tasks submitted but not yet picked up by a worker.
+    * `running` are tasks currently executing on a worker.
+    * wait time is measured from submission to the moment a worker starts the task.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def on_submit(self):
+        with self._lock:
+            self.queued += 1
+
+    def on_start(self, wait: float):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def on_finish(self, run: float, failed: bool):
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+            if failed:
+                self.failed += 1
+            self.total_run += run
+            self.max_run = max(self.max_run, run)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            completed = max(self.completed, 1)
+            return {
+                "queue_depth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait_s": self.total_wait / completed,
+                "max_wait_s": self.max_wait,
+                "avg_run_s": self.total_run / completed,
+                "max_run_s": self.max_run,
+            }
+
+
+class InferenceExecutor:
+    """
+    Dispatches blocking functions to a dedicated thread pool per stage and awaits them,
+    keeping the event loop free for request parsing and other sessions.
+    """
+
+    def __init__(self, stage_workers: Dict[str, int]):
+        """
+        Parameters:
+        -----------------
+        stage_workers: Dict[str, int]
+            Mapping of stage name to the number of workers in its pool.
+        """
+        self.pools = {
+            stage: ThreadPoolExecutor(
+                max_workers=num_workers, thread_name_prefix=f"{stage}-worker"
+            )
+            for stage, num_workers in stage_workers.items()
+        }
+        self.stats = {stage: StageStats() for stage in stage_workers}
+        self.stage_workers = dict(stage_workers)
+
+        logging.info(f"Finished Initializing Inference Executor ...\n{self}")
+
+    def __str__(self):
+        return "\n".join(
+            f"Stage `{stage}`: {n} worker(s)" for stage, n in self.stage_workers.items()
+        )
+
+    async def run(self, stage: str, fn: Callable, *args, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` on the pool of `stage` and awaits its result.
+
+        Parameters:
+        -----------------
+        stage: str
+            Name of the stage; must be one of the stages the executor was created with.
+        fn: Callable
+            The blocking function to run.
+        """
+        if stage not in self.pools:
+            raise KeyError(f"Unknown stage `{stage}`. Known: {list(self.pools)}")
+
+        stats = self.stats[stage]
+        submitted_at = time.perf_counter()
+
+        def task():
+            started_at = time.perf_counter()
+            wait = started_at - submitted_at
+            stats.on_start(wait)
+            failed = False
+            try:
+                with span(f"executor.{stage}", queue_wait_s=wait):
+                    return fn(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                stats.on_finish(time.perf_counter() - started_at, failed)
+
+        stats.on_submit()
+        loop = asyncio.get_running_loop()
+        # Copy the context so the spans of the task belong to the caller's trace
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.pools[stage], ctx.run, task)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            stage: {"workers": self.stage_workers[stage], **stats.to_dict()}
+            for stage, stats in self.stats.items()
+        }
+
+    def shutdown(self, wait: bool = True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
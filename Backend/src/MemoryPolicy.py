@@ -0,0 +1,118 @@
+"""
+Memory-pressure policy of the allocator cache of a device.
+
+`torch.cuda.empty_cache()` after every call hands the cached blocks back to the driver, so the
+next call allocates them again (synchronously, on the hot path). The cache is only worth
+releasing when the device is running out of memory, e.g. for another process or before the
+next long prompt: `MemoryPressurePolicy.check` releases it when the reserved memory goes over
+a fraction of the device memory, at most once per interval.
+"""
+
+import logging
+import time
+
+from threading import Lock
+from typing import Any, Callable, Dict, Tuple
+
+from Metrics import REGISTRY, Counter
+
+CACHE_RELEASES = REGISTRY.register(
+    Counter(
+        "webassist_allocator_cache_releases_total",
+        "Releases of the allocator cache of a device, by device and reason.",
+        ["device", "reason"],
+    )
+)
+
+
+class MemoryPressurePolicy:
+    """
+    Releases the allocator cache of a device under memory pressure.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        read_memory: Callable[[], Tuple[int, int]],
+        release: Callable[[], None],
+        threshold: float = 0.9,
+        min_interval_s: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Parameters:
+        -----------------
+        device: str
+            Name of the device, for the metrics.
+        read_memory: Callable[[], Tuple[int, int]]
+            Returns the reserved & total memory of the device, in bytes.
+        release: Callable[[], None]
+            Releases the cached memory (e.g. `torch.cuda.empty_cache`).
+        threshold: float
+            Fraction of the device memory reserved above which the cache is released.
+        min_interval_s: float
+            Minimum time between two releases under pressure.
+        """
+        self.device = device
+        self.read_memory = read_memory
+        self._release = release
+        self.threshold = threshold
+        self.min_interval_s = min_interval_s
+        self.clock = clock
+
+        self._lock = Lock()
+        self._last_release = None
+        self.checks = 0
+        self.releases = 0
+
+    def __str__(self):
+        str_rep = f"Device: {self.device}\n"
+        str_rep += f"Threshold: {self.threshold}\n"
+        str_rep += f"Min Interval (s): {self.min_interval_s}"
+        return str_rep
+
+    def check(self) -> bool:
+        """
+        Releases the cache if the reserved memory is over the threshold. Returns whether it did.
+        """
+        with self._lock:
+            self.checks += 1
+            now = self.clock()
+            if (
+                self._last_release is not None
+                and now - self._last_release < self.min_interval_s
+            ):
+                return False
+
+            reserved, total = self.read_memory()
+            if not total or reserved < self.threshold * total:
+                return False
+
+            self._release_locked("pressure", now)
+            logging.info(
+                f"Released the allocator cache of {self.device} "
+                f"({reserved / 2**20:.0f} / {total / 2**20:.0f} MB reserved)."
+            )
+            return True
+
+    def release(self, reason: str = "manual"):
+        """
+        Releases the cache now (e.g. after running out of memory).
+        """
+        with self._lock:
+            self._release_locked(reason, self.clock())
+
+    def _release_locked(self, reason: str, now: float):
+        self._release()
+        self._last_release = now
+        self.releases += 1
+        CACHE_RELEASES.inc(device=self.device, reason=reason)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "device": self.device,
+                "threshold": self.threshold,
+                "checks": self.checks,
+                "releases": self.releases,
+            }
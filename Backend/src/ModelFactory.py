@@ -0,0 +1,179 @@
+"""
+Builds the models of the server config & collects their stats.
+
+torch, transformers & sentence-transformers are only imported when a model is built (by the
+`ModelLoader` threads of the server), not when this module is.
+"""
+
+import os
+
+from typing import Dict
+
+from Metrics import REGISTRY, Gauge
+from ModelLoader import StartupTimer
+from RuntimeConfig import RuntimeConfig
+
+MODEL_DTYPE = REGISTRY.register(
+    Gauge(
+        "webassist_model_dtype_info",
+        "Dtype the local models actually run in (always 1), by model.",
+        ["model", "dtype"],
+    )
+)
+
+
+def report_dtype(model: str, inference):
+    dtype = str(inference.effective_dtype).replace("torch.", "")
+    MODEL_DTYPE.set(1, model=model, dtype=dtype)
+
+
+def build_dmr(cfg, runtime_config: RuntimeConfig, timer: StartupTimer):
+    """
+    Builds the DMR of the config: the local model, or the client of a remote one.
+    """
+    with timer.phase("dmr_import"):
+        from DMR import DMR, HF_DMR
+
+    if cfg.dmr.remote.enabled:
+        remote = cfg.dmr.remote
+        dmr_model = HF_DMR(
+            api_url=remote.api_url,
+            auth_token=f"Bearer {os.environ.get(remote.auth_token_env, '')}",
+            sim_method=cfg.dmr.get("similarity", "cos_sim"),
+            chunk_size=remote.chunk_size,
+            timeout_s=remote.timeout_s,
+            connect_timeout_s=remote.connect_timeout_s,
+            max_connections=remote.max_connections,
+            max_concurrency=remote.max_concurrency,
+            max_retries=remote.max_retries,
+            backoff_s=remote.backoff_s,
+            failure_threshold=remote.failure_threshold,
+            reset_timeout_s=remote.reset_timeout_s,
+            uds=remote.uds,
+        )
+    else:
+        dmr_model = DMR(
+            name=runtime_config.dmr.model,
+            sim_method=cfg.dmr.get("similarity", "cos_sim"),
+            use_bf16=runtime_config.dmr.dtype == "bfloat16",
+            batch_size_per_device=runtime_config.dmr.batch_size_per_device,
+            max_seq_length=runtime_config.dmr.max_seq_length,
+            device=runtime_config.dmr.device,
+            memory_threshold=runtime_config.memory.release_threshold,
+            min_release_interval_s=runtime_config.memory.min_release_interval_s,
+        )
+        if cfg.dmr.batching.enabled:
+            dmr_model.enable_batching(
+                max_wait_ms=cfg.dmr.batching.max_wait_ms,
+                max_batch_size=cfg.dmr.batching.max_batch_size,
+                max_batch_sentences=cfg.dmr.batching.max_batch_sentences,
+            )
+        if cfg.dmr.cache.enabled:
+            dmr_model.enable_cache(
+                max_bytes=cfg.dmr.cache.max_mb * 1024 * 1024,
+                max_entries=cfg.dmr.cache.max_entries,
+            )
+        report_dtype("dmr", dmr_model.inference)
+    return dmr_model
+
+
+def build_action_agent(cfg, runtime_config: RuntimeConfig, timer: StartupTimer):
+    """
+    Builds the action agent of the config: the local model, or the client of a remote one.
+    """
+    with timer.phase("action_import"):
+        from ActionAgent import ActionAgent, RemoteActionAgent
+
+    if cfg.action.remote.enabled:
+        remote = cfg.action.remote
+        auth_token = None
+        if remote.auth_token_env:
+            auth_token = os.environ.get(remote.auth_token_env)
+        action_agent = RemoteActionAgent(
+            tokenizer=runtime_config.action.tokenizer,
+            model=runtime_config.action.model,
+            api_url=remote.api_url,
+            auth_token=f"Bearer {auth_token}" if auth_token else None,
+            max_out_len=runtime_config.action.max_out_len,
+            max_inp_len=runtime_config.action.max_inp_len,
+            num_candidates=runtime_config.candidates.k,
+            timeout_s=remote.timeout_s,
+            connect_timeout_s=remote.connect_timeout_s,
+            max_connections=remote.max_connections,
+            max_concurrency=remote.max_concurrency,
+            max_retries=remote.max_retries,
+            backoff_s=remote.backoff_s,
+            failure_threshold=remote.failure_threshold,
+            reset_timeout_s=remote.reset_timeout_s,
+            uds=remote.uds,
+        )
+    else:
+        action_agent = ActionAgent(
+            tokenizer=runtime_config.action.tokenizer,
+            model=runtime_config.action.model,
+            use_rope=cfg.action.use_rope,
+            use_flash_attention_2=cfg.action.use_flash_attention_2,
+            max_out_len=runtime_config.action.max_out_len,
+            batch_size_per_device=runtime_config.action.batch_size_per_device,
+            max_inp_len=runtime_config.action.max_inp_len,
+            num_candidates=runtime_config.candidates.k,
+            dtype=runtime_config.action.dtype,
+            device_map=runtime_config.action.device_map,
+            memory_threshold=runtime_config.memory.release_threshold,
+            min_release_interval_s=runtime_config.memory.min_release_interval_s,
+        )
+        if cfg.action.batching.enabled:
+            action_agent.enable_batching(
+                max_wait_ms=cfg.action.batching.max_wait_ms,
+                max_batch_size=cfg.action.batching.max_batch_size,
+                max_batch_tokens=cfg.action.batching.max_batch_tokens,
+            )
+        if cfg.action.prefix_cache.enabled:
+            action_agent.enable_prefix_cache(
+                max_bytes=cfg.action.prefix_cache.max_mb * 1024 * 1024,
+                max_sessions=cfg.action.prefix_cache.max_sessions,
+                min_prefix_tokens=cfg.action.prefix_cache.min_prefix_tokens,
+            )
+        if cfg.action.constrained_decoding.enabled:
+            action_agent.enable_constrained_decoding(
+                top_k=cfg.action.constrained_decoding.top_k,
+                max_str_len=cfg.action.constrained_decoding.max_str_len,
+            )
+        report_dtype("action", action_agent.inference)
+    return action_agent
+
+
+def get_dmr_stats(dmr_model, inference: Dict) -> Dict:
+    """
+    Stats of the DMR for `/v1/stats`, the ones of its inference context go into `inference`.
+    """
+    from DMR import HF_DMR
+
+    if isinstance(dmr_model, HF_DMR):
+        return {"dmr_remote": dmr_model.client.get_stats()}
+
+    stats = {}
+    inference["dmr"] = dmr_model.inference.get_stats()
+    if dmr_model.batcher is not None:
+        stats["dmr_batcher"] = dmr_model.batcher.get_stats()
+    if dmr_model.cache is not None:
+        stats["dmr_cache"] = dmr_model.cache.get_stats()
+    return stats
+
+
+def get_action_stats(action_agent, inference: Dict) -> Dict:
+    """
+    Same as `get_dmr_stats` for the action agent.
+    """
+    from ActionAgent import RemoteActionAgent
+
+    stats = {}
+    if isinstance(action_agent, RemoteActionAgent):
+        stats["action_remote"] = action_agent.client.get_stats()
+    else:
+        inference["action"] = action_agent.inference.get_stats()
+    if action_agent.batcher is not None:
+        stats["generation_batcher"] = action_agent.batcher.get_stats()
+    if action_agent.prefix_cache is not None:
+        stats["prefix_cache"] = action_agent.prefix_cache.get_stats()
+    return stats
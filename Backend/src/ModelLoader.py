@@ -0,0 +1,197 @@
+"""
+Deferred loading of the models & startup timings.
+
+Loading the DMR encoder and the action model takes minutes (imports of torch, transformers &
+sentence-transformers, then the weights), so the server can start serving before they are
+loaded: a `ModelLoader` loads its model in a background thread, either right away (`start`)
+or on the first request that needs it (`get` / `aget`). The loaders back the readiness
+endpoint, and `StartupTimer` reports how long each phase of the startup took.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from Metrics import REGISTRY, Gauge
+
+STARTUP_PHASES = REGISTRY.register(
+    Gauge(
+        "webassist_startup_phase_seconds",
+        "Duration of the phases of the server startup (config, imports, model loads, ...).",
+        ["phase"],
+    )
+)
+MODEL_READY = REGISTRY.register(
+    Gauge(
+        "webassist_model_ready",
+        "Whether a model is loaded (1) or not (0), by model.",
+        ["model"],
+    )
+)
+
+
+class ModelNotReadyError(Exception):
+    """
+    A model is still loading, or its loading failed.
+    """
+
+
+class StartupTimer:
+    """
+    Durations of the startup phases, from the creation of the timer (the server's import).
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self._lock = Lock()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - started)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = seconds
+        STARTUP_PHASES.set(seconds, phase=name)
+        logging.info(f"Startup phase `{name}` took {seconds:.2f}s.")
+
+    def mark(self, name: str):
+        """
+        Records the time since the start, e.g. when the server is ready.
+        """
+        self.record(name, self.clock() - self.started)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.phases)
+
+
+class ModelLoader:
+    """
+    Loads a model once, in a background thread. A failed load is retried by the next `start`.
+
+    Parameters:
+    -----------------
+    name: str
+        Name of the model, for the logs & metrics.
+    load_fn: Callable[[], Any]
+        Imports & builds the model.
+    timer: StartupTimer
+        Records the duration of the load as the `<name>` phase.
+    clock: Callable[[], float]
+        Clock of the load durations.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        load_fn: Callable[[], Any],
+        timer: Optional[StartupTimer] = None,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.name = name
+        self.load_fn = load_fn
+        self.timer = timer
+        self.clock = clock
+
+        self._lock = Lock()
+        self._future = None
+        self.state = "pending"
+        self.load_s = None
+        self.error = None
+        MODEL_READY.set(0, model=name)
+
+    def __str__(self):
+        str_rep = f"Name: {self.name}\n"
+        str_rep += f"State: {self.state}"
+        return str_rep
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def failed(self) -> bool:
+        return self.state == "failed"
+
+    def start(self) -> Future:
+        """
+        Starts loading the model if it is not loaded or loading. Returns the future of the
+        model.
+        """
+        with self._lock:
+            if self.state in ("pending", "failed"):
+                self.state = "loading"
+                self.error = None
+                self._future = Future()
+                # The load cannot be cancelled by a waiting request timing out
+                self._future.set_running_or_notify_cancel()
+                Thread(
+                    target=self._load,
+                    args=(self._future,),
+                    name=f"load-{self.name}",
+                    daemon=True,
+                ).start()
+            return self._future
+
+    def _load(self, future: Future):
+        logging.info(f"Loading the `{self.name}` model ...")
+        started = self.clock()
+        try:
+            model = self.load_fn()
+        except BaseException as e:
+            logging.exception(f"Failed to load the `{self.name}` model.")
+            with self._lock:
+                self.state = "failed"
+                self.error = repr(e)
+            future.set_exception(e)
+            return
+
+        load_s = self.clock() - started
+        with self._lock:
+            self.state = "ready"
+            self.load_s = load_s
+        MODEL_READY.set(1, model=self.name)
+        if self.timer is not None:
+            self.timer.record(self.name, load_s)
+        future.set_result(model)
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        Returns the model, loading it first if needed. Raises `ModelNotReadyError` if it is not
+        loaded within `timeout` seconds or its loading failed.
+        """
+        future = self.start()
+        try:
+            return future.result(timeout)
+        except TimeoutError as e:
+            raise ModelNotReadyError(f"The `{self.name}` model is still loading.") from e
+        except Exception as e:
+            raise ModelNotReadyError(f"The `{self.name}` model failed to load: {e!r}") from e
+
+    async def aget(self, timeout: Optional[float] = None) -> Any:
+        """
+        Same as `get`, awaited on the event loop.
+        """
+        future = asyncio.wrap_future(self.start())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError as e:
+            raise ModelNotReadyError(f"The `{self.name}` model is still loading.") from e
+        except Exception as e:
+            raise ModelNotReadyError(f"The `{self.name}` model failed to load: {e!r}") from e
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "load_s": self.load_s, "error": self.error}
@@ -0,0 +1,103 @@
+"""
+Last page (HTML & bboxes) the server holds for a session, so the client can send a delta
+against it instead of re-uploading the whole page every turn.
+"""
+
+import hashlib
+import lxml.html
+
+from typing import Dict, Optional
+
+from BBoxTable import BBoxTable
+from schema import PageDelta
+
+
+class PageDeltaError(Exception):
+    """
+    Raised when a delta cannot be applied; the client should resend the full page.
+    """
+
+
+def hash_page(html: str) -> str:
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+class PageSnapshot:
+    """
+    The reconstructed page of a session and its content hash, which the client
+    uses as the `base_hash` of its next delta.
+    """
+
+    def __init__(self, html: str, bboxes: Optional[BBoxTable]):
+        self.html = html
+        self.bboxes = BBoxTable.validate(bboxes) if bboxes is not None else None
+        self.page_hash = hash_page(html)
+
+    def apply_delta(self, delta: PageDelta, uid_key: str) -> "PageSnapshot":
+        """
+        Builds the new page by replacing the changed subtrees and bboxes.
+
+        Parameters:
+        -------------
+        delta: PageDelta
+            The changes against this snapshot.
+        uid_key: str
+            The UID each element of the page is tagged with.
+
+        Returns:
+        ---------
+        The new snapshot (this one is not modified).
+
+        Raises:
+        --------
+        PageDeltaError if the delta is not against this snapshot or refers to unknown elements.
+        """
+        if delta.base_hash != self.page_hash:
+            raise PageDeltaError(
+                f"Delta is against page `{delta.base_hash}` but the server holds "
+                f"`{self.page_hash}`. Please resend the full page."
+            )
+
+        html = self.html
+        if delta.subtrees:
+            html = replace_subtrees(self.html, delta.subtrees, uid_key)
+
+        bboxes = self.bboxes if self.bboxes is not None else BBoxTable.from_dict({})
+        if delta.bboxes:
+            bboxes = bboxes.updated(delta.bboxes)
+
+        return PageSnapshot(html=html, bboxes=bboxes)
+
+
+def replace_subtrees(html: str, subtrees: Dict[str, str], uid_key: str) -> str:
+    """
+    Replaces the elements tagged `uid` with the new outer HTML of their subtree.
+    The subtrees must be disjoint (only send the outermost changed element).
+    """
+    root = lxml.html.document_fromstring(html)
+    index = {}
+    for elem in root.xpath(f"//*[@{uid_key}]"):
+        index.setdefault(elem.attrib[uid_key], elem)
+
+    for uid, outer_html in subtrees.items():
+        elem = index.get(uid)
+        if elem is None:
+            raise PageDeltaError(
+                f"Element `{uid}` of the delta is not in the page held by the server. "
+                "Please resend the full page."
+            )
+
+        parent = elem.getparent()
+        if parent is None:
+            # The whole document changed
+            root = lxml.html.document_fromstring(outer_html)
+            continue
+
+        try:
+            new_elem = lxml.html.fragment_fromstring(outer_html)
+        except Exception as e:
+            raise PageDeltaError(f"Could not parse subtree of element `{uid}`: {e}")
+        new_elem.tail = elem.tail
+        parent.replace(elem, new_elem)
+
+    return lxml.html.tostring(root, encoding="unicode")
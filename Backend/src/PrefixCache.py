@@ -0,0 +1,163 @@
+"""
+Key/value caches of the last prompt of each session, to reuse the prefill of the shared prefix.
+
+Consecutive prompts of a session share most of their tokens (system prompt, utterances,
+previous turns) until the first change. The KV cache left by a generation is kept with its
+token IDs; the next prompt of the session takes it back, crops it to the longest common token
+prefix and only prefills the rest.
+
+The caches are opaque here (the model's KV cache object), only their size is needed for the
+memory budget. A cache is handed out to one generation at a time: `take` removes it from the
+store and `put` stores the cache left by the generation.
+"""
+
+import logging
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+
+def common_prefix_length(a: np.ndarray, b: np.ndarray) -> int:
+    """
+    Number of leading tokens `a` and `b` have in common.
+    """
+    n = min(len(a), len(b))
+    mismatches = np.flatnonzero(a[:n] != b[:n])
+    return int(mismatches[0]) if len(mismatches) else n
+
+
+class PrefixCache:
+    """
+    Per-session KV caches bounded by memory and number of sessions (LRU eviction).
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_sessions: Optional[int] = None,
+        min_prefix_tokens: int = 16,
+    ):
+        """
+        Parameters:
+        -----------------
+        max_bytes: int
+            Memory cap of the cached key/values (on the device of the model).
+        max_sessions: int
+            Maximum number of sessions with a cache. `None` means only the memory cap applies.
+        min_prefix_tokens: int
+            Shorter common prefixes are not worth reusing, the cache is dropped instead.
+        """
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.min_prefix_tokens = min_prefix_tokens
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+        logging.info(f"Finished Initializing Prefix Cache ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Max Bytes: {self.max_bytes}\n"
+        str_rep += f"Max Sessions: {self.max_sessions}\n"
+        str_rep += f"Min Prefix Tokens: {self.min_prefix_tokens}"
+        return str_rep
+
+    def __len__(self):
+        return len(self._entries)
+
+    def take(self, session_id: str, token_ids: Sequence[int]) -> Tuple[Any, int]:
+        """
+        Removes the cache of the session and returns it with the number of tokens it can be
+        reused for (to crop it to), or `(None, 0)` when there is nothing to reuse.
+        At least the last token of the prompt is left to prefill, so that the model returns
+        the logits of the first generated token.
+        """
+        token_ids = np.asarray(token_ids)
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry["nbytes"]
+
+            prefix_length = 0
+            if entry is not None:
+                prefix_length = min(
+                    common_prefix_length(entry["token_ids"], token_ids),
+                    len(token_ids) - 1,
+                )
+
+            if prefix_length < self.min_prefix_tokens:
+                self.misses += 1
+                self.prefilled_tokens += len(token_ids)
+                return None, 0
+
+            self.hits += 1
+            self.reused_tokens += prefix_length
+            self.prefilled_tokens += len(token_ids) - prefix_length
+            return entry["cache"], prefix_length
+
+    def put(self, session_id: str, token_ids: Sequence[int], cache: Any, nbytes: int):
+        """
+        Stores the cache of the session, `token_ids` being the tokens it holds the keys &
+        values of.
+        """
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self.nbytes -= old["nbytes"]
+
+            self._entries[session_id] = {
+                "token_ids": np.asarray(token_ids).copy(),
+                "cache": cache,
+                "nbytes": nbytes,
+            }
+            self.nbytes += nbytes
+            self._evict()
+
+    def discard(self, session_id: str):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry["nbytes"]
+
+    def _evict(self):
+        while (self.nbytes > self.max_bytes) or (
+            self.max_sessions is not None and len(self._entries) > self.max_sessions
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry["nbytes"]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            prompt_tokens = self.reused_tokens + self.prefilled_tokens
+            return {
+                "sessions": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "reused_tokens": self.reused_tokens,
+                "prefilled_tokens": self.prefilled_tokens,
+                "reused_token_rate": (
+                    self.reused_tokens / prompt_tokens if prompt_tokens else None
+                ),
+            }
@@ -0,0 +1,98 @@
+"""
+Per-stage timings of the inference path (HTML parse, records, encode, prompt, generation, ...).
+
+Stages are marked with `timed(stage)`, as a context manager or a decorator. Each stage is a
+tracing span (see `Tracing`). Timings are also recorded while a `collect_timings()` block is
+active (e.g. in the replay benchmark). The collector is process-wide: stages run in worker
+threads and in the batcher threads are recorded too, so requests should be run one at a time
+while collecting.
+"""
+
+import time
+
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from Tracing import STAGE_DURATION, set_attributes, span
+
+_lock = Lock()
+_collector: Optional[Dict[str, List[float]]] = None
+
+
+@contextmanager
+def timed(stage: str):
+    with span(stage):
+        if _collector is None:
+            yield
+            return
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            _record(stage, time.perf_counter() - started)
+
+
+def _record(stage: str, seconds: float):
+    with _lock:
+        if _collector is not None:
+            _collector.setdefault(stage, []).append(seconds)
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects the timings of the stages run inside the block into `{stage -> [seconds, ...]}`.
+    Stages nest: e.g. `build_records` includes the `html_parse` of its turn.
+    """
+    global _collector
+    timings = {}
+    with _lock:
+        if _collector is not None:
+            raise RuntimeError("Timings are already being collected.")
+        _collector = timings
+    try:
+        yield timings
+    finally:
+        with _lock:
+            _collector = None
+
+
+class TimedTokenizer:
+    """
+    Tokenizer proxy accumulating the number and time of the `tokenize` and `__call__` calls.
+    Everything else is forwarded to the tokenizer.
+
+    The prompt builder tokenizes each candidate, turn & truncation attempt: `report` records
+    the calls once, as a `tokenization` timing and attributes of the current span, instead of
+    a span per call.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.tokenizer, name)
+
+    def __call__(self, *args, **kwargs):
+        return self._timed(self.tokenizer, *args, **kwargs)
+
+    def tokenize(self, *args, **kwargs):
+        return self._timed(self.tokenizer.tokenize, *args, **kwargs)
+
+    def _timed(self, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.calls += 1
+            self.seconds += time.perf_counter() - started
+
+    def report(self):
+        set_attributes(tokenizer_calls=self.calls, tokenization_s=self.seconds)
+        if self.calls:
+            STAGE_DURATION.observe(self.seconds, stage="tokenization")
+            _record("tokenization", self.seconds)
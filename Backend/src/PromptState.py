@@ -0,0 +1,145 @@
+"""
+Incremental per-session state of the prompts built from a replay.
+
+The query of the DMR and the prompt of the action model both need the instructor utterances
+before the previous-turns window and the formatted previous turns. Rebuilding them filters and
+re-formats the whole replay on every turn. A replay only grows by appending its last turn (or
+popping it), so `PromptState` is updated on each append / pop and keeps:
+    - the instructor chat turns, in order, to look up the ones before a window in O(log n);
+    - the formatted turns, by formatter, for the last `keep_last_n` turns;
+    - the last utterance contexts built, reused while their turns do not change.
+"""
+
+from bisect import bisect_left
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, List
+
+import weblinx as wl
+
+
+class PromptState:
+    """
+    Prompt state of a replay, updated by the replay with `on_add` & `on_remove`.
+    """
+
+    def __init__(self, keep_last_n: int = 16, speaker: str = "instructor"):
+        """
+        Parameters:
+        -----------------
+        keep_last_n: int
+            Formatted turns kept, counting back from the last turn. Must be at least the number
+            of previous turns in the prompts.
+        speaker: str
+            Speaker of the chat turns used as utterance context.
+        """
+        self.keep_last_n = keep_last_n
+        self.speaker = speaker
+
+        self._chat_turns = []
+        self._chat_indices = []
+        # Bumped when the chat turns change, see `chat_key`
+        self._chat_version = 0
+        self._formatted = {}
+        self._contexts = {}
+
+    def __str__(self):
+        str_rep = f"Keep Last N: {self.keep_last_n}\n"
+        str_rep += f"Chat Turns: {len(self._chat_turns)}\n"
+        str_rep += f"Formatted Turns: {len(self._formatted)}"
+        return str_rep
+
+    @classmethod
+    def from_turns(cls, turns: List[wl.Turn], **kwargs) -> "PromptState":
+        state = cls(**kwargs)
+        for turn in turns:
+            state.on_add(turn)
+        return state
+
+    def on_add(self, turn: wl.Turn):
+        """
+        Called after the turn was appended to the replay.
+        """
+        if turn.get("speaker") == self.speaker:
+            self._chat_turns.append(turn)
+            self._chat_indices.append(turn.index)
+            self._chat_version += 1
+
+        # Turns before the window are not formatted again
+        self._formatted.pop(turn.index - self.keep_last_n, None)
+
+    def on_remove(self, turn: wl.Turn):
+        """
+        Called after the last turn was popped from the replay.
+        """
+        if self._chat_turns and self._chat_turns[-1] is turn:
+            self._chat_turns.pop()
+            self._chat_indices.pop()
+            self._chat_version += 1
+        self._formatted.pop(turn.index, None)
+
+    def find_turns_with_instructor_chat(
+        self, turn: wl.Turn, num_prev_turns: int = 5
+    ) -> List[wl.Turn]:
+        """
+        Same as `weblinx.processing.prompt.find_turns_with_instructor_chat`: the chat turns of
+        the speaker before the `num_prev_turns` turns preceding `turn`.
+        """
+        start_index = max(0, turn.index - num_prev_turns)
+        return self._chat_turns[: bisect_left(self._chat_indices, start_index)]
+
+    def chat_key(self, chat_turns: List[wl.Turn]) -> tuple:
+        """
+        Key of chat turns returned by `find_turns_with_instructor_chat`, for `get_context`.
+        They are a prefix of the chat turns, so the version and length identify them.
+        """
+        return (self._chat_version, len(chat_turns))
+
+    def format_turn(self, turn: wl.Turn, format_intent: Callable, return_as=dict):
+        """
+        Formats the turn with `format_intent`, once per turn. Dicts are returned as copies
+        since the truncation edits them in place.
+        """
+        entries = self._formatted.setdefault(turn.index, {})
+        key = (format_intent, return_as)
+        cached = entries.get(key)
+        # The same index can be a different turn once the last turn was replaced
+        if cached is None or cached[0] is not turn:
+            cached = entries[key] = (turn, format_intent(turn, return_as=return_as))
+
+        formatted = cached[1]
+        return dict(formatted) if isinstance(formatted, dict) else formatted
+
+    def cached_format(self, format_intent: Callable) -> Callable:
+        """
+        Returns `format_intent` memoized with `format_turn`, to pass to the weblinx helpers.
+        """
+        return partial(self.format_turn, format_intent=format_intent)
+
+    def get_context(self, name: str, key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        Returns the last context called `name` if it was built with the same `key`, otherwise
+        builds it (e.g. the utterance context, which only changes when a chat turn leaves the
+        previous-turns window).
+        """
+        cached = self._contexts.get(name)
+        if cached is None or cached[0] != key:
+            cached = self._contexts[name] = (key, build())
+        return cached[1]
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "chat_turns": len(self._chat_turns),
+            "formatted_turns": len(self._formatted),
+            "contexts": len(self._contexts),
+        }
+
+
+def get_prompt_state(replay) -> PromptState:
+    """
+    Returns the prompt state of the replay, or a state built from its turns for replays that
+    do not keep one (e.g. a `weblinx.Replay`).
+    """
+    state = getattr(replay, "prompt_state", None)
+    if state is None:
+        state = PromptState.from_turns(list(replay))
+    return state
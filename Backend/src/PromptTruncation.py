@@ -0,0 +1,80 @@
+"""
+Truncation of the model input to `max_inp_len` tokens.
+
+The weblinx prompt builder truncates each section of the prompt (DOM tree, utterances, previous
+turns, candidates) to its own token budget. `scale_section_budgets` scales these budgets down
+when `max_inp_len` is smaller than their sum. The tokens still over the cap (e.g. the chat
+template markers of the previous turns) are cut by `truncate_prompt_tokens` from the middle of
+the prompt: the template header & the system prompt at its start, and the last turns & the final
+instructions at its end are kept.
+"""
+
+from typing import Dict, List
+
+# Defaults of `build_prompt_records_for_llama_truncated`
+DEFAULT_SECTION_BUDGETS = {
+    "max_html_tokens": 700,
+    "max_utterance_tokens": 40 * 5,
+    "max_prev_turns_tokens": 50 * 5,
+    "max_candidates_tokens": 65 * 10,
+}
+
+# Placeholder of the first user message, to find where the system prompt block ends
+_USER_MARKER = "<|first-user-message|>"
+
+
+def scale_section_budgets(
+    max_inp_len: int,
+    num_fixed_tokens: int,
+    budgets: Dict[str, int] = DEFAULT_SECTION_BUDGETS,
+) -> Dict[str, int]:
+    """
+    Token budgets of the prompt sections that fit in `max_inp_len` tokens.
+
+    Parameters:
+    -----------------
+    max_inp_len: int
+        Maximum number of tokens of the model input.
+    num_fixed_tokens: int
+        Tokens of the prompt with empty sections: chat template, instructions & final message.
+    budgets: Dict[str, int]
+        Budgets of the sections, kept when they fit & scaled down proportionally otherwise.
+    """
+    available = max_inp_len - num_fixed_tokens
+    total = sum(budgets.values())
+    if available >= total:
+        return dict(budgets)
+
+    scale = max(available, 0) / total
+    return {name: max(int(budget * scale), 1) for name, budget in budgets.items()}
+
+
+def count_head_tokens(tokenizer, system_prompt: str) -> int:
+    """
+    Number of tokens of the chat template up to the first user message: the BOS token, the
+    template header (e.g. `[INST] <<SYS>>`), the system prompt & the end of its block.
+    """
+    model_input = tokenizer.apply_chat_template(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": _USER_MARKER},
+        ],
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+    return len(tokenizer.tokenize(model_input[: model_input.index(_USER_MARKER)]))
+
+
+def truncate_prompt_tokens(
+    tokens: List[str], max_len: int, num_head_tokens: int
+) -> List[str]:
+    """
+    Cuts `tokens` to `max_len` tokens from the middle: the first `num_head_tokens` tokens are
+    kept (up to `max_len`), and the rest of the budget goes to the last tokens.
+    """
+    if len(tokens) <= max_len:
+        return tokens
+
+    num_head_tokens = min(num_head_tokens, max_len)
+    num_tail_tokens = max_len - num_head_tokens
+    return tokens[:num_head_tokens] + tokens[len(tokens) - num_tail_tokens :]
@@ -0,0 +1,41 @@
+"""
+Vectorized ranking of the DMR scores.
+
+Pages have hundreds to thousands of elements but the prompt only shows the best few, so the
+top `k` scores are selected with a partial sort instead of sorting (and ranking) all of them.
+"""
+
+import numpy as np
+
+from typing import Optional
+
+
+def select_top_k(scores: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    """
+    Indices of the `k` highest scores, by decreasing score (ties keep the order of the
+    records). Only the top `k` are sorted, after a partial selection of them.
+    """
+    n = len(scores)
+    if k is None or k >= n:
+        return np.argsort(-scores, kind="stable")
+
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    kth = scores[np.argpartition(-scores, k - 1)[:k]].min()
+    # The partition leaves out some of the records tied with the k-th score, take them all
+    # to break the ties like a full sort would
+    top = np.flatnonzero(scores >= kth)
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[:k]
+
+
+def rank_scores(scores: np.ndarray, starts_at=1) -> np.ndarray:
+    """
+    Rank of each score, the highest score being ranked `starts_at`.
+    """
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.argsort(-scores, kind="stable")] = np.arange(
+        starts_at, starts_at + len(scores)
+    )
+    return ranks
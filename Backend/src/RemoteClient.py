@@ -0,0 +1,501 @@
+"""
+Pooled async HTTP client of the remote model backends.
+
+A `RemoteClient` keeps its connections alive across requests (one `httpx.AsyncClient` with a
+bounded pool) and runs them on its own event loop thread, so it can be called both from the
+worker threads of the stages (`post`, blocking the worker only) and from the server's event
+loop (`apost`). Each call:
+    - waits for one of the `max_concurrency` slots, so a burst of turns cannot open more
+      connections than the backend handles;
+    - has connect & read timeouts;
+    - is retried on connection errors, timeouts, 429 & 5xx responses, with an exponential
+      backoff with full jitter (so that retries of concurrent calls do not line up);
+    - goes through a `CircuitBreaker`: after `failure_threshold` failed calls in a row, the
+      calls fail immediately with `CircuitOpenError` for `reset_timeout_s`, then a single trial
+      call decides whether the backend is back. Callers use it to switch to their fallback
+      without waiting on a backend that is down.
+"""
+
+import asyncio
+import httpx
+import json
+import logging
+import random
+import time
+
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+
+from Metrics import REGISTRY, Counter, Histogram
+
+REMOTE_REQUESTS = REGISTRY.register(
+    Counter(
+        "webassist_remote_requests_total",
+        "Calls to the remote backends, by client and outcome (ok, retry, error, circuit_open).",
+        ["client", "outcome"],
+    )
+)
+REMOTE_DURATION = REGISTRY.register(
+    Histogram(
+        "webassist_remote_request_duration_seconds",
+        "Duration of the calls to the remote backends (with their retries), by client.",
+        ["client"],
+    )
+)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RemoteError(Exception):
+    """
+    A call to a remote backend failed (after its retries).
+    """
+
+
+class CircuitOpenError(RemoteError):
+    """
+    The backend failed too many times in a row, calls are not sent for now.
+    """
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open (after `failure_threshold` failures in a row): calls are
+    refused for `reset_timeout_s`. Half-open: a single trial call goes through, its success
+    closes the circuit and its failure opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout_s: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.clock = clock
+
+        self._lock = Lock()
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if self.clock() - self._opened_at < self.reset_timeout_s:
+                    return False
+                self.state = "half_open"
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def abort_trial(self):
+        """
+        The call was cancelled before its outcome was known.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened += 1
+                self.state = "open"
+                self._opened_at = self.clock()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+            }
+
+
+class RemoteClient:
+    """
+    Pooled async JSON client of one backend.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        headers: Optional[Dict[str, str]] = None,
+        timeout_s: float = 10.0,
+        connect_timeout_s: float = 2.0,
+        max_connections: int = 16,
+        max_concurrency: int = 8,
+        max_retries: int = 2,
+        backoff_s: float = 0.2,
+        max_backoff_s: float = 2.0,
+        failure_threshold: int = 5,
+        reset_timeout_s: float = 30.0,
+        uds: Optional[str] = None,
+    ):
+        """
+        Parameters:
+        -----------------
+        name: str
+            Name of the client, for the logs & metrics.
+        base_url: str
+            URL the paths of the calls are relative to.
+        headers: Dict[str, str]
+            Headers of every call (e.g. `Authorization`).
+        timeout_s: float
+            Read / write timeout of an attempt.
+        connect_timeout_s: float
+            Timeout to open a connection.
+        max_connections: int
+            Size of the connection pool (all of them kept alive).
+        max_concurrency: int
+            Maximum number of calls in flight, the other calls wait for a slot.
+        max_retries: int
+            Retries of a call after a connection error, a timeout, a 429 or a 5xx response.
+        backoff_s: float
+            Base of the exponential backoff between attempts (before jitter).
+        max_backoff_s: float
+            Longest wait between two attempts.
+        failure_threshold: int
+            Failed calls in a row that open the circuit.
+        reset_timeout_s: float
+            How long the circuit stays open before a trial call.
+        uds: str
+            Unix domain socket to connect to instead of the host of `base_url`, e.g. the
+            inference process of the multi-process mode.
+        """
+        self.name = name
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout_s)
+
+        self.uds = uds
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(timeout_s, connect=connect_timeout_s),
+            # The pool limits are set on the transport when there is one
+            limits=limits,
+            transport=(
+                httpx.AsyncHTTPTransport(uds=uds, limits=limits) if uds else None
+            ),
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(
+            target=self._loop.run_forever, name=f"{name}-client", daemon=True
+        )
+        self._thread.start()
+
+        self._stats_lock = Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+
+        logging.info(f"Finished Initializing Remote Client ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Name: {self.name}\n"
+        str_rep += f"Base URL: {self.base_url}\n"
+        str_rep += f"Unix Socket: {self.uds}\n"
+        str_rep += f"Max Concurrency: {self.max_concurrency}\n"
+        str_rep += f"Max Retries: {self.max_retries}\n"
+        str_rep += f"Failure Threshold: {self.breaker.failure_threshold}"
+        return str_rep
+
+    ####### Calls ###########
+
+    def post(self, path: str, payload: Any) -> Any:
+        """
+        Posts the JSON payload and returns the JSON response, blocking until it is done.
+        Must not be called from the client's own loop.
+        """
+        return self.run(self._post(path, payload))
+
+    async def apost(self, path: str, payload: Any) -> Any:
+        """
+        Same as `post`, awaited from another event loop.
+        """
+        return await self.arun(self._post(path, payload))
+
+    def post_many(self, path: str, payloads: List[Any]) -> List[Any]:
+        """
+        Posts the payloads in parallel (within the concurrency limit), returns the responses in
+        the same order. Fails if any of the calls fails.
+        """
+        return self.run(self._post_many(path, payloads))
+
+    async def apost_many(self, path: str, payloads: List[Any]) -> List[Any]:
+        return await self.arun(self._post_many(path, payloads))
+
+    def run(self, coro) -> Any:
+        """
+        Runs a coroutine on the client's loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def arun(self, coro) -> Any:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self._loop)
+        )
+
+    async def _post_many(self, path: str, payloads: List[Any]) -> List[Any]:
+        return await asyncio.gather(*(self._post(path, p) for p in payloads))
+
+    async def _post(self, path: str, payload: Any) -> Any:
+        async def send():
+            response = await self._client.post(path, json=payload)
+            response.raise_for_status()
+            return response.json()
+
+        return await self.call(send)
+
+    async def call(self, send: Callable[[], Any]) -> Any:
+        """
+        Runs `send` (a coroutine function doing one attempt with `self.http`) with the
+        concurrency limit, the retries & the circuit breaker. To be run on the client's loop.
+        """
+        if not self.breaker.allow():
+            REMOTE_REQUESTS.inc(client=self.name, outcome="circuit_open")
+            raise CircuitOpenError(f"The circuit of `{self.name}` is open.")
+
+        started = time.perf_counter()
+        async with self._slots:
+            self._count(in_flight=1, calls=1)
+            try:
+                result = await self._send_with_retries(send)
+            except RemoteError:
+                self._count(errors=1)
+                REMOTE_REQUESTS.inc(client=self.name, outcome="error")
+                raise
+            except BaseException:
+                # Cancelled, e.g. with the other chunks of a failed `post_many`
+                self.breaker.abort_trial()
+                raise
+            finally:
+                self._count(in_flight=-1)
+                REMOTE_DURATION.observe(time.perf_counter() - started, client=self.name)
+
+        REMOTE_REQUESTS.inc(client=self.name, outcome="ok")
+        return result
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        return self._client
+
+    async def _send_with_retries(self, send: Callable[[], Any]) -> Any:
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await send()
+                self.breaker.record_success()
+                return result
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if status not in RETRY_STATUS_CODES:
+                    # The backend is up, the call itself is wrong
+                    self.breaker.record_success()
+                    raise RemoteError(f"`{self.name}` answered {status}.") from e
+                error = e
+            except httpx.TransportError as e:
+                # Connection errors & timeouts
+                error = e
+            except ValueError as e:
+                # Not the expected JSON
+                self.breaker.record_failure()
+                raise RemoteError(f"`{self.name}` sent an invalid response.") from e
+
+            if attempt == self.max_retries:
+                break
+            self._count(retries=1)
+            REMOTE_REQUESTS.inc(client=self.name, outcome="retry")
+            await asyncio.sleep(self.get_backoff(attempt))
+
+        self.breaker.record_failure()
+        raise RemoteError(
+            f"`{self.name}` failed after {self.max_retries + 1} attempts: {error!r}"
+        ) from error
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+        Full jitter: a uniform wait up to the exponential backoff of the attempt.
+        """
+        return random.uniform(0, min(self.max_backoff_s, self.backoff_s * 2**attempt))
+
+    ####### Stats ###########
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = {
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "retries": self.retries,
+                "errors": self.errors,
+            }
+        stats["circuit"] = self.breaker.get_stats()
+        return stats
+
+    def close(self):
+        self.run(self._client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class SentenceSimilarityClient:
+    """
+    Client of a sentence-similarity endpoint (HuggingFace Inference API format): the scores of
+    the sentences against a source sentence. Long lists of sentences are split into chunks
+    sent in parallel.
+    """
+
+    def __init__(self, client: RemoteClient, path: str = "", chunk_size: int = 256):
+        self.client = client
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def get_scores(self, source_sentence: str, sentences: List[str]) -> List[float]:
+        """
+        Score of each sentence, in order. Raises a `RemoteError` if any chunk fails.
+        """
+        if not sentences:
+            return []
+
+        chunks = [
+            sentences[i : i + self.chunk_size]
+            for i in range(0, len(sentences), self.chunk_size)
+        ]
+        payloads = [
+            {"inputs": {"source_sentence": source_sentence, "sentences": chunk}}
+            for chunk in chunks
+        ]
+        responses = self.client.post_many(self.path, payloads)
+
+        scores = []
+        for chunk, response in zip(chunks, responses):
+            # A single sentence can be scored as a bare float
+            chunk_scores = response if isinstance(response, list) else [response]
+            if len(chunk_scores) != len(chunk):
+                raise RemoteError(
+                    f"Expected {len(chunk)} scores from `{self.client.name}`, "
+                    f"got {len(chunk_scores)}."
+                )
+            scores.extend(float(s) for s in chunk_scores)
+        return scores
+
+
+class TextGenerationClient:
+    """
+    Client of a text-generation server (text-generation-inference format): `POST /generate`
+    returns the generated text of a prompt, `POST /generate_stream` streams its tokens as
+    server-sent events. The server batches the concurrent prompts itself (continuous
+    batching), so the prompts of a batch are sent as parallel calls over the pool.
+    """
+
+    def __init__(
+        self,
+        client: RemoteClient,
+        path: str = "/generate",
+        stream_path: str = "/generate_stream",
+    ):
+        self.client = client
+        self.path = path
+        self.stream_path = stream_path
+
+    def generate(self, inputs: List[str], parameters: Dict[str, Any]) -> List[str]:
+        """
+        Generated text of each prompt, in order. Raises a `RemoteError` if any call fails.
+        """
+        payloads = [{"inputs": i, "parameters": parameters} for i in inputs]
+        responses = self.client.post_many(self.path, payloads)
+        return [parse_generated_text(r) for r in responses]
+
+    def generate_stream(
+        self,
+        inputs: str,
+        parameters: Dict[str, Any],
+        on_text: Callable[[str], bool],
+    ) -> str:
+        """
+        Streams the generation of a prompt: `on_text` is called (from the client's thread) with
+        the text generated so far after each token, and the generation is cancelled as soon as
+        it returns `True`. Returns the generated text.
+
+        A call failing midway is retried from the start: with greedy decoding the new
+        generation repeats the text already passed to `on_text`.
+        """
+        payload = {"inputs": inputs, "parameters": parameters}
+
+        async def send():
+            text = ""
+            async with self.client.http.stream(
+                "POST", self.stream_path, json=payload
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    event = parse_sse_data(line)
+                    if event is None:
+                        continue
+                    if "error" in event:
+                        raise ValueError(event["error"])
+                    token = event.get("token") or {}
+                    if token.get("special"):
+                        continue
+                    text += token.get("text", "")
+                    # Leaving the block closes the connection, which cancels the generation
+                    if on_text(text):
+                        break
+            return text
+
+        return self.client.run(self.client.call(send))
+
+
+def parse_generated_text(response: Any) -> str:
+    """
+    Text of a `/generate` response, `{"generated_text": ...}` or the list of it returned by the
+    HuggingFace Inference API.
+    """
+    if isinstance(response, list) and len(response) == 1:
+        response = response[0]
+    if not isinstance(response, dict) or "generated_text" not in response:
+        raise RemoteError(f"Unexpected generation response: {response!r:.200}")
+    return response["generated_text"]
+
+
+def parse_sse_data(line: str) -> Optional[Dict[str, Any]]:
+    """
+    JSON payload of a `data:` line of a server-sent events stream, `None` for the other lines.
+    """
+    if not line.startswith("data:"):
+        return None
+    data = line[len("data:") :].strip()
+    if not data or data == "[DONE]":
+        return None
+    return json.loads(data)
@@ -0,0 +1,213 @@
+"""
+Typed runtime configuration of the models, validated at startup.
+
+`config.yaml` is read by hydra as untyped keys: a typo or a wrong type only shows up (if at
+all) when the value is used. The settings that trade latency for throughput (token caps,
+candidate count, batch sizes, dtype & device placement) are parsed here into pydantic models
+once, so the server refuses to start with an invalid configuration, and are exported as the
+`webassist_runtime_config` gauge of `/metrics`.
+"""
+
+import json
+import os
+
+from typing import Any, Dict, List, Literal, Optional
+
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    NonNegativeFloat,
+    PositiveFloat,
+    PositiveInt,
+    model_validator,
+)
+
+from Metrics import REGISTRY, Gauge
+
+Dtype = Literal["bfloat16", "float16", "float32"]
+
+# Hydra overrides of the server processes (e.g. the workers of `serve.py`, the benchmarks)
+OVERRIDES_ENV = "WEBASSIST_CONFIG_OVERRIDES"
+
+RUNTIME_CONFIG = REGISTRY.register(
+    Gauge(
+        "webassist_runtime_config",
+        "Numeric runtime settings of the models, by model and setting.",
+        ["model", "setting"],
+    )
+)
+RUNTIME_CONFIG_INFO = REGISTRY.register(
+    Gauge(
+        "webassist_runtime_config_info",
+        "Model names, configured dtype & device placement (always 1), see "
+        "`webassist_model_dtype_info` for the dtype in effect.",
+        ["model", "name", "dtype", "device"],
+    )
+)
+
+
+class StrictModel(BaseModel):
+    model_config = ConfigDict(extra="forbid", protected_namespaces=())
+
+
+class DMRRuntimeConfig(StrictModel):
+    model: str
+    max_seq_length: PositiveInt
+    batch_size_per_device: PositiveInt
+    dtype: Literal["bfloat16", "float32"] = "bfloat16"
+    device: Optional[str] = None  # `None` lets sentence-transformers pick
+    max_batch_size: Optional[PositiveInt] = None  # cross-session batching, if enabled
+    max_batch_sentences: Optional[PositiveInt] = None
+
+
+class CandidatesRuntimeConfig(StrictModel):
+    k: PositiveInt  # candidates shown in the prompt
+    full_ranks: bool = False  # ranks every element, for debugging
+
+
+class ActionRuntimeConfig(StrictModel):
+    model: str
+    tokenizer: str
+    max_inp_len: Optional[PositiveInt] = None  # `None` keeps the whole prompt
+    max_out_len: PositiveInt
+    batch_size_per_device: PositiveInt
+    dtype: Dtype = "bfloat16"
+    device_map: str = "auto"
+    max_batch_size: Optional[PositiveInt] = None  # cross-session batching, if enabled
+    max_batch_tokens: Optional[PositiveInt] = None
+
+    @model_validator(mode="after")
+    def validate_batch_fits_a_prompt(self):
+        if (
+            self.max_inp_len is not None
+            and self.max_batch_tokens is not None
+            and self.max_batch_tokens < self.max_inp_len
+        ):
+            raise ValueError(
+                f"`max_batch_tokens` ({self.max_batch_tokens}) must fit at least one prompt "
+                f"of `max_inp_len` ({self.max_inp_len}) tokens."
+            )
+        return self
+
+
+class MemoryRuntimeConfig(StrictModel):
+    release_threshold: float = Field(0.9, gt=0, le=1)
+    min_release_interval_s: NonNegativeFloat = 5.0
+
+
+class StartupRuntimeConfig(StrictModel):
+    mode: Literal["eager", "background", "lazy"] = "eager"
+    load_timeout_s: Optional[PositiveFloat] = None  # `None` waits for the load
+
+
+class RuntimeConfig(StrictModel):
+    dmr: DMRRuntimeConfig
+    candidates: CandidatesRuntimeConfig
+    action: ActionRuntimeConfig
+    memory: MemoryRuntimeConfig
+    startup: StartupRuntimeConfig
+
+    @classmethod
+    def from_cfg(cls, cfg) -> "RuntimeConfig":
+        """
+        Parses the runtime settings of the hydra config (`config.yaml`).
+        """
+        dmr_batching = cfg.dmr.batching.enabled
+        action_batching = cfg.action.batching.enabled
+        return cls(
+            dmr=DMRRuntimeConfig(
+                model=cfg.dmr.model,
+                max_seq_length=cfg.dmr.max_seq_length,
+                batch_size_per_device=cfg.dmr.batch_size_per_device,
+                dtype=cfg.dmr.dtype,
+                device=cfg.dmr.device,
+                max_batch_size=cfg.dmr.batching.max_batch_size if dmr_batching else None,
+                max_batch_sentences=(
+                    cfg.dmr.batching.max_batch_sentences if dmr_batching else None
+                ),
+            ),
+            candidates=CandidatesRuntimeConfig(
+                k=cfg.candidates.k, full_ranks=cfg.candidates.full_ranks
+            ),
+            action=ActionRuntimeConfig(
+                model=cfg.action.model,
+                tokenizer=cfg.action.tokenizer,
+                max_inp_len=cfg.action.max_inp_len,
+                max_out_len=cfg.action.max_out_len,
+                batch_size_per_device=cfg.action.batch_size_per_device,
+                dtype=cfg.action.dtype,
+                device_map=cfg.action.device_map,
+                max_batch_size=(
+                    cfg.action.batching.max_batch_size if action_batching else None
+                ),
+                max_batch_tokens=(
+                    cfg.action.batching.max_batch_tokens if action_batching else None
+                ),
+            ),
+            memory=MemoryRuntimeConfig(
+                release_threshold=cfg.memory.release_threshold,
+                min_release_interval_s=cfg.memory.min_release_interval_s,
+            ),
+            startup=StartupRuntimeConfig(
+                mode=cfg.startup.mode, load_timeout_s=cfg.startup.load_timeout_s
+            ),
+        )
+
+    def report(self):
+        """
+        Sets the `/metrics` gauges: one series per numeric setting (unset ones are left
+        out) and the names, dtype & device of each model as labels.
+        """
+        for model, section in self.sections().items():
+            for setting, value in section.model_dump().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    RUNTIME_CONFIG.set(value, model=model, setting=setting)
+
+        RUNTIME_CONFIG_INFO.set(
+            1,
+            model="dmr",
+            name=self.dmr.model,
+            dtype=self.dmr.dtype,
+            device=self.dmr.device or "auto",
+        )
+        RUNTIME_CONFIG_INFO.set(
+            1,
+            model="action",
+            name=self.action.model,
+            dtype=self.action.dtype,
+            device=self.action.device_map,
+        )
+
+    def sections(self) -> Dict[str, StrictModel]:
+        return {
+            "dmr": self.dmr,
+            "candidates": self.candidates,
+            "action": self.action,
+            "memory": self.memory,
+            "startup": self.startup,
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.model_dump()
+
+
+def encode_config_overrides(overrides: List[str]) -> str:
+    """
+    Value of `WEBASSIST_CONFIG_OVERRIDES` for `overrides`: a JSON list, an override can hold
+    spaces (e.g. a path).
+    """
+    return json.dumps(list(overrides))
+
+
+def read_config_overrides() -> List[str]:
+    """
+    Hydra overrides of `WEBASSIST_CONFIG_OVERRIDES`, see `encode_config_overrides`.
+    """
+    value = os.environ.get(OVERRIDES_ENV, "").strip()
+    if not value:
+        return []
+    overrides = json.loads(value)
+    if not isinstance(overrides, list) or not all(isinstance(o, str) for o in overrides):
+        raise ValueError(f"`{OVERRIDES_ENV}` should be a JSON list of hydra overrides.")
+    return overrides
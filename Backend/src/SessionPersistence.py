@@ -0,0 +1,713 @@
+"""
+Sessions persisted outside of the server process.
+
+The `SessionStore` of a server holds its sessions in memory: a session is lost on restart and
+only the server that created it can serve it. With a `SessionPersistence`, each session is saved
+to a key-value store after every request and loaded back by any server that does not hold its
+latest revision (after a restart, a failover or a move to another replica).
+
+A session is saved as:
+    - a record `<prefix>:session:<id>`: the turns (intents, elements, metadata) as compressed
+      JSON, with the keys of their payloads, and a revision bumped on each save. The record is
+      only replaced if it is still the one the server last loaded or saved: when two servers
+      save the same revision of a session, the second one gets a `SessionConflictError`;
+    - the payloads, `<prefix>:html:<hash>` & `<prefix>:bboxes:<hash>`, stored by content hash:
+      a page is written once, even if it is the page of several turns or sessions.
+
+The store has the interface of Redis (`get`, `set` with an expiry, `expire`, `delete`, and a
+`WATCH`ed `compare_and_set`):
+`RedisStore` wraps a Redis client, `SQLiteStore` is a local file that the replicas of a host can
+share, and `MemoryStore` is an in-process stand-in.
+"""
+
+import abc
+import hashlib
+import io
+import json
+import logging
+import math
+import numpy as np
+import sqlite3
+import time
+import zlib
+
+from datetime import datetime
+from functools import partial
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from BBoxTable import BBoxTable
+from PageSnapshot import PageSnapshot, hash_page
+from Profiling import timed
+from WebLinxHelper import (
+    PAYLOAD_DROPPED,
+    PAYLOAD_RESIDENT,
+    InferReplay,
+    InferTurn,
+)
+from schema import Metadata, PrevTurn, UserIntent
+
+# Bumped when the record format changes, older records are ignored
+FORMAT_VERSION = 1
+
+
+class SessionConflictError(Exception):
+    """
+    Another server saved the session since this one loaded it.
+    """
+
+    def __init__(self, session_id: str, revision: int):
+        self.session_id = session_id
+        self.revision = revision
+        super().__init__(
+            f"Session `{session_id}` was saved by another server since revision {revision}, "
+            "resend the turn."
+        )
+
+
+####### Stores #######
+class KeyValueStore(metaclass=abc.ABCMeta):
+    """
+    The subset of the Redis commands used by `SessionPersistence`.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes, ex: Optional[float] = None):
+        """
+        Sets the value, expiring in `ex` seconds (never if `None`).
+        """
+        pass
+
+    @abc.abstractmethod
+    def compare_and_set(
+        self,
+        key: str,
+        value: bytes,
+        expected: Optional[bytes],
+        ex: Optional[float] = None,
+    ) -> bool:
+        """
+        Atomically sets the value if the current one is `expected` (`None`: the key does not
+        exist or expired). Returns whether the value was set.
+        """
+        pass
+
+    @abc.abstractmethod
+    def expire(self, key: str, seconds: float):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, *keys: str):
+        pass
+
+
+class MemoryStore(KeyValueStore):
+    """
+    In-process store, a stand-in for Redis in tests and single process servers.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = Lock()
+        self._items = {}
+
+    def __str__(self):
+        return f"Memory ({len(self._items)} keys)"
+
+    def __len__(self):
+        with self._lock:
+            self._purge_expired()
+            return len(self._items)
+
+    def _purge_expired(self):
+        now = self.clock()
+        expired = [
+            k for k, (_, expires_at) in self._items.items() if _is_expired(expires_at, now)
+        ]
+        for key in expired:
+            del self._items[key]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if _is_expired(expires_at, self.clock()):
+            del self._items[key]
+            return None
+        return value
+
+    def set(self, key: str, value: bytes, ex: Optional[float] = None):
+        with self._lock:
+            self._items[key] = (value, self._expires_at(ex))
+
+    def compare_and_set(
+        self,
+        key: str,
+        value: bytes,
+        expected: Optional[bytes],
+        ex: Optional[float] = None,
+    ) -> bool:
+        with self._lock:
+            if self._get(key) != expected:
+                return False
+            self._items[key] = (value, self._expires_at(ex))
+            return True
+
+    def expire(self, key: str, seconds: float):
+        with self._lock:
+            if key in self._items:
+                self._items[key] = (self._items[key][0], self._expires_at(seconds))
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def _expires_at(self, seconds: Optional[float]) -> Optional[float]:
+        return self.clock() + seconds if seconds is not None else None
+
+
+class SQLiteStore(KeyValueStore):
+    """
+    Store in a SQLite file. The processes of a host can share the file (write-ahead log).
+
+    Parameters:
+    -----------------
+    path: str
+        Path of the database file.
+    purge_every: int
+        Expired rows are deleted every `purge_every` writes (reads already skip them).
+    clock: Callable[[], float]
+        Wall clock of the expiry times, shared by the processes.
+    """
+
+    def __init__(self, path: str, purge_every: int = 1000, clock=time.time):
+        self.path = path
+        self.purge_every = purge_every
+        self.clock = clock
+
+        self._lock = Lock()
+        self._writes = 0
+        # Autocommit, each command is its own transaction
+        self.conn = sqlite3.connect(
+            path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+            )
+
+    def __str__(self):
+        return f"SQLite ({self.path})"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self.conn.execute(
+            "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or _is_expired(row[1], self.clock()):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: bytes, ex: Optional[float] = None):
+        with self._lock:
+            self._set(key, value, ex)
+
+    def _set(self, key: str, value: bytes, ex: Optional[float]):
+        expires_at = self.clock() + ex if ex is not None else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at),
+        )
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self.conn.execute("DELETE FROM kv WHERE expires_at <= ?", (self.clock(),))
+
+    def compare_and_set(
+        self,
+        key: str,
+        value: bytes,
+        expected: Optional[bytes],
+        ex: Optional[float] = None,
+    ) -> bool:
+        with self._lock:
+            # Takes the write lock of the file before reading, the other processes wait
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                swapped = self._get(key) == expected
+                if swapped:
+                    self._set(key, value, ex)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return swapped
+
+    def expire(self, key: str, seconds: float):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE kv SET expires_at = ? WHERE key = ?",
+                (self.clock() + seconds, key),
+            )
+
+    def delete(self, *keys: str):
+        with self._lock:
+            self.conn.executemany("DELETE FROM kv WHERE key = ?", [(k,) for k in keys])
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class RedisStore(KeyValueStore):
+    """
+    Store on a Redis server, shared by all the replicas.
+
+    Parameters:
+    -----------------
+    client: redis.Redis
+        Client of the server, or any object with the same `get`, `set`, `expire` & `delete`
+        (and `pipeline` for `compare_and_set`).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __str__(self):
+        return f"Redis ({self.client})"
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisStore":
+        # Optional dependency, only needed with the redis backend
+        import redis
+
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ex: Optional[float] = None):
+        # Redis expiries are whole seconds
+        self.client.set(key, value, ex=math.ceil(ex) if ex is not None else None)
+
+    def compare_and_set(
+        self,
+        key: str,
+        value: bytes,
+        expected: Optional[bytes],
+        ex: Optional[float] = None,
+    ) -> bool:
+        import redis
+
+        # The transaction is discarded if another client writes the key after the `WATCH`
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.set(key, value, ex=math.ceil(ex) if ex is not None else None)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def expire(self, key: str, seconds: float):
+        self.client.expire(key, math.ceil(seconds))
+
+    def delete(self, *keys: str):
+        if keys:
+            self.client.delete(*keys)
+
+
+def _is_expired(expires_at: Optional[float], now: float) -> bool:
+    return (expires_at is not None) and (expires_at <= now)
+
+
+def build_store(
+    backend: str, sqlite_path: Optional[str] = None, redis_url: Optional[str] = None
+) -> KeyValueStore:
+    """
+    Store of the `session.persistence.backend` setting: `memory`, `sqlite` or `redis`.
+    """
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(sqlite_path)
+    if backend == "redis":
+        return RedisStore.from_url(redis_url)
+    raise ValueError(f"Unknown session persistence backend `{backend}`.")
+
+
+####### Payload encoding #######
+def encode_html(html: str) -> bytes:
+    return zlib.compress(html.encode("utf-8"))
+
+
+def decode_html(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+
+def hash_bboxes(bboxes: BBoxTable) -> str:
+    digest = hashlib.sha256(bboxes.uids.astype(str).tobytes())
+    digest.update(np.ascontiguousarray(bboxes.values).tobytes())
+    return digest.hexdigest()
+
+
+def encode_bboxes(bboxes: BBoxTable) -> bytes:
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, uids=bboxes.uids.astype(str), values=bboxes.values)
+    return buffer.getvalue()
+
+
+def decode_bboxes(blob: bytes) -> BBoxTable:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+        return BBoxTable(uids=arrays["uids"], values=arrays["values"])
+
+
+def encode_record(record: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_record(blob: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(blob))
+
+
+####### Persistence #######
+class SessionPersistence:
+    """
+    Saves the sessions (`InferReplay` & last page) to a `KeyValueStore` and loads them back.
+
+    Parameters:
+    -----------------
+    store: KeyValueStore
+        Where the sessions are kept.
+    ttl_seconds: float
+        Sessions (and their payloads) not saved for this long expire. `None` keeps them.
+    key_prefix: str
+        Prefix of the keys, to share a store with other data.
+    clock: Callable[[], float]
+        Wall clock of the payload expiries, see `_write`.
+    """
+
+    def __init__(
+        self,
+        store: KeyValueStore,
+        ttl_seconds: Optional[float] = 86400,
+        key_prefix: str = "webassist",
+        clock: Callable[[], float] = time.time,
+    ):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self.clock = clock
+
+        self._lock = Lock()
+        self.stats = {
+            "loads": 0,
+            "restores": 0,
+            "saves": 0,
+            "conflicts": 0,
+            "payloads_written": 0,
+            "payloads_reused": 0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "load_s": 0.0,
+            "max_load_s": 0.0,
+            "save_s": 0.0,
+            "max_save_s": 0.0,
+        }
+
+        logging.info(f"Finished Initializing Session Persistence ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"Store: {self.store}\n"
+        str_rep += f"TTL (s): {self.ttl_seconds}\n"
+        str_rep += f"Key Prefix: {self.key_prefix}"
+        return str_rep
+
+    def session_key(self, session_id: str) -> str:
+        return f"{self.key_prefix}:session:{session_id}"
+
+    def html_key(self, html: str) -> str:
+        # Same hash as the `page_hash` of the page snapshots
+        return f"{self.key_prefix}:html:{hash_page(html)}"
+
+    def bboxes_key(self, bboxes: BBoxTable) -> str:
+        return f"{self.key_prefix}:bboxes:{hash_bboxes(bboxes)}"
+
+    def restore(self, session) -> bool:
+        """
+        Loads the replay & page of the session from the store if the session does not hold
+        its latest revision. Returns whether the session was rebuilt.
+        """
+        started = time.perf_counter()
+        with timed("session_load"):
+            blob = self.store.get(self.session_key(session.session_id))
+            # The next save only replaces this record
+            session.stored_record = blob
+            nbytes = len(blob) if blob is not None else 0
+            record = decode_record(blob) if blob is not None else None
+            if record is not None and record.get("version") != FORMAT_VERSION:
+                logging.warning(
+                    f"Ignoring stored session `{session.session_id}` of format version "
+                    f"{record.get('version')}."
+                )
+                record = None
+
+            restored = (record is not None) and (record["revision"] != session.revision)
+            if restored:
+                nbytes += self._restore_record(session, record)
+        self._record_op("load", time.perf_counter() - started, bytes_read=nbytes)
+        if restored:
+            with self._lock:
+                self.stats["restores"] += 1
+            logging.info(
+                f"Restored session `{session.session_id}` at revision {session.revision} "
+                f"({len(session.replay)} turns) from the store."
+            )
+        return restored
+
+    def _restore_record(self, session, record: Dict[str, Any]) -> int:
+        # Payloads loaded by this restore, by key (a page is often the page of several turns)
+        loaded = {}
+        nbytes = 0
+
+        def load(key: Optional[str], decode):
+            nonlocal nbytes
+            if key is None:
+                return None
+            if key not in loaded:
+                blob = self.store.get(key)
+                if blob is None:
+                    logging.warning(f"Payload `{key}` of a stored session has expired.")
+                    loaded[key] = None
+                else:
+                    nbytes += len(blob)
+                    loaded[key] = decode(blob)
+            return loaded[key]
+
+        turns = []
+        for turn_record in record["turns"]:
+            html_key, bboxes_key = turn_record["html"], turn_record["bboxes"]
+            # Only the turns that held their payload when saved load it now
+            resident = turn_record["state"] == PAYLOAD_RESIDENT
+            turn = InferTurn(
+                prev_turn=(
+                    UserIntent(**turn_record["turn"])
+                    if turn_record["speaker"] == "instructor"
+                    else PrevTurn(**turn_record["turn"])
+                ),
+                html=load(html_key, decode_html) if resident else None,
+                bboxes=load(bboxes_key, decode_bboxes) if resident else None,
+                metadata=(
+                    Metadata(**turn_record["metadata"])
+                    if turn_record["metadata"] is not None
+                    else None
+                ),
+                index=turn_record["index"],
+                timestamp=turn_record["timestamp"],
+                demo_name=session.session_id,
+            )
+            if (html_key or bboxes_key) and not resident:
+                turn.store_payload(
+                    partial(self.load_payload, html_key, bboxes_key),
+                    payload_keys=(html_key, bboxes_key),
+                )
+            else:
+                turn.payload_keys = (html_key, bboxes_key)
+            turns.append(turn)
+
+        session.replay.close()
+        session.replay = InferReplay.from_turns(
+            session.session_id,
+            turns,
+            start=datetime.fromisoformat(record["start"]),
+            retention=session.replay.retention,
+        )
+
+        page = record["page"]
+        html = load(page["html"], decode_html) if page is not None else None
+        session.page_snapshot = None
+        if html is not None:
+            session.page_snapshot = PageSnapshot(
+                html=html, bboxes=load(page["bboxes"], decode_bboxes)
+            )
+
+        session.revision = record["revision"]
+        # Written by another process, their expiry is refreshed on the next save
+        session.stored_payloads = {
+            key: 0.0 for key, value in loaded.items() if value is not None
+        }
+        return nbytes
+
+    def load_payload(
+        self, html_key: Optional[str], bboxes_key: Optional[str]
+    ) -> Tuple[Optional[str], Optional[BBoxTable]]:
+        """
+        Loads the html & bboxes of a turn, `None` if they expired.
+        """
+        with timed("session_payload_load"):
+            html = self.store.get(html_key) if html_key is not None else None
+            bboxes = self.store.get(bboxes_key) if bboxes_key is not None else None
+        with self._lock:
+            self.stats["bytes_read"] += sum(len(b) for b in [html, bboxes] if b is not None)
+        return (
+            decode_html(html) if html is not None else None,
+            decode_bboxes(bboxes) if bboxes is not None else None,
+        )
+
+    def save(self, session):
+        """
+        Saves the replay & page of the session. The payloads the session already wrote are not
+        written again.
+
+        Raises a `SessionConflictError`, without saving, if the stored record is not the one
+        the session last loaded or saved: another server saved the session in the meantime.
+        """
+        started = time.perf_counter()
+        with timed("session_save"):
+            # New payloads by key, and the keys of all the payloads of the session
+            payloads = {}
+            referenced = set()
+            bboxes_keys = {}
+
+            def add_html(html: Optional[str]) -> Optional[str]:
+                if html is None:
+                    return None
+                key = self.html_key(html)
+                referenced.add(key)
+                if key not in session.stored_payloads and key not in payloads:
+                    payloads[key] = encode_html(html)
+                return key
+
+            def add_bboxes(bboxes: Optional[BBoxTable]) -> Optional[str]:
+                if bboxes is None:
+                    return None
+                # The page snapshot & the last turn usually share the table
+                if id(bboxes) not in bboxes_keys:
+                    bboxes_keys[id(bboxes)] = self.bboxes_key(bboxes)
+                key = bboxes_keys[id(bboxes)]
+                referenced.add(key)
+                if key not in session.stored_payloads and key not in payloads:
+                    payloads[key] = encode_bboxes(bboxes)
+                return key
+
+            turn_records = []
+            for turn in session.replay:
+                if turn.payload_keys is None and turn.payload_state != PAYLOAD_DROPPED:
+                    # Leaves an offloaded payload offloaded
+                    html, bboxes = turn.read_payload()
+                    turn.payload_keys = (add_html(html), add_bboxes(bboxes))
+                elif turn.payload_keys is not None:
+                    referenced.update(k for k in turn.payload_keys if k is not None)
+                html_key, bboxes_key = turn.payload_keys or (None, None)
+                turn_records.append(self.dump_turn(turn, html_key, bboxes_key))
+
+            page = session.page_snapshot
+            record = {
+                "version": FORMAT_VERSION,
+                "session_id": session.session_id,
+                "revision": session.revision + 1,
+                "start": session.replay.start.isoformat(),
+                "turns": turn_records,
+                "page": (
+                    {"html": add_html(page.html), "bboxes": add_bboxes(page.bboxes)}
+                    if page is not None
+                    else None
+                ),
+            }
+
+            nbytes = self._write(session, payloads, referenced)
+            blob = encode_record(record)
+            if not self.store.compare_and_set(
+                self.session_key(session.session_id),
+                blob,
+                session.stored_record,
+                ex=self.ttl_seconds,
+            ):
+                with self._lock:
+                    self.stats["conflicts"] += 1
+                raise SessionConflictError(session.session_id, session.revision)
+            nbytes += len(blob)
+            session.stored_record = blob
+            session.revision += 1
+
+        self._record_op("save", time.perf_counter() - started, bytes_written=nbytes)
+        with self._lock:
+            self.stats["payloads_written"] += len(payloads)
+            self.stats["payloads_reused"] += len(referenced) - len(payloads)
+
+    def _write(self, session, payloads: Dict[str, bytes], referenced: Iterable[str]) -> int:
+        now = self.clock()
+        for key, blob in payloads.items():
+            self.store.set(key, blob, ex=self.ttl_seconds)
+            session.stored_payloads[key] = now
+
+        # The payloads of older turns must outlive the record: their expiry is pushed back
+        # once half of it has passed
+        if self.ttl_seconds is not None:
+            for key in referenced:
+                if now - session.stored_payloads.get(key, 0.0) > self.ttl_seconds / 2:
+                    self.store.expire(key, self.ttl_seconds)
+                    session.stored_payloads[key] = now
+
+        # Drops the keys of the pages the session no longer references
+        session.stored_payloads = {
+            k: t for k, t in session.stored_payloads.items() if k in referenced
+        }
+        return sum(len(blob) for blob in payloads.values())
+
+    @staticmethod
+    def dump_turn(
+        turn: InferTurn, html_key: Optional[str], bboxes_key: Optional[str]
+    ) -> Dict[str, Any]:
+        return {
+            "index": turn.index,
+            "timestamp": turn.timestamp,
+            "speaker": turn.speaker,
+            "turn": turn.prev_turn.model_dump(mode="json", exclude_none=True),
+            "metadata": (
+                turn.metadata.model_dump(mode="json") if turn.metadata is not None else None
+            ),
+            "state": turn.payload_state,
+            "html": html_key,
+            "bboxes": bboxes_key,
+        }
+
+    def delete(self, session_id: str):
+        """
+        Deletes the record of the session, its payloads expire with the TTL.
+        """
+        self.store.delete(self.session_key(session_id))
+
+    def _record_op(self, op: str, seconds: float, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.stats[f"{op}s"] += 1
+            self.stats[f"{op}_s"] += seconds
+            self.stats[f"max_{op}_s"] = max(self.stats[f"max_{op}_s"], seconds)
+            self.stats["bytes_read"] += bytes_read
+            self.stats["bytes_written"] += bytes_written
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["avg_load_s"] = stats["load_s"] / max(stats["loads"], 1)
+        stats["avg_save_s"] = stats["save_s"] / max(stats["saves"], 1)
+        stats["store"] = str(self.store)
+        return stats
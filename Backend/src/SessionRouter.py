@@ -0,0 +1,240 @@
+"""
+Front router of the multi-process mode (see `serve.py`).
+
+The state of a session (`InferReplay`, page snapshot, token cache) lives in the worker process
+that served it, so all the requests of a session must reach the same worker: the router reads
+the `sessionID` of the request body and forwards the request to the worker picked by a stable
+hash of it, over the worker's unix socket. The router does no other work on the requests (the
+body is not decoded), so one process keeps up with many workers.
+"""
+
+import asyncio
+import hashlib
+import httpx
+import itertools
+import json
+import logging
+import re
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Any, Dict, List, Optional
+
+from Metrics import REGISTRY, Counter
+
+ROUTED_REQUESTS = REGISTRY.register(
+    Counter(
+        "webassist_router_requests_total",
+        "Requests forwarded by the session router, by target (worker index or inference).",
+        ["target"],
+    )
+)
+
+# In a JSON document, the quotes inside strings are escaped: an unescaped `"sessionID":` can
+# only be a key
+# Monitoring routes of the inference process reachable through the router (`GET` only): its
+# model routes are not authenticated, they must only be reached by the workers
+INFERENCE_ROUTES = {"metrics", "v1/stats", "v1/health/live", "v1/health/ready"}
+
+SESSION_ID_PATTERN = re.compile(rb'"sessionID"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Headers of a single connection, not forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+
+def extract_session_id(body: bytes) -> Optional[str]:
+    """
+    `sessionID` of a JSON request body, without decoding the (large) body.
+    """
+    match = SESSION_ID_PATTERN.search(body)
+    if match is None:
+        return None
+    # Unescapes the value
+    return json.loads(b'"' + match.group(1) + b'"')
+
+
+def pick_worker(session_id: str, num_workers: int) -> int:
+    """
+    Worker of a session, the same in every router process and across restarts.
+    """
+    digest = hashlib.blake2b(session_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_workers
+
+
+def filter_headers(headers) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+class SessionRouter:
+    """
+    Forwards the requests to the workers (by session) and to the inference process.
+
+    Parameters:
+    -----------------
+    worker_transports: List[httpx.AsyncBaseTransport]
+        Transport to each worker, e.g. `httpx.AsyncHTTPTransport(uds=...)`.
+    inference_transport: httpx.AsyncBaseTransport
+        Transport to the inference process.
+    connect_timeout_s: float
+        Timeout to connect to a process. Requests are not timed out by the router, the workers
+        time out their calls to the inference process.
+    """
+
+    def __init__(
+        self,
+        worker_transports: List[httpx.AsyncBaseTransport],
+        inference_transport: httpx.AsyncBaseTransport,
+        connect_timeout_s: float = 2.0,
+    ):
+        timeout = httpx.Timeout(None, connect=connect_timeout_s)
+        self.workers = [
+            httpx.AsyncClient(transport=t, base_url="http://worker", timeout=timeout)
+            for t in worker_transports
+        ]
+        self.inference = httpx.AsyncClient(
+            transport=inference_transport, base_url="http://inference", timeout=timeout
+        )
+        self._round_robin = itertools.count()
+
+        logging.info(f"Finished Initializing Session Router ...\n{self}")
+
+    def __str__(self):
+        return f"Workers: {len(self.workers)}"
+
+    @classmethod
+    def from_sockets(
+        cls, worker_sockets: List[str], inference_socket: str, **kwargs
+    ) -> "SessionRouter":
+        return cls(
+            worker_transports=[httpx.AsyncHTTPTransport(uds=s) for s in worker_sockets],
+            inference_transport=httpx.AsyncHTTPTransport(uds=inference_socket),
+            **kwargs,
+        )
+
+    def select_worker(self, body: bytes) -> int:
+        """
+        Worker of the session of the request, round-robin for requests without a session.
+        """
+        session_id = extract_session_id(body) if body else None
+        if session_id is None:
+            return next(self._round_robin) % len(self.workers)
+        return pick_worker(session_id, len(self.workers))
+
+    async def forward(
+        self, client: httpx.AsyncClient, target: str, request: Request, path: str
+    ) -> Response:
+        """
+        Forwards the request to `path` of the client's process, streaming the response back
+        (e.g. the server-sent events of `/v1/stream_next_action`).
+        """
+        body = await request.body()
+        upstream = client.build_request(
+            request.method,
+            httpx.URL(path=path, query=request.url.query.encode()),
+            headers=filter_headers(request.headers),
+            content=body,
+        )
+        ROUTED_REQUESTS.inc(target=target)
+        try:
+            response = await client.send(upstream, stream=True)
+        except httpx.TransportError as e:
+            logging.error(f"Could not forward the request to the {target} process: {e!r}")
+            return JSONResponse(
+                {"detail": f"The {target} process is unavailable."}, status_code=502
+            )
+
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=filter_headers(response.headers),
+            background=BackgroundTask(response.aclose),
+        )
+
+    async def forward_to_worker(self, request: Request, path: str) -> Response:
+        index = self.select_worker(await request.body())
+        return await self.forward(self.workers[index], f"worker {index}", request, path)
+
+    async def readiness(self) -> Dict[str, Any]:
+        """
+        Readiness of the inference process & of every worker.
+        """
+
+        async def probe(client: httpx.AsyncClient) -> Dict[str, Any]:
+            try:
+                response = await client.get("/v1/health/ready")
+                return {"ready": response.status_code == 200, **response.json()}
+            except (httpx.TransportError, ValueError) as e:
+                return {"ready": False, "error": repr(e)}
+
+        inference, *workers = await asyncio.gather(
+            probe(self.inference), *(probe(w) for w in self.workers)
+        )
+        return {
+            "ready": inference["ready"] and all(w["ready"] for w in workers),
+            "inference": inference,
+            "workers": workers,
+        }
+
+    async def close(self):
+        for client in [self.inference, *self.workers]:
+            await client.aclose()
+
+
+def build_router_app(router: SessionRouter) -> FastAPI:
+    """
+    App of the router process:
+        - `/v1/health/live` & `/v1/health/ready` (ready once every process is),
+        - `/metrics` of the router,
+        - `/inference/<path>` & `/workers/<index>/<path>` reach one process, e.g. for its
+          `/metrics` & `/v1/stats` (only the `INFERENCE_ROUTES` of the inference process),
+        - any other request goes to the worker of its session.
+    """
+    app = FastAPI()
+    methods = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
+
+    @app.on_event("shutdown")
+    async def close_router():
+        await router.close()
+
+    @app.get("/v1/health/live")
+    async def liveness():
+        return {"status": "alive"}
+
+    @app.get("/v1/health/ready")
+    async def readiness():
+        readiness = await router.readiness()
+        readiness["status"] = "ready" if readiness.pop("ready") else "not_ready"
+        return JSONResponse(
+            readiness, status_code=200 if readiness["status"] == "ready" else 503
+        )
+
+    @app.get("/metrics")
+    async def get_metrics():
+        return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @app.api_route("/inference/{path:path}", methods=methods)
+    async def to_inference(path: str, request: Request):
+        if request.method != "GET" or path not in INFERENCE_ROUTES:
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+        return await router.forward(router.inference, "inference", request, f"/{path}")
+
+    @app.api_route("/workers/{index:int}/{path:path}", methods=methods)
+    async def to_worker(index: int, path: str, request: Request):
+        if not 0 <= index < len(router.workers):
+            return JSONResponse({"detail": f"No worker {index}."}, status_code=404)
+        client = router.workers[index]
+        return await router.forward(client, f"worker {index}", request, f"/{path}")
+
+    @app.api_route("/{path:path}", methods=methods)
+    async def to_session_worker(path: str, request: Request):
+        return await router.forward_to_worker(request, f"/{path}")
+
+    return app
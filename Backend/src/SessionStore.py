@@ -0,0 +1,237 @@
+"""
+Bounded store of the sessions (replay + lock) the server keeps in memory.
+
+Sessions are evicted when idle for longer than the TTL, or least recently used first when the
+store goes over its session count or memory budget. A session with a request in flight is never
+evicted. Requests for an evicted session fail with `SessionEvictedError` instead of silently
+starting from an empty replay.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from TokenCache import TokenCache
+from WebLinxHelper import InferReplay, PayloadRetention
+
+
+def hash_session_id(session_id: str) -> str:
+    """
+    Short hash of a session id, to tell the sessions apart in the stats without exposing them.
+    """
+    return hashlib.blake2b(session_id.encode(), digest_size=6).hexdigest()
+
+
+class SessionEvictedError(Exception):
+    """
+    Raised when a request refers to a session that was evicted from the store.
+    """
+
+    def __init__(self, session_id: str, reason: str):
+        self.session_id = session_id
+        self.reason = reason
+        super().__init__(
+            f"Session `{session_id}` is no longer available on the server ({reason}). "
+            "Please start a new session."
+        )
+
+
+class Session:
+    def __init__(
+        self,
+        session_id: str,
+        retention: Optional[PayloadRetention] = None,
+        token_cache_entries: int = 4096,
+    ):
+        self.session_id = session_id
+        self.replay = InferReplay(session_id=session_id, retention=retention)
+        # Tokenizations of the prompt fragments (utterances, previous turns, ...) of the session
+        self.token_cache = TokenCache(max_entries=token_cache_entries)
+        self.lock = asyncio.Lock()
+        self.created_at = time.monotonic()
+        self.last_access = self.created_at
+        self.active_requests = 0
+        self.nbytes = 0
+
+        # Last page received, base of the client's next page delta
+        self.page_snapshot = None
+
+        # Persisted revision the session holds, payload keys it wrote & record it last loaded
+        # or saved, see `SessionPersistence`
+        self.revision = 0
+        self.stored_payloads = {}
+        self.stored_record = None
+
+    def update_nbytes(self):
+        self.nbytes = self.replay.estimate_nbytes() + self.token_cache.nbytes
+
+
+class SessionStore:
+    """
+    Holds the sessions with an idle TTL and a max-sessions / max-bytes budget (LRU eviction).
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: Optional[float] = 3600,
+        max_sessions: Optional[int] = 1000,
+        max_bytes: Optional[int] = None,
+        max_evicted_ids: int = 10000,
+        retention: Optional[PayloadRetention] = None,
+        token_cache_entries: int = 4096,
+    ):
+        """
+        Parameters:
+        -----------------
+        ttl_seconds: float
+            Sessions idle for longer than this are evicted. `None` disables the TTL.
+        max_sessions: int
+            Maximum number of sessions kept. `None` means no limit.
+        max_bytes: int
+            Memory budget of all sessions, using the replay size estimates. `None` means no limit.
+        max_evicted_ids: int
+            How many evicted session IDs to remember, to report them as evicted.
+        retention: PayloadRetention
+            Policy for the HTML & bboxes of older turns of each replay.
+        token_cache_entries: int
+            Maximum number of tokenizations kept by each session, reused across its turns.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_evicted_ids = max_evicted_ids
+        self.retention = retention
+        self.token_cache_entries = token_cache_entries
+
+        self.sessions = OrderedDict()
+        self.evicted = OrderedDict()
+        self.evictions = {"ttl": 0, "max_sessions": 0, "max_bytes": 0}
+
+        logging.info(f"Finished Initializing Session Store ...\n{self}")
+
+    def __str__(self):
+        str_rep = f"TTL (s): {self.ttl_seconds}\n"
+        str_rep += f"Max Sessions: {self.max_sessions}\n"
+        str_rep += f"Max Bytes: {self.max_bytes}\n"
+        str_rep += f"Payload Retention: {self.retention}"
+        return str_rep
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id: str):
+        return session_id in self.sessions
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self.sessions.values())
+
+    def get_or_create(self, session_id: str) -> Session:
+        """
+        Returns the session, creating it if it was never seen.
+
+        Raises:
+        --------
+        SessionEvictedError if the session was evicted.
+        """
+        self.evict_expired()
+
+        session = self.sessions.get(session_id)
+        if session is None:
+            if session_id in self.evicted:
+                raise SessionEvictedError(session_id, self.evicted[session_id])
+            session = Session(
+                session_id,
+                retention=self.retention,
+                token_cache_entries=self.token_cache_entries,
+            )
+            self.sessions[session_id] = session
+
+        session.last_access = time.monotonic()
+        self.sessions.move_to_end(session_id)
+        return session
+
+    @asynccontextmanager
+    async def session(self, session_id: str):
+        """
+        Holds the lock of the session for the duration of a request.
+        Its size is re-estimated and the budgets enforced once the request is done.
+        """
+        session = self.get_or_create(session_id)
+        session.active_requests += 1
+        try:
+            async with session.lock:
+                yield session
+        finally:
+            session.active_requests -= 1
+            session.last_access = time.monotonic()
+            session.update_nbytes()
+            self.enforce_budget()
+
+    def evict_expired(self):
+        if self.ttl_seconds is None:
+            return
+
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if (session.active_requests == 0) and (
+                now - session.last_access > self.ttl_seconds
+            ):
+                self._evict(session, "ttl")
+
+    def enforce_budget(self):
+        # Least recently used first
+        for session in list(self.sessions.values()):
+            over_sessions = (self.max_sessions is not None) and (
+                len(self.sessions) > self.max_sessions
+            )
+            over_bytes = (self.max_bytes is not None) and (self.nbytes > self.max_bytes)
+            if not (over_sessions or over_bytes):
+                return
+            if session.active_requests > 0:
+                continue
+            self._evict(session, "max_sessions" if over_sessions else "max_bytes")
+
+    def _evict(self, session: Session, reason: str):
+        del self.sessions[session.session_id]
+        session.replay.close()
+        self.evictions[reason] += 1
+
+        self.evicted[session.session_id] = {
+            "ttl": "expired after being idle",
+            "max_sessions": "evicted, too many sessions",
+            "max_bytes": "evicted, memory budget exceeded",
+        }[reason]
+        while len(self.evicted) > self.max_evicted_ids:
+            self.evicted.popitem(last=False)
+
+        logging.info(
+            f"Evicted session `{session.session_id}` ({reason}, ~{session.nbytes} bytes)."
+        )
+
+    def get_stats(self, top_k: int = 10) -> Dict[str, Any]:
+        self.evict_expired()
+        largest = sorted(self.sessions.values(), key=lambda s: s.nbytes, reverse=True)
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.nbytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": dict(self.evictions),
+            "largest_sessions": [
+                {
+                    # `/v1/stats` is public, the id would let anyone add turns to the session
+                    "session_hash": hash_session_id(s.session_id),
+                    "idle_s": time.monotonic() - s.last_access,
+                    **s.replay.get_memory_stats(),
+                    "token_cache": s.token_cache.get_stats(),
+                }
+                for s in largest[:top_k]
+            ],
+        }
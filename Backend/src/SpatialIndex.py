@@ -0,0 +1,192 @@
+"""
+Spatial index over the bboxes of a page, built once per turn.
+
+Viewport filtering is vectorized over the whole table. Point and rectangle queries go through a
+uniform grid: each bbox is registered in the cells it covers, so a query only tests the bboxes of
+the cells it touches. Bboxes covering too many cells (page-wide containers) are kept aside in a
+small list tested on every query, which keeps the grid from growing with the page size.
+"""
+
+import numpy as np
+
+from typing import List, Optional
+
+from BBoxTable import BOTTOM, HEIGHT, LEFT, RIGHT, TOP, WIDTH, BBoxTable
+
+
+class SpatialIndex:
+    """
+    Grid index of a BBoxTable answering viewport, point and rectangle queries with the same
+    results as the weblinx helpers.
+    """
+
+    def __init__(
+        self,
+        bboxes: BBoxTable,
+        cell_size: float = 64,
+        max_cells_per_box: int = 256,
+    ):
+        """
+        Parameters:
+        -----------------
+        bboxes: BBoxTable
+            Bboxes of the page.
+        cell_size: float
+            Side of a grid cell, in pixels.
+        max_cells_per_box: int
+            Bboxes covering more cells than this are not registered in the grid but tested on
+            every query.
+        """
+        self.bboxes = bboxes
+        self.cell_size = cell_size
+        self.max_cells_per_box = max_cells_per_box
+
+        v = bboxes.values
+        # Same rounding as `get_element_uid_by_coords`
+        self.left = np.floor(v[:, LEFT])
+        self.right = np.ceil(v[:, RIGHT])
+        self.top = np.floor(v[:, TOP])
+        self.bottom = np.ceil(v[:, BOTTOM])
+        self.area = v[:, WIDTH] * v[:, HEIGHT]
+
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.left, self.right, self.top, self.bottom, self.area]
+        arrays += [self.cell_keys, self.cell_starts, self.cell_rows, self.large_rows]
+        return sum(a.nbytes for a in arrays)
+
+    def _cell(self, coord):
+        return np.floor(np.asarray(coord) / self.cell_size).astype(np.int64)
+
+    def _build_grid(self):
+        # Boxes with right < left (or bottom < top) cannot contain any point
+        valid = (self.left <= self.right) & (self.top <= self.bottom)
+
+        cx0, cx1 = self._cell(self.left), self._cell(self.right)
+        cy0, cy1 = self._cell(self.top), self._cell(self.bottom)
+        nx = np.where(valid, cx1 - cx0 + 1, 0)
+        ny = np.where(valid, cy1 - cy0 + 1, 0)
+        ncells = nx * ny
+
+        large = ncells > self.max_cells_per_box
+        self.large_rows = np.flatnonzero(large)
+
+        gridded = np.flatnonzero(valid & ~large)
+        if len(gridded):
+            self.col_min = int(cx0[gridded].min())
+            self.row_min = int(cy0[gridded].min())
+            self.ncols = int(cx1[gridded].max()) - self.col_min + 1
+            self.nrows = int(cy1[gridded].max()) - self.row_min + 1
+        else:
+            self.col_min, self.row_min, self.ncols, self.nrows = 0, 0, 1, 1
+
+        # One entry per (cell, box), expanded without a Python loop
+        counts = ncells[gridded]
+        rows = np.repeat(gridded, counts)
+        starts = np.cumsum(counts) - counts
+        offsets = np.arange(counts.sum()) - np.repeat(starts, counts)
+        cols = cx0[rows] + offsets % nx[rows]
+        lines = cy0[rows] + offsets // nx[rows]
+        keys = (lines - self.row_min) * self.ncols + (cols - self.col_min)
+
+        # Stable sort keeps the rows of a cell in table order
+        order = np.argsort(keys, kind="stable")
+        keys, self.cell_rows = keys[order], rows[order]
+        self.cell_keys, self.cell_starts = np.unique(keys, return_index=True)
+        self.cell_starts = np.append(self.cell_starts, len(keys))
+
+    def _rows_in_cells(self, col0: int, col1: int, row0: int, row1: int) -> np.ndarray:
+        """
+        Rows registered in the cells of the range (inclusive) or kept aside as large, in table
+        order and without duplicates.
+        """
+        col0 = max(col0 - self.col_min, 0)
+        col1 = min(col1 - self.col_min, self.ncols - 1)
+        row0 = max(row0 - self.row_min, 0)
+        row1 = min(row1 - self.row_min, self.nrows - 1)
+
+        if (col0 > col1) or (row0 > row1):
+            return self.large_rows
+
+        keys = (
+            np.arange(row0, row1 + 1)[:, None] * self.ncols
+            + np.arange(col0, col1 + 1)[None, :]
+        ).ravel()
+        pos = np.searchsorted(self.cell_keys, keys)
+        hit = pos < len(self.cell_keys)
+        hit[hit] = self.cell_keys[pos[hit]] == keys[hit]
+        pos = pos[hit]
+
+        found = [self.large_rows] + [
+            self.cell_rows[self.cell_starts[p] : self.cell_starts[p + 1]] for p in pos
+        ]
+        if len(pos) <= 1:
+            # A row is in one list only, no need to deduplicate
+            return np.sort(np.concatenate(found))
+        return np.unique(np.concatenate(found))
+
+    def visible_uids(
+        self,
+        min_height: float = 10,
+        min_width: float = 10,
+        viewport_height: Optional[float] = None,
+        viewport_width: Optional[float] = None,
+    ) -> List[str]:
+        """
+        UIDs kept by `weblinx.utils.html.filter_bboxes`, in table order.
+        """
+        mask = self.bboxes.visible_mask(
+            min_height=min_height,
+            min_width=min_width,
+            viewport_height=viewport_height,
+            viewport_width=viewport_width,
+        )
+        return self.bboxes.uids[mask].tolist()
+
+    def uid_at(self, x: float, y: float) -> Optional[str]:
+        """
+        UID of the smallest non-zero-sized element containing (x, y), like
+        `weblinx.processing.outputs.get_element_uid_by_coords`.
+        """
+        x, y = float(x), float(y)
+        col, row = int(self._cell(x)), int(self._cell(y))
+        rows = self._rows_in_cells(col, col, row, row)
+
+        contains = (
+            (self.left[rows] <= x)
+            & (x <= self.right[rows])
+            & (self.top[rows] <= y)
+            & (y <= self.bottom[rows])
+            & (self.area[rows] != 0)
+        )
+        rows = rows[contains]
+        if len(rows) == 0:
+            return None
+
+        # Rows are in table order, so argmin keeps the first of equal areas
+        return self.bboxes.uids[rows[np.argmin(self.area[rows])]].item()
+
+    def uids_in_rect(
+        self, left: float, top: float, right: float, bottom: float
+    ) -> List[str]:
+        """
+        UIDs of the elements whose bbox intersects the rectangle, in table order.
+        """
+        rows = self._rows_in_cells(
+            int(self._cell(left)),
+            int(self._cell(right)),
+            int(self._cell(top)),
+            int(self._cell(bottom)),
+        )
+        intersects = (
+            (self.left[rows] <= right)
+            & (left <= self.right[rows])
+            & (self.top[rows] <= bottom)
+            & (top <= self.bottom[rows])
+        )
+        return self.bboxes.uids[rows[intersects]].tolist()
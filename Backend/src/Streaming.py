@@ -0,0 +1,95 @@
+"""
+Server-sent events of the streaming next-action endpoint.
+
+The stages of the request run on the executor pools and the tokens are generated in a worker
+thread, so events are emitted thread-safely into an `EventStream` that the response iterates
+on the event loop. `ActionStreamMonitor` follows the generated text: it emits the new text and
+tells the generation to stop once the text holds a complete action, e.g. `click(uid="12")`.
+"""
+
+import asyncio
+import json
+
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+_CLOSE = object()
+
+
+def find_action_end(text: str) -> Optional[int]:
+    """
+    Index of the bracket closing the first `intent(...)` of the text, or `None` if it is not
+    closed yet. Brackets between quotes are ignored, the same way as the weblinx parser
+    (`find_intent_and_raw_args`), so parsing the text up to there gives the same action as
+    parsing the full generation.
+    """
+    start = text.find("(")
+    if start == -1:
+        return None
+
+    quote_is_open = False
+    for i in range(start, len(text)):
+        if text[i] == '"':
+            quote_is_open = not quote_is_open
+        elif text[i] == ")" and not quote_is_open:
+            return i
+    return None
+
+
+class ActionStreamMonitor:
+    """
+    Follows the text generated so far: emits what was added since the last update and reports
+    when the action is complete.
+    """
+
+    def __init__(self, on_text: Optional[Callable[[str], None]] = None):
+        self.on_text = on_text
+        self.text = ""
+        self.complete = False
+
+    def update(self, text: str) -> bool:
+        """
+        Returns whether the generation can stop.
+        """
+        # A token ending in the middle of a character decodes to a replacement character
+        stable = text.rstrip("\ufffd")
+        if stable.startswith(self.text) and len(stable) > len(self.text):
+            if self.on_text is not None:
+                self.on_text(stable[len(self.text) :])
+            self.text = stable
+
+        self.complete = find_action_end(text) is not None
+        return self.complete
+
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class EventStream:
+    """
+    Queue of server-sent events. `emit` can be called from any thread, `stream` is iterated on
+    the event loop that created the stream.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.closed = False
+
+    def emit(self, event: str, data: Dict[str, Any]):
+        self._put((event, data))
+
+    def close(self):
+        self._put(_CLOSE)
+
+    def _put(self, item):
+        # Also scheduled from the loop's thread, to keep the order with the other threads
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    async def stream(self) -> AsyncIterator[str]:
+        while True:
+            item = await self._queue.get()
+            if item is _CLOSE:
+                self.closed = True
+                return
+            yield format_sse(*item)
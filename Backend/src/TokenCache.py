@@ -0,0 +1,234 @@
+"""
+Memoized tokenization for prompt truncation.
+
+The weblinx truncation helpers re-tokenize the same fragments (utterances, previous turns,
+DOM texts, candidates) several times per attempt, and the prompt builder tokenizes them once
+more to compute the unused budget. `CachedTokenizer` wraps the tokenizer for one request and
+memoizes its outputs by text hash: every fragment is tokenized at most once per request, and
+the short ones are kept in the session's `TokenCache` so that the utterances and previous
+turns are not tokenized again on the next turn.
+"""
+
+import hashlib
+import logging
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from Metrics import REGISTRY, Counter
+
+# Rough per-entry overhead (key, OrderedDict node, result container) and per-token size
+ENTRY_OVERHEAD_BYTES = 200
+TOKEN_BYTES = 60
+
+# Keyword arguments that make the output depend on the other texts of the batch
+_BATCH_DEPENDENT_KWARGS = ("padding", "return_tensors", "truncation", "max_length")
+
+TOKEN_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "webassist_token_cache_lookups_total",
+        "Tokenizations looked up while building prompts, by where they were found.",
+        ["result"],
+    )
+)
+
+
+def _num_tokens(value) -> int:
+    if isinstance(value, list):
+        return len(value)
+    input_ids = value.get("input_ids") if hasattr(value, "get") else None
+    return len(input_ids) if input_ids is not None else 1
+
+
+class TokenCache:
+    """
+    LRU cache of the tokenizations of a session, shared by its requests.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_text_len: int = 4096):
+        """
+        Parameters:
+        -----------------
+        max_entries: int
+            Maximum number of cached tokenizations.
+        max_text_len: int
+            Longer texts (e.g. the truncated DOM tree, which changes on every turn) are only
+            memoized for the request.
+        """
+        self.max_entries = max_entries
+        self.max_text_len = max_text_len
+
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        str_rep = f"Max Entries: {self.max_entries}\n"
+        str_rep += f"Max Text Length: {self.max_text_len}"
+        return str_rep
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(method: str, text: str, kwargs: Dict[str, Any]) -> bytes:
+        options = repr(sorted(kwargs.items()))
+        return hashlib.blake2b(
+            f"{method}\0{options}\0{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def get(self, key: bytes):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: bytes, value):
+        size = ENTRY_OVERHEAD_BYTES + TOKEN_BYTES * _num_tokens(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+
+            while len(self._entries) > self.max_entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+class CachedTokenizer:
+    """
+    Tokenizer proxy for one request, memoizing `tokenize` and `__call__` on strings (and on
+    lists of strings, element by element). Lookups go to the request's memo first, then to the
+    session's `TokenCache`. Everything else is forwarded to the tokenizer.
+
+    Cached outputs are shared between the calls, they must not be modified.
+    """
+
+    def __init__(self, tokenizer, session_cache: Optional[TokenCache] = None):
+        self.tokenizer = tokenizer
+        self.session_cache = session_cache
+        self._memo = {}
+
+        self.request_hits = 0
+        self.session_hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.tokenizer, name)
+
+    def _lookup(self, key: bytes):
+        value = self._memo.get(key)
+        if value is not None:
+            self.request_hits += 1
+            return value
+        if self.session_cache is not None:
+            value = self.session_cache.get(key)
+            if value is not None:
+                self.session_hits += 1
+                self._memo[key] = value
+                return value
+        return None
+
+    def _store(self, key: bytes, text: str, value):
+        self.misses += 1
+        self._memo[key] = value
+        if self.session_cache is not None and len(text) <= self.session_cache.max_text_len:
+            self.session_cache.put(key, value)
+
+    def tokenize(self, text: str, **kwargs) -> List[str]:
+        key = TokenCache.make_key("tokenize", text, kwargs)
+        tokens = self._lookup(key)
+        if tokens is None:
+            tokens = self.tokenizer.tokenize(text, **kwargs)
+            self._store(key, text, tokens)
+        return list(tokens)
+
+    def __call__(self, text, **kwargs):
+        if any(kwargs.get(k) for k in _BATCH_DEPENDENT_KWARGS):
+            return self.tokenizer(text, **kwargs)
+
+        if isinstance(text, str):
+            key = TokenCache.make_key("call", text, kwargs)
+            encoded = self._lookup(key)
+            if encoded is None:
+                encoded = self.tokenizer(text, **kwargs)
+                self._store(key, text, encoded)
+            return encoded
+
+        if isinstance(text, list) and all(isinstance(t, str) for t in text):
+            return self._call_many(text, **kwargs)
+
+        return self.tokenizer(text, **kwargs)
+
+    def _call_many(self, texts: List[str], **kwargs) -> Dict[str, list]:
+        """
+        Tokenizes the texts not seen yet as one batch, returns the outputs of all texts as a
+        dict of lists (like the tokenizer's `BatchEncoding`).
+        """
+        keys = [TokenCache.make_key("call", t, kwargs) for t in texts]
+        outputs = [self._lookup(key) for key in keys]
+
+        missing = {}
+        for i, (key, output) in enumerate(zip(keys, outputs)):
+            if output is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            missing_texts = [texts[positions[0]] for positions in missing.values()]
+            encoded = self.tokenizer(missing_texts, **kwargs)
+            for j, (key, positions) in enumerate(missing.items()):
+                output = {name: values[j] for name, values in encoded.items()}
+                self._store(key, texts[positions[0]], output)
+                for i in positions:
+                    outputs[i] = output
+
+        names = outputs[0].keys() if outputs else ()
+        return {name: [output[name] for output in outputs] for name in names}
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.request_hits + self.session_hits + self.misses
+        hits = self.request_hits + self.session_hits
+        return {
+            "request_hits": self.request_hits,
+            "session_hits": self.session_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else None,
+        }
+
+    def report(self):
+        """
+        Adds the lookups of the request to the `/metrics` counter and logs its hit rate.
+        """
+        stats = self.get_stats()
+        TOKEN_CACHE_LOOKUPS.inc(stats["request_hits"], result="request_hit")
+        TOKEN_CACHE_LOOKUPS.inc(stats["session_hits"], result="session_hit")
+        TOKEN_CACHE_LOOKUPS.inc(stats["misses"], result="miss")
+        logging.debug(f"Token cache: {stats}")
+        return stats
@@ -0,0 +1,210 @@
+"""
+Request tracing: nested spans with durations and attributes (session ID, HTML bytes, element
+count, prompt / generated tokens, ...).
+
+The current span is held in a context variable, so spans opened by the stages of a request
+(including the ones run on the executor pools, which copy the context) become children of the
+request's root span. The spans of a batch shared by several requests are copied into each of
+their traces (see `detached_trace`). When the root span ends, the whole trace is logged as one
+JSON line.
+Every span also feeds the stage latency histogram exported on `/metrics`.
+"""
+
+import copy
+import itertools
+import json
+import logging
+import time
+import uuid
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from Metrics import REGISTRY, Counter, Histogram
+
+logger = logging.getLogger("tracing")
+
+STAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "webassist_stage_duration_seconds",
+        "Duration of the stages of a request (DMR, prompt building, generation, ...).",
+        ["stage"],
+    )
+)
+REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "webassist_request_duration_seconds",
+        "Duration of the HTTP requests.",
+        ["path", "status"],
+    )
+)
+REQUESTS = REGISTRY.register(
+    Counter("webassist_requests_total", "HTTP requests handled.", ["path", "status"])
+)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Trace:
+    """
+    The spans of a request, in the order they ended.
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.root = None
+        self.spans = []
+        self._lock = Lock()
+
+    def add(self, span: "Span"):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        origin = self.root.start
+        return {
+            "event": "trace",
+            "trace_id": self.trace_id,
+            **self.root.to_dict(origin),
+            "spans": [s.to_dict(origin) for s in spans],
+        }
+
+
+class Span:
+    def __init__(
+        self, name: str, trace: Optional[Trace], parent: Optional["Span"], **attributes
+    ):
+        self.name = name
+        self.trace = trace
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ms": round(1000 * (self.start - origin), 3),
+            "duration_ms": (
+                round(1000 * self.duration, 3) if self.duration is not None else None
+            ),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Opens a child span of the current span. Outside of a request (e.g. in the batcher threads)
+    the span is not part of any trace but its duration is still recorded in the histogram.
+    """
+    parent = _current_span.get()
+    current = Span(name, parent.trace if parent else None, parent, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        STAGE_DURATION.observe(current.duration, stage=name)
+        if current.trace is not None:
+            current.trace.add(current)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """
+    Opens the root span of a request; the trace is logged when it ends.
+    """
+    trace = Trace()
+    root = trace.root = Span(name, trace, None, **attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException:
+        root.status = "error"
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        _current_span.reset(token)
+        logger.info(json.dumps(trace.to_dict(), default=str))
+
+
+@contextmanager
+def detached_trace(name: str, **attributes):
+    """
+    Opens the root span of work done for several requests at once (e.g. a batch run on the
+    batcher thread). Its spans are not logged, they are copied into the traces of the requests
+    with `attach_trace`.
+    """
+    trace = Trace()
+    root = trace.root = Span(name, trace, None, **attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException:
+        root.status = "error"
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        _current_span.reset(token)
+        STAGE_DURATION.observe(root.duration, stage=name)
+
+
+def attach_trace(trace: Trace, parent: Optional[Span], **attributes):
+    """
+    Copies the spans of a detached trace into the trace of `parent`, its root becoming a child
+    of `parent` with the extra `attributes` (e.g. the queue wait of the request's item).
+    """
+    if parent is None or parent.trace is None:
+        return
+    root = copy.copy(trace.root)
+    root.trace = parent.trace
+    root.parent_id = parent.span_id
+    root.attributes = {**trace.root.attributes, **attributes}
+    parent.trace.add(root)
+    with trace._lock:
+        spans = list(trace.spans)
+    for child in spans:
+        child = copy.copy(child)
+        child.trace = parent.trace
+        parent.trace.add(child)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_attributes(**attributes):
+    """
+    Sets attributes on the current span, if any.
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def set_trace_attributes(**attributes):
+    """
+    Sets attributes on the root span of the current trace (e.g. the session ID once the
+    request body is parsed).
+    """
+    current = _current_span.get()
+    if current is not None and current.trace is not None:
+        current.trace.root.set(**attributes)
@@ -1,11 +1,20 @@
+import io
 import logging
-import lxml
+import lxml.html
+import numpy as np
+import os
+import tempfile
+import uuid
 import weblinx as wl
 
 from datetime import datetime
 from functools import cached_property, lru_cache
-from typing import Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+from BBoxTable import BBoxTable
+from Profiling import timed
+from PromptState import PromptState
+from SpatialIndex import SpatialIndex
 from schema import (
     BoundingBox,
     BrowserIntentEnum,
@@ -15,6 +24,124 @@ from schema import (
     PrevTurn,
 )
 
+# Rough sizes used to estimate the memory held by a turn
+BBOX_NBYTES = 600  # pydantic BoundingBox + its dict entry, if not a BBoxTable
+PARSED_PAGE_NBYTES_PER_CHAR = 2  # lxml tree relative to the HTML size
+TURN_NBYTES = 2000  # turn object, prev_turn model and metadata
+
+# Where the HTML & bboxes of a turn are held
+PAYLOAD_RESIDENT = "resident"
+PAYLOAD_DROPPED = "dropped"
+PAYLOAD_COMPRESSED = "compressed"
+PAYLOAD_SPILLED = "spilled"
+PAYLOAD_STORED = "stored"  # in the session store, see `SessionPersistence`
+
+
+def encode_payload(html: Optional[str], bboxes: Optional[BBoxTable]) -> bytes:
+    """
+    Compressed copy of the payload of a turn: the UTF-8 HTML and the columns of the bboxes in
+    one `npz` archive. Loaded back without pickle, spilled files cannot run code.
+    """
+    arrays = {}
+    if html is not None:
+        arrays["html"] = np.frombuffer(html.encode("utf-8"), dtype=np.uint8)
+    if bboxes is not None:
+        arrays["uids"] = bboxes.uids.astype(str)
+        arrays["values"] = bboxes.values
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def decode_payload(blob: bytes) -> Tuple[Optional[str], Optional[BBoxTable]]:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+        html = arrays["html"].tobytes().decode("utf-8") if "html" in arrays else None
+        bboxes = None
+        if "uids" in arrays:
+            bboxes = BBoxTable(uids=arrays["uids"], values=arrays["values"])
+    return html, bboxes
+
+
+class ParsedPage:
+    """
+    The parsed DOM of a turn's HTML, shared by DMR, prompt building and element lookup
+    so the page is only parsed once per turn.
+    * Elements tagged with a `uid_key` are indexed lazily, once per `uid_key`.
+    * Consumers must not modify `root` in place (copy it first).
+    """
+
+    def __init__(self, html: str):
+        with timed("html_parse"):
+            self.root = lxml.html.fromstring(html)
+        self.root_tree = self.root.getroottree()
+        self._elements = {}
+        self._uid_index = {}
+
+    def get_elements(self, uid_key: str) -> List:
+        """
+        All the elements tagged with `uid_key`, in document order.
+        """
+        if uid_key not in self._elements:
+            self._elements[uid_key] = self.root.xpath(f"//*[@{uid_key}]")
+        return self._elements[uid_key]
+
+    def get_uid_index(self, uid_key: str) -> Dict:
+        """
+        Maps each uid to its element (the first one if the uid is repeated).
+        """
+        if uid_key not in self._uid_index:
+            index = {}
+            for elem in self.get_elements(uid_key):
+                index.setdefault(elem.attrib[uid_key], elem)
+            self._uid_index[uid_key] = index
+        return self._uid_index[uid_key]
+
+    def get_element(self, uid: str, uid_key: str):
+        return self.get_uid_index(uid_key).get(uid)
+
+    def get_xpath(self, element) -> str:
+        return self.root_tree.getpath(element)
+
+
+def get_parsed_page(turn: wl.Turn) -> ParsedPage:
+    """
+    Returns the cached parsed page of an InferTurn, or parses the HTML of any other turn.
+    """
+    if isinstance(turn, InferTurn):
+        return turn.parsed_page
+    return ParsedPage(turn.html)
+
+
+def get_bbox_table(turn: wl.Turn) -> Optional[BBoxTable]:
+    """
+    Returns the bboxes of the turn as a BBoxTable (InferTurns already hold one).
+    """
+    bboxes = turn.bboxes
+    if bboxes is None:
+        return None
+    return BBoxTable.validate(bboxes)
+
+
+def get_spatial_index(turn: wl.Turn) -> Optional[SpatialIndex]:
+    """
+    Returns the cached spatial index of an InferTurn, or builds one for any other turn.
+    """
+    if isinstance(turn, InferTurn):
+        return turn.spatial_index
+    bboxes = get_bbox_table(turn)
+    return SpatialIndex(bboxes) if bboxes is not None else None
+
+
+def get_element_uid_by_coords(turn: wl.Turn, x, y) -> Optional[str]:
+    """
+    Indexed version of `weblinx.processing.outputs.get_element_uid_by_coords`: the uid of
+    the smallest non-zero-sized element containing (x, y).
+    """
+    index = get_spatial_index(turn)
+    if not index:
+        return None
+    return index.uid_at(x, y)
+
 
 class InferTurn(wl.Turn):
     """
@@ -26,7 +153,7 @@ class InferTurn(wl.Turn):
         self,
         prev_turn: Union[PrevTurn, UserIntent],
         html: Optional[str],
-        bboxes: Optional[Dict[str, BoundingBox]],
+        bboxes: Optional[Union[BBoxTable, Dict[str, BoundingBox]]],
         metadata: Optional[Metadata],
         index: int,
         timestamp: float,
@@ -40,7 +167,19 @@ class InferTurn(wl.Turn):
 
         self._html = html
         self._metadata = metadata
-        self._bboxes = bboxes
+        self._bboxes = BBoxTable.validate(bboxes) if bboxes is not None else None
+        self._parsed_page = None
+        self._spatial_index = None
+
+        # Set when the payload (html & bboxes) is offloaded, see `offload_payload`
+        self._payload_state = PAYLOAD_RESIDENT
+        self._payload_blob = None
+        self._payload_path = None
+        self._payload_loader = None
+        # Whether the offloaded payload holds an html & bboxes, checked without loading it
+        self._offloaded_parts = (False, False)
+        # Keys of the html & bboxes in the session store, set by `SessionPersistence`
+        self.payload_keys = None
 
         self.utterance = self.prev_turn.utterance
 
@@ -79,10 +218,13 @@ class InferTurn(wl.Turn):
             result["properties"] = self.props
         if self.element:
             result["element"] = self.element
-        if self.scrollX:
-            result["scrollX"] = self.scrollX
-        if self.scrollY:
-            result["scrollY"] = self.scrollY
+        # 0 is a valid scroll position
+        scroll_x = getattr(self.prev_turn, "scrollX", None)
+        scroll_y = getattr(self.prev_turn, "scrollY", None)
+        if scroll_x is not None:
+            result["scrollX"] = scroll_x
+        if scroll_y is not None:
+            result["scrollY"] = scroll_y
 
         return result
 
@@ -136,13 +278,45 @@ class InferTurn(wl.Turn):
             return {}
 
     @property
-    def bboxes(self) -> dict:
+    def bboxes(self) -> Optional[BBoxTable]:
+        self._load_payload()
         return self._bboxes
 
     @property
     def html(self) -> str:
+        self._load_payload()
         return self._html
 
+    @html.setter
+    def html(self, html: str):
+        self._load_payload()
+        self._html = html
+        self._parsed_page = None
+        self.payload_keys = None
+
+    @property
+    def parsed_page(self) -> Optional[ParsedPage]:
+        """
+        Parsed DOM of the HTML, built on first access and reset when the HTML changes.
+        """
+        if self.html is None:
+            return None
+        if self._parsed_page is None:
+            self._parsed_page = ParsedPage(self._html)
+        return self._parsed_page
+
+    @property
+    def spatial_index(self) -> Optional[SpatialIndex]:
+        """
+        Spatial index of the bboxes, built on first access.
+        """
+        bboxes = self.bboxes
+        if bboxes is None:
+            return None
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex(bboxes)
+        return self._spatial_index
+
     @property
     def speaker(self) -> str:
         if isinstance(self.prev_turn, UserIntent):
@@ -153,14 +327,158 @@ class InferTurn(wl.Turn):
         # Prev turn is already validated
         return True
 
+    def estimate_nbytes(self, seen: Optional[set] = None) -> int:
+        """
+        Rough estimate of the memory held by the turn, dominated by the HTML & bboxes.
+
+        Parameters:
+        -------------
+        seen: set
+            `id()` of the HTML & bboxes already counted, e.g. by the turns before in the
+            replay: the turns of a request share the same HTML string & bboxes table.
+        """
+        if seen is None:
+            seen = set()
+        nbytes = TURN_NBYTES
+        if self._html is not None:
+            if id(self._html) not in seen:
+                seen.add(id(self._html))
+                nbytes += len(self._html)
+            if self._parsed_page is not None:
+                nbytes += PARSED_PAGE_NBYTES_PER_CHAR * len(self._html)
+        if isinstance(self._bboxes, BBoxTable):
+            if id(self._bboxes) not in seen:
+                seen.add(id(self._bboxes))
+                nbytes += self._bboxes.nbytes
+            if self._spatial_index is not None:
+                nbytes += self._spatial_index.nbytes
+        elif self._bboxes is not None:
+            nbytes += BBOX_NBYTES * len(self._bboxes)
+        if self._payload_blob is not None:
+            nbytes += len(self._payload_blob)
+        return nbytes
+
+    @property
+    def payload_state(self) -> str:
+        return self._payload_state
+
+    def offload_payload(self, mode: str, spill_dir: Optional[str] = None):
+        """
+        Releases the HTML, bboxes and parsed page of the turn.
+
+        Parameters:
+        -------------
+        mode: str
+            `drop` releases the payload for good, `compress` keeps it compressed in memory
+            and `spill` writes it compressed to `spill_dir`. Compressed / spilled payloads
+            are loaded back when `html` or `bboxes` is accessed.
+        spill_dir: str
+            Directory of the spilled payloads, required with `spill`.
+        """
+        if self._payload_state != PAYLOAD_RESIDENT:
+            return
+        if (self._html is None) and (self._bboxes is None):
+            return
+
+        if mode == "drop":
+            state = PAYLOAD_DROPPED
+        elif mode in ["compress", "spill"]:
+            blob = encode_payload(self._html, self._bboxes)
+            if mode == "compress":
+                state = PAYLOAD_COMPRESSED
+                self._payload_blob = blob
+            else:
+                state = PAYLOAD_SPILLED
+                # Not named after the session: its id comes from the client
+                self._payload_path = os.path.join(spill_dir, f"{uuid.uuid4().hex}.npz")
+                with open(self._payload_path, "wb") as f:
+                    f.write(blob)
+        else:
+            raise ValueError(f"Unknown payload retention mode `{mode}`.")
+
+        self._offloaded_parts = (self._html is not None, self._bboxes is not None)
+        self._html = None
+        self._bboxes = None
+        self._parsed_page = None
+        self._spatial_index = None
+        self._payload_state = state
+
+    def store_payload(
+        self,
+        load_fn: Callable[[], Tuple[Optional[str], Optional[BBoxTable]]],
+        payload_keys: Tuple[Optional[str], Optional[str]],
+    ):
+        """
+        Releases the payload, kept in the session store under `payload_keys` (html, bboxes):
+        `load_fn` loads it back when `html` or `bboxes` is accessed.
+        """
+        self.payload_keys = payload_keys
+        self._offloaded_parts = tuple(key is not None for key in payload_keys)
+        self._html = None
+        self._bboxes = None
+        self._parsed_page = None
+        self._spatial_index = None
+        self._payload_loader = load_fn
+        self._payload_state = PAYLOAD_STORED
+
+    def read_payload(self) -> Tuple[Optional[str], Optional[BBoxTable]]:
+        """
+        The html & bboxes of the turn, without loading an offloaded payload back in memory.
+        """
+        if self._payload_state == PAYLOAD_STORED:
+            return self._payload_loader()
+        if self._payload_state == PAYLOAD_COMPRESSED:
+            blob = self._payload_blob
+        elif self._payload_state == PAYLOAD_SPILLED:
+            with open(self._payload_path, "rb") as f:
+                blob = f.read()
+        else:
+            return self._html, self._bboxes
+        return decode_payload(blob)
+
+    def _load_payload(self):
+        if self._payload_state not in [
+            PAYLOAD_COMPRESSED,
+            PAYLOAD_SPILLED,
+            PAYLOAD_STORED,
+        ]:
+            return
+
+        logging.debug(f"Rehydrating {self._payload_state} payload of {self}")
+        self._html, self._bboxes = self.read_payload()
+        self.discard_offloaded_payload()
+
+    def discard_offloaded_payload(self):
+        """
+        Frees the compressed / spilled copy of the payload, if any.
+        """
+        if self._payload_path is not None:
+            try:
+                os.remove(self._payload_path)
+            except FileNotFoundError:
+                pass
+        self._payload_blob = None
+        self._payload_path = None
+        self._payload_loader = None
+        if self._payload_state != PAYLOAD_DROPPED:
+            self._payload_state = PAYLOAD_RESIDENT
+
     def has_screenshot(self):
         raise NotImplementedError
 
+    def _is_offloaded(self) -> bool:
+        return self._payload_state in [PAYLOAD_COMPRESSED, PAYLOAD_SPILLED, PAYLOAD_STORED]
+
     def has_html(self) -> bool:
+        if self._is_offloaded():
+            return self._offloaded_parts[0]
         return self._html is not None
 
     def has_bboxes(self, subdir: str = "bboxes", page_subdir: str = "pages"):
-        return self.bboxes is not None
+        # Does not load an offloaded payload back
+        if self._is_offloaded():
+            return self._offloaded_parts[1]
+        return self._bboxes is not None
 
     def get_screenshot_path(
         self,
@@ -193,10 +511,8 @@ class InferTurn(wl.Turn):
         if not self.html:
             return {}
 
-        tree = lxml.html.fromstring(self._html)
-        root = tree.getroottree()
-
-        elems = root.xpath(f"//*[@{uid_key}]")
+        page = self.parsed_page
+        elems = page.get_elements(uid_key)
 
         logging.debug(f"xpath:  //*[@{uid_key}]")
 
@@ -207,7 +523,7 @@ class InferTurn(wl.Turn):
 
         for elem in elems:
             uid = elem.attrib[uid_key]
-            xpath = root.getpath(elem)
+            xpath = page.get_xpath(elem)
             xpaths[uid] = xpath
 
         logging.debug(f"xpaths ({len(xpaths)}): {list(xpaths.keys())[:10]}")
@@ -223,22 +539,21 @@ class InferTurn(wl.Turn):
         if not self.html:
             return ""
 
-        tree = lxml.html.fromstring(self._html)
-        root = tree.getroottree()
-
-        elems = root.xpath(f'//*[@{uid_key}="{uid}"]')
+        page = self.parsed_page
+        elem = page.get_element(uid, uid_key)
 
-        if len(elems) == 0:
+        if elem is None:
             return ""
 
-        return root.getpath(elems[0])
+        return page.get_xpath(elem)
 
     def get_element_bbox(self, uid: str):
+        bboxes = self.bboxes
 
-        logging.debug(f"Bboxes ({len(self._bboxes)}: {list(self._bboxes.keys())[:10]}")
+        logging.debug(f"Bboxes ({len(bboxes)}: {bboxes.uids[:10].tolist()}")
 
-        if uid in self._bboxes:
-            return self._bboxes[uid]
+        if uid in bboxes:
+            return BoundingBox(**bboxes[uid])
         else:
             logging.debug(f"Could not find UID {uid} in bboxes.")
             return BoundingBox(
@@ -246,6 +561,52 @@ class InferTurn(wl.Turn):
             )
 
 
+class PayloadRetention:
+    """
+    Policy keeping the HTML & bboxes of only the last `keep_last_n` turns of a replay.
+    Prompts only use the payload of the current turn, older turns are only formatted
+    from their intent / element / utterance.
+    """
+
+    def __init__(
+        self,
+        keep_last_n: int = 2,
+        mode: str = "drop",
+        spill_dir: Optional[str] = None,
+    ):
+        """
+        Parameters:
+        -------------
+        keep_last_n: int
+            Number of most recent turns keeping their payload.
+        mode: str
+            How older payloads are released, see `InferTurn.offload_payload`.
+        spill_dir: str
+            Directory of the spilled payloads, defaults to a new private directory in the
+            temp dir.
+        """
+        if mode not in ["drop", "compress", "spill"]:
+            raise ValueError(f"Unknown payload retention mode `{mode}`.")
+
+        self.keep_last_n = max(1, keep_last_n)
+        self.mode = mode
+        self.spill_dir = None
+        if mode == "spill":
+            if spill_dir is None:
+                # Readable & writable by this user only
+                spill_dir = tempfile.mkdtemp(prefix="web-assist-payloads-")
+            self.spill_dir = spill_dir
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __str__(self):
+        return f"Keep payload of last {self.keep_last_n} turns, {self.mode} older ones"
+
+    def apply(self, turns: List[InferTurn]):
+        for turn in turns[: -self.keep_last_n]:
+            if turn.payload_state == PAYLOAD_RESIDENT:
+                turn.offload_payload(mode=self.mode, spill_dir=self.spill_dir)
+
+
 class InferReplay(wl.Replay):
     """
     Takes in the Pydantic model and simulates the wl.Replay object
@@ -255,13 +616,17 @@ class InferReplay(wl.Replay):
     def __init__(
         self,
         session_id: str,
+        retention: Optional[PayloadRetention] = None,
     ):
         self.session_id = session_id
+        self.retention = retention
         self.demo_name = session_id
         self.base_dir = "fake dir"
         self.turns = []
         self.start = datetime.now()
         self.index = 0
+        # Utterances & formatted turns for the prompts, updated as turns are added / removed
+        self.prompt_state = PromptState()
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -296,11 +661,67 @@ class InferReplay(wl.Replay):
     def from_demonstration(cls, demonstration: wl.Demonstration):
         raise NotImplementedError
 
+    @classmethod
+    def from_turns(
+        cls,
+        session_id: str,
+        turns: List[InferTurn],
+        start: datetime,
+        retention: Optional[PayloadRetention] = None,
+    ) -> "InferReplay":
+        """
+        Rebuilds a replay from its turns, e.g. loaded from the session store.
+        """
+        replay = cls(session_id=session_id, retention=retention)
+        replay.start = start
+        replay.turns = list(turns)
+        replay.index = len(replay.turns)
+        replay.prompt_state = PromptState.from_turns(replay.turns)
+        if retention is not None:
+            retention.apply(replay.turns)
+        return replay
+
+    def estimate_nbytes(self) -> int:
+        """
+        Rough estimate of the memory held by all the turns of the replay, shared payloads
+        counted once.
+        """
+        seen = set()
+        return sum(t.estimate_nbytes(seen) for t in self.turns)
+
+    def get_memory_stats(self) -> Dict[str, Any]:
+        payload_turns = {
+            state: 0
+            for state in [
+                PAYLOAD_RESIDENT,
+                PAYLOAD_DROPPED,
+                PAYLOAD_COMPRESSED,
+                PAYLOAD_SPILLED,
+                PAYLOAD_STORED,
+            ]
+        }
+        for t in self.turns:
+            if t.payload_state != PAYLOAD_RESIDENT or t.has_html():
+                payload_turns[t.payload_state] += 1
+
+        return {
+            "turns": len(self),
+            "resident_bytes": self.estimate_nbytes(),
+            "payload_turns": payload_turns,
+        }
+
+    def close(self):
+        """
+        Removes the spilled payloads of the turns.
+        """
+        for t in self.turns:
+            t.discard_offloaded_payload()
+
     def buildInferTurn(
         self,
         turn: Union[PrevTurn, UserIntent],
         html: Optional[str],
-        bboxes: Optional[Dict[str, BoundingBox]],
+        bboxes: Optional[BBoxTable],
         metadata: Optional[Metadata],
     ) -> InferTurn:
         """
@@ -330,6 +751,10 @@ class InferReplay(wl.Replay):
         turn.index = self.index
         self.turns.append(turn)
         self.index += 1
+        self.prompt_state.on_add(turn)
+
+        if self.retention is not None:
+            self.retention.apply(self.turns)
 
         logging.info(
             f"Added Turn `[{turn.speaker}] - {turn.intent}` into Replay at index {turn.index} "
@@ -339,7 +764,7 @@ class InferReplay(wl.Replay):
         self,
         prev_turn: Union[PrevTurn, UserIntent],
         html: Optional[str],
-        bboxes: Optional[Dict[str, BoundingBox]],
+        bboxes: Optional[BBoxTable],
         metadata: Optional[Metadata],
     ):
         """
@@ -352,6 +777,7 @@ class InferReplay(wl.Replay):
         """Removes the last infer turn"""
         prev_turn = self.turns.pop()
         self.index -= 1
+        self.prompt_state.on_remove(prev_turn)
 
         logging.info(
             f"Removing turn `[{prev_turn.speaker}] - {prev_turn.intent}` from Replay at index {prev_turn.index} "
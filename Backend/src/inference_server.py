@@ -0,0 +1,226 @@
+"""
+Inference process of the multi-process mode (see `serve.py`).
+
+It owns the DMR & the action model and serves them to the worker processes over a unix
+socket, in the formats of their remote clients:
+    - `POST /dmr`: sentence-similarity scores (HuggingFace Inference API format, `HF_DMR`);
+    - `POST /generate` & `POST /generate_stream`: text-generation-inference format
+      (`RemoteActionAgent`).
+The calls of all the workers go through the cross-session batchers & the embedding cache of
+the models, the same way as the requests of a single process server.
+"""
+
+import asyncio
+import hydra
+import logging
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from functools import partial
+from omegaconf import OmegaConf
+from pydantic import BaseModel
+from typing import Any, Dict, List
+
+from InferenceExecutor import InferenceExecutor
+from Metrics import REGISTRY
+from ModelFactory import (
+    build_action_agent,
+    build_dmr,
+    get_action_stats,
+    get_dmr_stats,
+)
+from ModelLoader import ModelLoader, ModelNotReadyError, StartupTimer
+from RuntimeConfig import RuntimeConfig, read_config_overrides
+from Streaming import ActionStreamMonitor, EventStream
+
+app = FastAPI()
+
+
+### Setup #############
+startup = StartupTimer()
+
+with startup.phase("config"):
+    hydra.initialize(config_path="./", version_base=None)
+    # The models of this process are always the local ones
+    overrides = [
+        o
+        for o in read_config_overrides()
+        if not o.startswith(("dmr.remote.", "action.remote."))
+    ]
+    cfg = hydra.compose(
+        config_name="config",
+        overrides=overrides + ["dmr.remote.enabled=False", "action.remote.enabled=False"],
+    )
+
+    logger = logging.getLogger(__name__)
+    logger.info(OmegaConf.to_yaml(cfg))
+
+    runtime_config = RuntimeConfig.from_cfg(cfg)
+    runtime_config.report()
+
+dmr_loader = ModelLoader(
+    "dmr", partial(build_dmr, cfg, runtime_config, startup), timer=startup
+)
+action_loader = ModelLoader(
+    "action", partial(build_action_agent, cfg, runtime_config, startup), timer=startup
+)
+model_loaders = [dmr_loader, action_loader]
+
+executor = InferenceExecutor(
+    stage_workers={
+        "dmr": cfg.executor.dmr_workers,
+        "generation": cfg.executor.generation_workers,
+    }
+)
+
+# Streamed generations, referenced until they finish
+background_tasks = set()
+
+
+class SimilarityInputs(BaseModel):
+    source_sentence: str
+    sentences: List[str]
+
+
+class SimilarityRequest(BaseModel):
+    inputs: SimilarityInputs
+
+
+class GenerationRequest(BaseModel):
+    inputs: str
+    # Decoding settings of the client, the ones of the config are used
+    parameters: Dict[str, Any] = {}
+
+
+@app.on_event("startup")
+async def start_loading_models():
+    """
+    Loads the models in the background (`lazy` loads them on the first call), the workers
+    wait for `GET /v1/health/ready`.
+    """
+    if runtime_config.startup.mode == "lazy":
+        return
+    for loader in model_loaders:
+        loader.start()
+    if runtime_config.startup.mode == "eager":
+        await asyncio.gather(*(loader.aget() for loader in model_loaders))
+        startup.mark("ready")
+
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown(wait=False)
+
+
+async def get_model(loader: ModelLoader):
+    try:
+        return await loader.aget(runtime_config.startup.load_timeout_s)
+    except ModelNotReadyError as e:
+        # Retried by the clients of the workers
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.get("/v1/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+
+@app.get("/v1/health/ready")
+async def readiness():
+    ready = all(loader.ready for loader in model_loaders)
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "not_ready",
+            "models": {loader.name: loader.get_stats() for loader in model_loaders},
+        },
+        status_code=200 if ready else 503,
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/v1/stats")
+async def get_stats():
+    stats = {
+        "executor": executor.get_stats(),
+        "inference": {},
+        "startup": {
+            "phases": startup.get_stats(),
+            "models": {loader.name: loader.get_stats() for loader in model_loaders},
+        },
+    }
+    if dmr_loader.ready:
+        stats.update(get_dmr_stats(dmr_loader.get(), stats["inference"]))
+    if action_loader.ready:
+        stats.update(get_action_stats(action_loader.get(), stats["inference"]))
+    return stats
+
+
+def score_sentences(dmr_model, source_sentence: str, sentences: List[str]) -> List[float]:
+    records = [{"doc": sentence} for sentence in sentences]
+    return dmr_model.score_records(source_sentence, records).tolist()
+
+
+def generate_text(
+    action_agent, model_input: str, monitor: ActionStreamMonitor = None
+) -> str:
+    # The prompt was truncated by the worker, its length is the cost of its batch
+    num_tokens = len(action_agent.tokenizer.tokenize(model_input))
+    return action_agent.complete(model_input, num_tokens, monitor=monitor)
+
+
+@app.post("/dmr")
+async def post_dmr(request: SimilarityRequest) -> List[float]:
+    dmr_model = await get_model(dmr_loader)
+    return await executor.run(
+        "dmr",
+        score_sentences,
+        dmr_model,
+        request.inputs.source_sentence,
+        request.inputs.sentences,
+    )
+
+
+@app.post("/generate")
+async def post_generate(request: GenerationRequest):
+    action_agent = await get_model(action_loader)
+    text = await executor.run("generation", generate_text, action_agent, request.inputs)
+    return {"generated_text": text}
+
+
+@app.post("/generate_stream")
+async def post_generate_stream(request: GenerationRequest):
+    """
+    Streams the generated text as `token` events until the action is complete.
+    """
+    action_agent = await get_model(action_loader)
+    events = EventStream()
+    monitor = ActionStreamMonitor(
+        lambda text: events.emit("token", {"token": {"text": text, "special": False}})
+    )
+
+    async def run():
+        try:
+            text = await executor.run(
+                "generation", generate_text, action_agent, request.inputs, monitor
+            )
+            events.emit("end", {"generated_text": text})
+        except Exception as e:
+            logger.exception("Streamed generation failed.")
+            events.emit("error", {"error": repr(e)})
+        finally:
+            events.close()
+
+    # Runs to the end even if the worker disconnects, the action is short
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return StreamingResponse(
+        events.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
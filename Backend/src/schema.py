@@ -2,6 +2,8 @@ from enum import Enum
 from typing import Any, Optional, Dict, Union, List
 from pydantic import BaseModel, validator, model_validator
 
+from BBoxTable import BBoxTable
+
 
 class GettableBaseModel(BaseModel):
 
@@ -87,6 +89,16 @@ class PrevTurn(GettableBaseModel):
     utterance: Optional[str] = None
 
 
+class PageDelta(GettableBaseModel):
+    """
+    Changes of the page against the last snapshot the server holds for the session.
+    """
+
+    base_hash: str  # `page_hash` of the last response
+    subtrees: Dict[str, str] = {}  # uid -> new outer HTML of the changed element
+    bboxes: Dict[str, Optional[BoundingBox]] = {}  # changed bboxes, None if removed
+
+
 def raise_field_error(field_name, param_name, intent):
     raise ValueError(
         f"Field `{field_name}` should be in {param_name} if intent is {intent}."
@@ -100,9 +112,12 @@ class RequestBody(GettableBaseModel):
     prev_turn: Optional[PrevTurn] = None
 
     html: Optional[str] = None
-    bboxes: Optional[Dict[str, BoundingBox]] = None
+    bboxes: Optional[BBoxTable] = None  # validated in bulk, see BBoxTable
     metadata: Optional[Metadata] = None
 
+    # Sent instead of `html` & `bboxes` in incremental mode
+    page_delta: Optional[PageDelta] = None
+
     @model_validator(mode="after")
     def validate_utterance_in_user_say_intent(self):
         intent = self.user_intent.intent
@@ -112,6 +127,17 @@ class RequestBody(GettableBaseModel):
 
         return self
 
+    @model_validator(mode="after")
+    def validate_page_delta_or_full_page(self):
+        if (self.page_delta is not None) and (
+            (self.html is not None) or (self.bboxes is not None)
+        ):
+            raise ValueError(
+                "Send either `page_delta` or the full page (`html` & `bboxes`), not both."
+            )
+
+        return self
+
     @model_validator(mode="after")
     def validate_required_fields_in_param(self):
 
@@ -138,10 +164,12 @@ class RequestBody(GettableBaseModel):
             BrowserIntentEnum.textInput,
         ]
         if intent in browser_intents:
-            if not self.html:
-                raise_field_error("html", "prev_turn", intent)
-            if not self.bboxes:
-                raise_field_error("bboxes", "prev_turn", intent)
+            # With a delta, the page is rebuilt from the one held by the server
+            if self.page_delta is None:
+                if not self.html:
+                    raise_field_error("html", "prev_turn", intent)
+                if not self.bboxes:
+                    raise_field_error("bboxes", "prev_turn", intent)
             if not self.metadata:
                 raise_field_error("metadata", "prev_turn", intent)
 
@@ -157,9 +185,10 @@ class RequestBody(GettableBaseModel):
 
         # Check for scroll
         if intent in BrowserIntentEnum.scroll:
-            if not self.prev_turn.scrollX:
+            # 0 is a valid scroll position
+            if self.prev_turn.scrollX is None:
                 raise_field_error("scrollX", "prev_turn", intent)
-            if not self.prev_turn.scrollY:
+            if self.prev_turn.scrollY is None:
                 raise_field_error("scrollY", "prev_turn", intent)
 
         return self
@@ -172,3 +201,6 @@ class ResponseBody(GettableBaseModel):
     intent: BrowserIntentEnum
     args: Dict[str, Any]
     element: Optional[Any]
+
+    # Hash of the page the server holds for the session, base of the next `page_delta`
+    page_hash: Optional[str] = None
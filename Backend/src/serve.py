@@ -0,0 +1,153 @@
+"""
+Multi-process server.
+
+`server.py` runs in a single process: the parsing, validation & prompt building of every
+request share one GIL. This launcher runs:
+    - one inference process (`inference_server.py`) that loads the models once and batches the
+      calls of all the workers,
+    - `serving.workers` worker processes (`server.py`) that do the per-request CPU work and
+      call the inference process over a unix socket, through the remote DMR & action clients,
+    - a session router (`SessionRouter.py`) on `serving.host`:`serving.port`, that sends all the
+      requests of a session to the same worker, where its `InferReplay` lives.
+
+Usage, from `Backend/src`: `python serve.py [hydra overrides ...]`
+"""
+
+import hydra
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uvicorn
+
+from omegaconf import OmegaConf
+from typing import List
+
+from RuntimeConfig import OVERRIDES_ENV, encode_config_overrides
+from SessionRouter import SessionRouter, build_router_app
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The worker calls reach the inference process through its socket, the host is not resolved
+INFERENCE_URL = "http://inference"
+
+# Features of the local action model, disabled in the workers
+WORKER_DISABLED_FEATURES = ["prefix_cache", "constrained_decoding"]
+
+
+def quote_override(value: str) -> str:
+    """
+    Quoted hydra override value, e.g. a path with spaces or commas.
+    """
+    return "'" + value.replace("'", "\\'") + "'"
+
+
+def worker_overrides(inference_socket: str) -> List[str]:
+    """
+    Hydra overrides of the workers: both models are the ones of the inference process, and
+    the features that need the local model are disabled.
+    """
+    return [
+        "dmr.remote.enabled=True",
+        f"dmr.remote.api_url={INFERENCE_URL}/dmr",
+        f"dmr.remote.uds={quote_override(inference_socket)}",
+        "action.remote.enabled=True",
+        f"action.remote.api_url={INFERENCE_URL}",
+        f"action.remote.uds={quote_override(inference_socket)}",
+        "action.remote.auth_token_env=null",
+    ] + [f"action.{feature}.enabled=False" for feature in WORKER_DISABLED_FEATURES]
+
+
+def warn_disabled_features(cfg):
+    """
+    The features of `WORKER_DISABLED_FEATURES` need the local model, they are off in this mode.
+    """
+    enabled = [f for f in WORKER_DISABLED_FEATURES if cfg.action[f].enabled]
+    if enabled:
+        logging.warning(
+            f"`action.{'`, `action.'.join(enabled)}` enabled in the config, but not supported "
+            "by the multi-process server: the workers run without "
+            f"{' & '.join(f.replace('_', ' ') for f in enabled)}. Run `server.py` to use them."
+        )
+
+
+def start_process(app: str, socket: str, overrides: List[str]) -> subprocess.Popen:
+    env = dict(os.environ, **{OVERRIDES_ENV: encode_config_overrides(overrides)})
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--uds", socket],
+        cwd=SRC_DIR,
+        env=env,
+    )
+
+
+def watch_processes(processes: List[subprocess.Popen], poll_s: float = 1.0):
+    """
+    Stops the router when a process exits: the server cannot run without any of them.
+    """
+    while True:
+        for process in processes:
+            if process.poll() is not None:
+                logging.error(
+                    f"Process {process.args} exited with code {process.returncode}, stopping."
+                )
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+        time.sleep(poll_s)
+
+
+def stop_processes(processes: List[subprocess.Popen], timeout_s: float = 10.0):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout_s)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(overrides: List[str]):
+    hydra.initialize(config_path="./", version_base=None)
+    cfg = hydra.compose(config_name="config", overrides=overrides)
+    serving = cfg.serving
+    logging.info(OmegaConf.to_yaml(serving))
+    warn_disabled_features(cfg)
+
+    socket_dir = serving.socket_dir or tempfile.mkdtemp(prefix="webassist-")
+    os.makedirs(socket_dir, exist_ok=True)
+    inference_socket = os.path.join(socket_dir, "inference.sock")
+    worker_sockets = [
+        os.path.join(socket_dir, f"worker-{i}.sock") for i in range(serving.workers)
+    ]
+
+    processes = [start_process("inference_server:app", inference_socket, overrides)]
+    for socket in worker_sockets:
+        processes.append(
+            start_process(
+                "server:app", socket, overrides + worker_overrides(inference_socket)
+            )
+        )
+    threading.Thread(
+        target=watch_processes, args=(processes,), name="watch-processes", daemon=True
+    ).start()
+
+    router = SessionRouter.from_sockets(
+        worker_sockets,
+        inference_socket,
+        connect_timeout_s=serving.connect_timeout_s,
+    )
+    try:
+        uvicorn.run(build_router_app(router), host=serving.host, port=serving.port)
+    except OSError as e:
+        print(f"Failed to bind to port: {e}")
+    finally:
+        stop_processes(processes)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
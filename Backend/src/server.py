@@ -1,26 +1,41 @@
+import asyncio
 import hydra
 import json
 import logging
+import time
 import traceback
 import uvicorn
-import weblinx as wl
 
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from functools import partial
 from omegaconf import OmegaConf
-from threading import Lock
-from typing import List, Optional, Union
-
-from ActionAgent import ActionAgent
-from DMR import DMR
+from typing import Dict, List, Optional, Union
+
+from InferenceExecutor import InferenceExecutor
+from Metrics import REGISTRY
+from ModelFactory import (
+    build_action_agent,
+    build_dmr,
+    get_action_stats,
+    get_dmr_stats,
+)
+from ModelLoader import ModelLoader, ModelNotReadyError, StartupTimer
+from PageSnapshot import PageDeltaError, PageSnapshot
+from RuntimeConfig import RuntimeConfig, read_config_overrides
+from SessionPersistence import SessionConflictError, SessionPersistence, build_store
+from SessionStore import SessionEvictedError, SessionStore
+from Streaming import EventStream
+from Tracing import REQUEST_DURATION, REQUESTS, set_trace_attributes, start_trace
 from schema import (
     ResponseBody,
     RequestBody,
     UserIntentEnum,
     BrowserIntentEnum,
 )
-from WebLinxHelper import InferReplay
+from WebLinxHelper import InferReplay, PayloadRetention
 
 app = FastAPI()
 
@@ -36,35 +51,90 @@ app.add_middleware(
 
 
 ### Setup #############
-hydra.initialize(config_path="./", version_base=None)
-cfg = hydra.compose(config_name="config")
-
-# Logger setup
-logger = logging.getLogger(__name__)
-logger.info(OmegaConf.to_yaml(cfg))
-
-## Setup DMR model
-dmr_model = DMR(
-    name=cfg.dmr.model,
-    sim_method=cfg.dmr.get("similarity", "cos_sim"),
-    use_bf16=cfg.dmr.use_bf16,
-    batch_size_per_device=cfg.dmr.batch_size_per_device,
-)
+startup = StartupTimer()
+
+with startup.phase("config"):
+    hydra.initialize(config_path="./", version_base=None)
+    # Hydra overrides, e.g. smaller models for benchmarks
+    cfg = hydra.compose(config_name="config", overrides=read_config_overrides())
+
+    # Logger setup
+    logger = logging.getLogger(__name__)
+    logger.info(OmegaConf.to_yaml(cfg))
+
+    # Fails the startup on invalid model settings
+    runtime_config = RuntimeConfig.from_cfg(cfg)
+    runtime_config.report()
+    if cfg.action.remote.enabled and (
+        cfg.action.prefix_cache.enabled or cfg.action.constrained_decoding.enabled
+    ):
+        raise ValueError(
+            "The prefix cache & constrained decoding run on the local model, "
+            "disable them to use `action.remote`."
+        )
 
-## Setup Action Agent
-action_agent = ActionAgent(
-    tokenizer=cfg.action.tokenizer,
-    model=cfg.action.model,
-    use_rope=cfg.action.use_rope,
-    use_flash_attention_2=cfg.action.use_flash_attention_2,
-    max_out_len=cfg.action.max_out_len,
-    batch_size_per_device=cfg.action.batch_size_per_device,
-)
 
+## Setup the models, loaded by `ModelLoader`s (see `startup.mode`)
+dmr_loader = ModelLoader(
+    "dmr", partial(build_dmr, cfg, runtime_config, startup), timer=startup
+)
+action_loader = ModelLoader(
+    "action", partial(build_action_agent, cfg, runtime_config, startup), timer=startup
+)
+model_loaders = [dmr_loader, action_loader]
+
+
+with startup.phase("server"):
+    ## Setup worker pools for the blocking stages
+    executor = InferenceExecutor(
+        stage_workers={
+            "dmr": cfg.executor.dmr_workers,
+            "prompt": cfg.executor.prompt_workers,
+            "session": cfg.executor.session_workers,
+            "generation": cfg.executor.generation_workers,
+        }
+    )
+
+    ## Setup the persistence of the sessions, if enabled
+    session_persistence = None
+    persistence = cfg.session.persistence
+    if persistence.backend is not None:
+        session_persistence = SessionPersistence(
+            store=build_store(
+                persistence.backend,
+                sqlite_path=persistence.sqlite_path,
+                redis_url=persistence.redis_url,
+            ),
+            ttl_seconds=persistence.ttl_seconds,
+            key_prefix=persistence.key_prefix,
+        )
 
-# Dictionary to store session locks and replays
-session_locks = {}
-stored_replays = {}
+    ## Setup the store of session locks and replays
+    session_store = SessionStore(
+        ttl_seconds=cfg.session.ttl_seconds,
+        max_sessions=cfg.session.max_sessions,
+        max_bytes=(
+            cfg.session.max_mb * 1024 * 1024 if cfg.session.max_mb is not None else None
+        ),
+        retention=PayloadRetention(
+            keep_last_n=cfg.session.retention.keep_last_n,
+            mode=cfg.session.retention.mode,
+            spill_dir=cfg.session.retention.spill_dir,
+        ),
+        token_cache_entries=cfg.session.token_cache_entries,
+        # Sessions evicted from memory are loaded back from the persistence
+        max_evicted_ids=0 if session_persistence is not None else 10000,
+    )
+
+
+# Top candidates sent in the `candidates` event of the streaming endpoint
+STREAMED_CANDIDATES = 5
+
+# Streaming requests, referenced until they finish
+background_tasks = set()
+
+# Scraped & probed paths, left out of the traces and request metrics
+UNTRACED_PATHS = {"/metrics", "/v1/health/live", "/v1/health/ready"}
 
 BrowserIntentsWithElements = [
     BrowserIntentEnum.change,
@@ -74,36 +144,302 @@ BrowserIntentsWithElements = [
 ]
 
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Traces each request: its spans are logged as one JSON line (logger `tracing`) and its
+    latency is recorded in the `/metrics` histograms. The trace ID is returned in the
+    `X-Trace-Id` header.
+    """
+    path = request.url.path
+    if path in UNTRACED_PATHS:
+        return await call_next(request)
+
+    status = 500
+    started = time.perf_counter()
+    try:
+        with start_trace("request", method=request.method, path=path) as root:
+            response = await call_next(request)
+            status = response.status_code
+            root.set(status_code=status)
+            response.headers["X-Trace-Id"] = root.trace.trace_id
+            return response
+    finally:
+        # Labelled by route template: each unknown path (404 probes, ...) would be a new series
+        route = request.scope.get("route")
+        label = route.path if route is not None else "other"
+        REQUEST_DURATION.observe(time.perf_counter() - started, path=label, status=status)
+        REQUESTS.inc(path=label, status=status)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Latency histograms of the requests and their stages, in the Prometheus text format.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("startup")
+async def start_loading_models():
+    """
+    `eager`: serves once the models are loaded. `background`: serves right away while the
+    models load. `lazy`: each model is loaded by the first request that needs it.
+    """
+    if runtime_config.startup.mode == "lazy":
+        return
+
+    for loader in model_loaders:
+        loader.start()
+    if runtime_config.startup.mode == "eager":
+        await wait_until_ready()
+    else:
+        task = asyncio.create_task(wait_until_ready())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def wait_until_ready():
+    try:
+        await asyncio.gather(*(loader.aget() for loader in model_loaders))
+    except ModelNotReadyError as e:
+        if runtime_config.startup.mode == "eager":
+            raise
+        # The next requests retry the load
+        logger.error(str(e))
+        return
+    record_ready()
+
+
+def record_ready():
+    if "ready" not in startup.get_stats():
+        startup.mark("ready")
+
+
+async def get_models():
+    """
+    Returns the DMR & the action agent, waiting up to `startup.load_timeout_s` for them to
+    load. Raises `ModelNotReadyError` otherwise.
+    """
+    timeout = runtime_config.startup.load_timeout_s
+    dmr_model, action_agent = await asyncio.gather(
+        dmr_loader.aget(timeout), action_loader.aget(timeout)
+    )
+    record_ready()
+    return dmr_model, action_agent
+
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown(wait=False)
+
+
 @app.post("/v1/hello")
 async def hello_world():
     return {"message": "Hello, World!"}
 
 
+@app.get("/v1/health/live")
+async def liveness():
+    """
+    The server is up, even if the models are still loading.
+    """
+    return {"status": "alive"}
+
+
+@app.get("/v1/health/ready")
+async def readiness():
+    """
+    200 once the server can predict actions, 503 otherwise. The models must be loaded, except
+    in `lazy` mode where they load on the first request (only a failed load is not ready).
+    """
+    if runtime_config.startup.mode == "lazy":
+        ready = not any(loader.failed for loader in model_loaders)
+    else:
+        ready = all(loader.ready for loader in model_loaders)
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "not_ready",
+            "mode": runtime_config.startup.mode,
+            "models": {loader.name: loader.get_stats() for loader in model_loaders},
+        },
+        status_code=200 if ready else 503,
+    )
+
+
+@app.get("/v1/stats")
+async def get_stats():
+    stats = {
+        "config": runtime_config.get_stats(),
+        "executor": executor.get_stats(),
+        "inference": {},
+        "sessions": session_store.get_stats(),
+    }
+    if session_persistence is not None:
+        stats["persistence"] = session_persistence.get_stats()
+    stats["startup"] = {
+        "mode": runtime_config.startup.mode,
+        "phases": startup.get_stats(),
+        "models": {loader.name: loader.get_stats() for loader in model_loaders},
+    }
+    if dmr_loader.ready:
+        stats.update(get_dmr_stats(dmr_loader.get(), stats["inference"]))
+    if action_loader.ready:
+        stats.update(get_action_stats(action_loader.get(), stats["inference"]))
+    return stats
+
+
+def resolve_page(snapshot: Optional[PageSnapshot], request_body: RequestBody):
+    """
+    Returns the page snapshot of the request: the full page sent by the client, or the
+    snapshot held by the server with the client's delta applied.
+    """
+    if request_body.page_delta is not None:
+        if snapshot is None:
+            raise PageDeltaError(
+                "Received a page delta but the server holds no page for this session. "
+                "Please resend the full page."
+            )
+        return snapshot.apply_delta(request_body.page_delta, request_body.uid_key)
+
+    if request_body.html is not None:
+        return PageSnapshot(html=request_body.html, bboxes=request_body.bboxes)
+
+    return None
+
+
+def restore_session(session):
+    """
+    Loads the session from the persistence if another server saved a newer revision. Serves
+    from memory if the store is unavailable.
+    """
+    try:
+        session_persistence.restore(session)
+    except Exception:
+        logger.exception(f"Could not load session `{session.session_id}` from the store.")
+
+
+def save_session(session):
+    try:
+        session_persistence.save(session)
+    except SessionConflictError:
+        # Another server saved the session first: its history is loaded, and the client resends
+        # the turn
+        restore_session(session)
+        raise
+    except Exception:
+        logger.exception(f"Could not save session `{session.session_id}` to the store.")
+
+
+def rank_candidates(dmr_model, replay: InferReplay, turn, uid_key: str):
+    """
+    Runs the DMR stage: builds the query and the records of the turn, then keeps the best
+    ranked ones. Returns them with the number of records.
+    """
+    dmr_query = dmr_model.build_query(replay=replay, turn=turn)
+    dmr_records = dmr_model.build_records(
+        turn=turn,
+        uid_key=uid_key,
+    )
+    cands_turn = dmr_model.rank_top_k(
+        query=dmr_query,
+        records=dmr_records,
+        k=runtime_config.candidates.k,
+        full_ranks=runtime_config.candidates.full_ranks,
+    )
+    return cands_turn, len(dmr_records)
+
+
 @app.post("/v1/get_next_action", response_model=ResponseBody)
 async def get_next_action(request_body: RequestBody):
-    # Validate the request body using Pydantic model
+    return await predict_next_action(request_body)
+
+
+@app.post("/v1/stream_next_action")
+async def stream_next_action(request_body: RequestBody):
+    """
+    Same as `/v1/get_next_action`, as server-sent events: `candidates` once the DMR ranked the
+    elements, `prompt` once the prompt is built, `token` as the action is generated, then the
+    `action` (or an `error`). The generation stops as soon as the action is complete.
+    """
+    events = EventStream()
+
+    async def run():
+        try:
+            response = await predict_next_action(request_body, events)
+            events.emit("action", response.model_dump(mode="json"))
+        except HTTPException as e:
+            events.emit("error", {"status_code": e.status_code, "detail": e.detail})
+        finally:
+            events.close()
+
+    # Runs to the end even if the client disconnects, so the session stays consistent
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return StreamingResponse(
+        events.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def summarize_candidates(
+    cands_turn: List[Dict], num_records: int, top_k: int = STREAMED_CANDIDATES
+):
+    top = sorted(cands_turn, key=lambda c: c["rank"])[:top_k]
+    return {
+        "count": num_records,
+        "top": [
+            {"uid": c["uid"], "rank": c["rank"], "score": float(c["score"])} for c in top
+        ],
+    }
+
+
+async def predict_next_action(
+    request_body: RequestBody, events: Optional[EventStream] = None
+) -> ResponseBody:
+    """
+    Predicts the next action of the session, emitting the stage events if `events` is set.
+    """
     try:
 
+        dmr_model, action_agent = await get_models()
+
         session_key = request_body.sessionID
 
-        # Check if session key exists, if not, create a new lock for it
-        if session_key not in session_locks:
-            session_locks[session_key] = Lock()
+        # Creates the session (lock & replay) if it does not exist
+        async with session_store.session(session_key) as session:
 
-        with session_locks[session_key]:
+            if session_persistence is not None:
+                await executor.run("session", restore_session, session)
 
-            # Create new replay object if not there
-            if session_key not in stored_replays:
-                stored_replays[session_key] = InferReplay(session_id=session_key)
-            replay = stored_replays[session_key]
+            replay = session.replay
             logger.info(f"Current replay {replay.session_id} has {len(replay)} turns.")
 
+            # Rebuild the page if the client only sent what changed
+            page = await executor.run(
+                "prompt", resolve_page, session.page_snapshot, request_body
+            )
+            html, bboxes = None, None
+            if page is not None:
+                session.page_snapshot = page
+                html, bboxes = page.html, page.bboxes
+            set_trace_attributes(
+                session_id=session_key,
+                turns=len(replay),
+                page_delta=request_body.page_delta is not None,
+                html_bytes=len(html) if html is not None else 0,
+                elements=len(bboxes) if bboxes is not None else 0,
+            )
+
             # Add prev turn if exist
             if request_body.prev_turn:
                 replay.build_add_InferTurn(
                     prev_turn=request_body.prev_turn,
-                    html=request_body.html,
-                    bboxes=request_body.bboxes,
+                    html=html,
+                    bboxes=bboxes,
                     metadata=request_body.metadata,
                 )
 
@@ -120,8 +456,8 @@ async def get_next_action(request_body: RequestBody):
             if user_intent.intent == UserIntentEnum.say:
                 curr_turn = replay.buildInferTurn(
                     turn=user_intent,
-                    html=request_body.html,
-                    bboxes=request_body.bboxes,
+                    html=html,
+                    bboxes=bboxes,
                     metadata=request_body.metadata,
                 )
             else:
@@ -134,28 +470,44 @@ async def get_next_action(request_body: RequestBody):
 
             cands_turn = None
             if curr_turn.has_html() and curr_turn.has_bboxes():
-                dmr_query = dmr_model.build_query(replay=replay, turn=curr_turn)
-                dmr_records = dmr_model.build_records(
-                    turn=curr_turn,
-                    uid_key=uid_key,
-                )
-                cands_turn = dmr_model.rank_records(
-                    query=dmr_query, records=dmr_records
+                cands_turn, num_records = await executor.run(
+                    "dmr", rank_candidates, dmr_model, replay, curr_turn, uid_key
                 )
 
                 logger.info(
-                    f"Ran DMR and ranked a total of {len(cands_turn)} candidates."
+                    f"Ran DMR on a total of {num_records} elements, "
+                    f"kept {len(cands_turn)} candidates."
                 )
+                if events is not None:
+                    events.emit(
+                        "candidates", summarize_candidates(cands_turn, num_records)
+                    )
 
             # Build prompt & predict action
-            action_prompt = action_agent.build_prompt(
+            action_prompt = await executor.run(
+                "prompt",
+                action_agent.build_prompt,
                 replay=replay,
                 turn=curr_turn,
                 cands_turn=cands_turn,
+                token_cache=session.token_cache,
             )
+            if events is not None:
+                events.emit("prompt", {"messages": len(action_prompt)})
 
-            next_action = action_agent.next_action(
-                turn=curr_turn, uid_key=uid_key, model_prompt=action_prompt
+            next_action = await executor.run(
+                "generation",
+                action_agent.next_action,
+                turn=curr_turn,
+                uid_key=uid_key,
+                model_prompt=action_prompt,
+                session_id=session_key,
+                cands_turn=cands_turn,
+                on_text=(
+                    (lambda text: events.emit("token", {"text": text}))
+                    if events is not None
+                    else None
+                ),
             )
 
             # Double check our response body
@@ -173,8 +525,32 @@ async def get_next_action(request_body: RequestBody):
 
             logger.info(f"Predicted: {next_action}")
 
+            if session.page_snapshot is not None:
+                next_action["page_hash"] = session.page_snapshot.page_hash
+
+            if session_persistence is not None:
+                await executor.run("session", save_session, session)
+
             return ResponseBody(**next_action)
 
+    except SessionEvictedError as e:
+
+        logger.warning(str(e))
+
+        raise HTTPException(status_code=410, detail=str(e))
+
+    except (PageDeltaError, SessionConflictError) as e:
+
+        logger.warning(str(e))
+
+        raise HTTPException(status_code=409, detail=str(e))
+
+    except ModelNotReadyError as e:
+
+        logger.warning(str(e))
+
+        raise HTTPException(status_code=503, detail=str(e))
+
     except Exception as e:
 
         error_message = f"Something bad happened... {traceback.format_exc()}"
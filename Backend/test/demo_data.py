@@ -0,0 +1,33 @@
+"""
+Loaders of the demo session recorded in `src/ckmtdoi`, shared by the tests.
+"""
+
+import json
+
+from pathlib import Path
+from typing import Any, Dict
+
+from BBoxTable import BBoxTable
+from schema import BoundingBox
+
+DEMO_DIR = Path(__file__).parents[1] / "src" / "ckmtdoi"
+
+
+def load_raw_bboxes(index: int = 2) -> Dict[str, Dict[str, Any]]:
+    """
+    Bboxes of a page as sent by the extension, `{uid -> bbox dict}`.
+    """
+    with open(DEMO_DIR / "bboxes" / f"bboxes-{index}.json") as f:
+        return json.load(f)
+
+
+def load_page(index: int = 2) -> str:
+    return (DEMO_DIR / "pages" / f"page-{index}-0.html").read_text(encoding="utf-8")
+
+
+def load_bboxes(index: int = 2) -> Dict[str, BoundingBox]:
+    return {k: BoundingBox(**v) for k, v in load_raw_bboxes(index).items()}
+
+
+def load_bbox_table(index: int = 2) -> BBoxTable:
+    return BBoxTable.from_dict(load_raw_bboxes(index))
@@ -0,0 +1,145 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from weblinx.processing.outputs import parse_predicted_output_string
+
+from ActionAgent import ActionAgent
+from Streaming import ActionStreamMonitor
+
+WORDS = ["</s>"] + [f"w{i}" for i in range(40)]
+# The model of `action_llama` generates `click(uid="zz")` after `go`, then `x` until the end
+ACTION_WORDS = ["</s>", "go", 'click(uid="', "a1", "b2", "zz", '")', "x"]
+NEXT_ACTION_WORDS = {
+    "go": 'click(uid="',
+    'click(uid="': "zz",
+    "zz": '")',
+    '")': "x",
+    "x": "x",
+}
+
+
+def save_tiny_llama(path, words=WORDS, next_words=None, seed=0):
+    """
+    Saves a 2-layer Llama with random weights & a tokenizer with one token per word of
+    `words` (split on spaces, decoded without them), the first word being the EOS token.
+    `next_words` maps words to the word greedily generated after them, whatever the context:
+    the embeddings are then one-hot & much larger than what the random layers add to them.
+    """
+    vocab = {word: i for i, word in enumerate(words)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token=words[1]))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.decoder = decoders.Fuse()
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token=words[0],
+        model_input_names=["input_ids", "attention_mask"],
+    ).save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(words),
+        hidden_size=32 * (len(words) // 32 + 1),
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        bos_token_id=0,
+        eos_token_id=0,
+        pad_token_id=0,
+        tie_word_embeddings=False,
+    )
+    model = LlamaForCausalLM(config)
+    if next_words is not None:
+        with torch.no_grad():
+            embeddings = model.get_input_embeddings().weight
+            embeddings.zero_()
+            embeddings[range(len(words)), range(len(words))] = 100.0
+            model.lm_head.weight.zero_()
+            for word, next_word in next_words.items():
+                model.lm_head.weight[vocab[next_word], vocab[word]] = 1.0
+    model.save_pretrained(path)
+    return model
+
+
+def load_agent(path, max_out_len=8) -> ActionAgent:
+    return ActionAgent(
+        tokenizer=str(path),
+        model=str(path),
+        use_rope=False,
+        use_flash_attention_2=False,
+        max_out_len=max_out_len,
+        dtype="float32",
+        device_map="cpu",
+    )
+
+
+@pytest.fixture(scope="module")
+def random_llama(tmp_path_factory):
+    path = tmp_path_factory.mktemp("random-llama")
+    save_tiny_llama(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def action_llama(tmp_path_factory):
+    path = tmp_path_factory.mktemp("action-llama")
+    save_tiny_llama(path, ACTION_WORDS, NEXT_ACTION_WORDS)
+    return path
+
+
+class TestPrefixCache:
+    def test_greedy_output_kept(self, random_llama):
+        agent = load_agent(random_llama)
+        first = " ".join(f"w{i % 40}" for i in range(1, 60))
+        turns = [first, first + " w7 w8 w9", first + " w7 w8 w9 w10 w11"]
+        expected = [agent.complete(model_input, 0) for model_input in turns]
+
+        agent.enable_prefix_cache(max_bytes=10**8, min_prefix_tokens=4)
+        preds = [agent.complete(model_input, 0, session_id="s") for model_input in turns]
+
+        assert preds == expected
+        assert agent.prefix_cache.hits == 2
+        # The caches hold the generated tokens, cropped to the prefix of the next prompt
+        assert agent.prefix_cache.reused_tokens >= 59 + 62
+
+
+class TestStreaming:
+    def test_stops_at_closing_bracket(self, action_llama):
+        agent = load_agent(action_llama, max_out_len=12)
+        assert agent.complete("x go", 0) == 'click(uid="zz")' + "x" * 9
+
+        deltas = []
+        monitor = ActionStreamMonitor(on_text=deltas.append)
+        pred = agent.complete("x go", 0, monitor=monitor)
+
+        # Stopped after the 3 tokens of the action, not at `max_out_len`
+        assert pred == 'click(uid="zz")'
+        assert monitor.complete
+        assert "".join(deltas) == pred
+
+
+class TestConstrainedDecoding:
+    def test_actions_on_candidates(self, action_llama):
+        agent = load_agent(action_llama, max_out_len=12)
+        agent.enable_constrained_decoding()
+        cands_turn = [{"uid": "a1", "rank": 0}, {"uid": "b2", "rank": 1}]
+
+        preds = [
+            agent.complete(model_input, 0, cands_turn=cands_turn)
+            for model_input in ["x go", "x x"]
+        ]
+        agent.enable_prefix_cache(max_bytes=10**8, min_prefix_tokens=1)
+        preds += [
+            agent.complete(model_input, 0, session_id="s", cands_turn=cands_turn)
+            for model_input in ["x go", "x go x"]
+        ]
+
+        # Unconstrained, the model generates `click(uid="zz")` or only `x` tokens
+        for pred in preds:
+            intent, args = parse_predicted_output_string(pred)
+            assert intent == "click"
+            assert args["uid"] in {"a1", "b2"}
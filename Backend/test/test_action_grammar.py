@@ -0,0 +1,148 @@
+from weblinx.processing.outputs import parse_predicted_output_string
+
+from ActionGrammar import ActionGrammar, TokenConstraint, build_token_texts
+
+
+def accepts(grammar, text):
+    return grammar.advance(grammar.initial_state(), text) is not None
+
+
+def is_complete(grammar, text):
+    state = grammar.advance(grammar.initial_state(), text)
+    return state is not None and grammar.is_complete(state)
+
+
+class FakeTokenizer:
+    """
+    Sentencepiece-like vocabulary: `▁` marks a space, `<0x..>` tokens are bytes.
+    """
+
+    def __init__(self, tokens, special_ids=()):
+        self.tokens = tokens
+        self.all_special_ids = list(special_ids)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[i] for i in ids]
+
+    def convert_tokens_to_string(self, tokens):
+        return "".join(tokens)
+
+
+class TestActionGrammar:
+    def test_complete_actions(self):
+        grammar = ActionGrammar(uids=["12", "a3"])
+        actions = [
+            'change(value="blue", uid="12")',
+            'click(uid="a3")',
+            'load(url="https://www.example.com")',
+            'say(speaker="navigator", utterance="Hi :)")',
+            "scroll(x=0, y=-250)",
+            'submit(uid="12")',
+            'text_input(text="hello world", uid="a3")',
+        ]
+
+        for action in actions:
+            assert is_complete(grammar, action), action
+            intent, args = parse_predicted_output_string(action)
+            assert intent == action.split("(")[0].replace("_", "")
+
+    def test_prefixes(self):
+        grammar = ActionGrammar(uids=["12"])
+        action = 'text_input(text="hi", uid="12")'
+
+        for i in range(len(action)):
+            assert accepts(grammar, action[:i])
+            assert not is_complete(grammar, action[:i])
+        assert is_complete(grammar, action)
+
+    def test_invalid_text(self):
+        grammar = ActionGrammar(uids=["12"])
+
+        assert not accepts(grammar, "hover(")
+        assert not accepts(grammar, "click(uid=12")
+        assert not accepts(grammar, 'say(speaker="instructor"')
+        assert not accepts(grammar, "scroll(x=1.5")
+        assert not accepts(grammar, "scroll(x=, y=0)")
+        assert not accepts(grammar, 'load(url="a\nb")')
+        # Nothing follows the action
+        assert not accepts(grammar, 'click(uid="12") ')
+
+    def test_uid_restricted_to_candidates(self):
+        grammar = ActionGrammar(uids=["12", "125"])
+
+        assert accepts(grammar, 'click(uid="12')
+        assert is_complete(grammar, 'click(uid="12")')
+        assert is_complete(grammar, 'click(uid="125")')
+        assert not accepts(grammar, 'click(uid="13')
+        assert not accepts(grammar, 'click(uid="1")')
+
+    def test_any_uid_without_candidates(self):
+        grammar = ActionGrammar()
+
+        assert is_complete(grammar, 'click(uid="anything")')
+
+    def test_string_length(self):
+        grammar = ActionGrammar(max_str_len=3)
+
+        assert is_complete(grammar, 'load(url="abc")')
+        assert not accepts(grammar, 'load(url="abcd')
+
+    def test_leading_spaces(self):
+        grammar = ActionGrammar(max_leading_spaces=2)
+
+        assert accepts(grammar, " click")
+        assert not accepts(grammar, "   click")
+        assert not accepts(grammar, "click (")
+
+
+class TestTokenConstraint:
+    def setup_method(self):
+        tokens = ["</s>", "▁click", '(uid="', "1", "2", '")', "▁say", "<0x0A>", "<0xC3>"]
+        self.tokenizer = FakeTokenizer(tokens, special_ids=[0])
+
+    def test_build_token_texts(self):
+        texts = build_token_texts(self.tokenizer)
+
+        assert texts[0] is None
+        assert texts[1] == " click"
+        assert texts[7] == "\n"
+        assert texts[8] == "�"
+
+    def test_generation(self):
+        grammar = ActionGrammar(uids=["2"])
+        constraint = TokenConstraint(grammar, build_token_texts(self.tokenizer), 0)
+        everything = range(len(self.tokenizer))
+
+        # Leading whitespace is allowed before the action
+        assert constraint.allowed_tokens(everything) == [1, 6, 7]
+        constraint.consume(1)
+        assert constraint.allowed_tokens(everything) == [2]
+        constraint.consume(2)
+        # Only the candidate UID
+        assert constraint.allowed_tokens(everything) == [4]
+        constraint.consume(4)
+        assert constraint.allowed_tokens(everything) == [5]
+        constraint.consume(5)
+
+        assert constraint.complete
+        assert constraint.allowed_tokens(everything) == [0]
+        assert constraint.num_tokens == 4
+
+    def test_allowed_tokens_in_order(self):
+        grammar = ActionGrammar()
+        constraint = TokenConstraint(grammar, build_token_texts(self.tokenizer), 0)
+
+        assert constraint.allowed_tokens([6, 3, 1]) == [6, 1]
+        assert constraint.allowed_tokens([6, 3, 1], max_tokens=1) == [6]
+
+    def test_invalid_token_ends_generation(self):
+        grammar = ActionGrammar()
+        constraint = TokenConstraint(grammar, build_token_texts(self.tokenizer), 0)
+
+        constraint.consume(3)
+
+        assert constraint.state is None
+        assert constraint.allowed_tokens(range(9)) == [0]
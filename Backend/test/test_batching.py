@@ -0,0 +1,161 @@
+import pytest
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from Batching import DynamicBatcher
+from Tracing import span, start_trace
+
+
+class TestDynamicBatcher:
+    def test_single_item(self):
+        batcher = DynamicBatcher(
+            name="test",
+            process_fn=lambda items: [i * 2 for i in items],
+            max_batch_size=4,
+            max_wait_ms=1,
+        )
+
+        assert batcher.submit(21).result(timeout=1) == 42
+        batcher.shutdown()
+
+    def test_coalesces_concurrent_items(self):
+        batch_sizes = []
+
+        def process(items):
+            batch_sizes.append(len(items))
+            return [i + 1 for i in items]
+
+        batcher = DynamicBatcher(
+            name="test", process_fn=process, max_batch_size=4, max_wait_ms=200
+        )
+        futures = [batcher.submit(i) for i in range(4)]
+
+        assert [f.result(timeout=1) for f in futures] == [1, 2, 3, 4]
+        assert batch_sizes == [4]
+
+        stats = batcher.get_stats()
+        assert stats["batches"] == 1
+        assert stats["avg_batch_fill"] == 1.0
+        assert stats["by_batch_size"][4]["items"] == 4
+        batcher.shutdown()
+
+    def test_max_batch_size(self):
+        batch_sizes = []
+
+        def process(items):
+            batch_sizes.append(len(items))
+            return items
+
+        batcher = DynamicBatcher(
+            name="test", process_fn=process, max_batch_size=2, max_wait_ms=50
+        )
+        futures = [batcher.submit(i) for i in range(5)]
+
+        assert [f.result(timeout=1) for f in futures] == list(range(5))
+        assert batch_sizes == [2, 2, 1]
+        batcher.shutdown()
+
+    def test_padded_token_budget(self):
+        batches = []
+
+        def process(items):
+            batches.append(list(items))
+            return items
+
+        batcher = DynamicBatcher(
+            name="test",
+            process_fn=process,
+            max_batch_size=8,
+            max_wait_ms=50,
+            max_batch_cost=100,
+            batch_cost_fn=lambda costs: max(costs) * len(costs),
+        )
+        futures = [
+            batcher.submit("a", cost=30),
+            batcher.submit("b", cost=30),
+            batcher.submit("c", cost=60),
+        ]
+
+        assert [f.result(timeout=1) for f in futures] == ["a", "b", "c"]
+        # 3 x 60 padded tokens is over budget
+        assert batches == [["a", "b"], ["c"]]
+        batcher.shutdown()
+
+    def test_max_wait(self):
+        batcher = DynamicBatcher(
+            name="test", process_fn=lambda items: items, max_batch_size=8, max_wait_ms=20
+        )
+
+        started = time.perf_counter()
+        batcher.submit(1).result(timeout=1)
+
+        assert time.perf_counter() - started < 0.5
+        batcher.shutdown()
+
+    def test_errors_routed_to_callers(self):
+        def process(items):
+            raise ValueError("boom")
+
+        batcher = DynamicBatcher(
+            name="test", process_fn=process, max_batch_size=2, max_wait_ms=1
+        )
+
+        with pytest.raises(ValueError):
+            batcher.submit(1).result(timeout=1)
+
+        # Batcher keeps working after a failed batch
+        batcher.process_fn = lambda items: items
+        assert batcher.submit(2).result(timeout=1) == 2
+        batcher.shutdown()
+
+    def test_submit_from_threads(self):
+        batcher = DynamicBatcher(
+            name="test",
+            process_fn=lambda items: [i * i for i in items],
+            max_batch_size=4,
+            max_wait_ms=5,
+        )
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: batcher.submit(i).result(), range(32)))
+
+        assert results == [i * i for i in range(32)]
+        assert batcher.get_stats()["items"] == 32
+        batcher.shutdown()
+
+    def test_shutdown_while_collecting(self):
+        batcher = DynamicBatcher(
+            name="test", process_fn=lambda items: items, max_batch_size=8, max_wait_ms=500
+        )
+        future = batcher.submit(1)
+        batcher.shutdown()
+
+        assert future.result(timeout=1) == 1
+        assert not batcher._thread.is_alive()
+
+    def test_batch_spans_in_caller_traces(self):
+        def process(items):
+            with span("encode"):
+                return [i + 1 for i in items]
+
+        batcher = DynamicBatcher(
+            name="test", process_fn=process, max_batch_size=4, max_wait_ms=100
+        )
+
+        def request(item):
+            with start_trace("request") as root:
+                with span("dmr") as dmr:
+                    result = batcher.submit(item).result(timeout=1)
+            return root.trace, dmr, result
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            traces = list(pool.map(request, [1, 2]))
+        batcher.shutdown()
+
+        for trace, dmr, _ in traces:
+            spans = {s.name: s for s in trace.spans}
+            assert spans["test.batch"].parent_id == dmr.span_id
+            assert spans["test.batch"].attributes["batch_size"] == 2
+            assert "queue_wait_s" in spans["test.batch"].attributes
+            assert spans["encode"].parent_id == spans["test.batch"].span_id
@@ -0,0 +1,87 @@
+import pickle
+import pytest
+
+from weblinx.utils.html import filter_bboxes
+
+from BBoxTable import COLUMNS, BBoxTable
+from schema import BoundingBox, RequestBody
+
+from .demo_data import load_raw_bboxes
+
+
+class TestBBoxTable:
+    def test_reads_like_dict(self):
+        raw = load_raw_bboxes(2)
+        table = BBoxTable.from_dict(raw)
+
+        assert len(table) == len(raw)
+        assert list(table) == list(raw)
+        uid = next(iter(raw))
+        assert uid in table
+        assert "missing" not in table
+        assert table[uid] == {c: float(raw[uid][c]) for c in COLUMNS}
+        assert table == BBoxTable.from_dict(
+            {k: BoundingBox(**v) for k, v in raw.items()}
+        )
+
+    def test_columnar_input(self):
+        table = BBoxTable.validate(
+            {"uids": ["a", "b"], "values": [list(range(8)), list(range(8, 16))]}
+        )
+
+        assert table["b"]["x"] == 8
+        assert table["b"]["right"] == 15
+
+    def test_invalid_input(self):
+        with pytest.raises(ValueError):
+            BBoxTable.validate({"a": {"x": 1}})
+        with pytest.raises(ValueError):
+            BBoxTable.validate({"uids": ["a"], "values": [[1, 2, 3]]})
+        with pytest.raises(ValueError):
+            BBoxTable.validate({"uids": ["a"], "values": [[float("nan")] * 8]})
+
+    @pytest.mark.parametrize("index", [0, 2, 5, 10, 17])
+    def test_visible_mask_matches_filter_bboxes(self, index):
+        raw = load_raw_bboxes(index)
+        table = BBoxTable.from_dict(raw)
+
+        for viewport in [(None, None), (651, 1366), (200, 400)]:
+            expected = filter_bboxes(
+                raw, viewport_height=viewport[0], viewport_width=viewport[1]
+            )
+            mask = table.visible_mask(
+                viewport_height=viewport[0], viewport_width=viewport[1]
+            )
+            assert table.uids[mask].tolist() == list(expected)
+
+    def test_updated(self):
+        table = BBoxTable.validate({"uids": ["a", "b"], "values": [[0] * 8, [1] * 8]})
+
+        new = table.updated(
+            {"a": None, "b": {c: 2 for c in COLUMNS}, "c": {c: 3 for c in COLUMNS}}
+        )
+
+        assert list(new) == ["b", "c"]
+        assert new["b"]["x"] == 2
+        assert list(table) == ["a", "b"]
+
+    def test_pickle(self):
+        table = BBoxTable.from_dict(load_raw_bboxes(2))
+        table.index
+
+        restored = pickle.loads(pickle.dumps(table))
+
+        assert restored._index is None
+        assert restored == table
+
+    def test_request_body_field(self):
+        raw = load_raw_bboxes(2)
+        request = RequestBody(
+            sessionID="1",
+            uid_key="data-webtasks-id",
+            user_intent={"intent": "continue"},
+            bboxes=raw,
+        )
+
+        assert isinstance(request.bboxes, BBoxTable)
+        assert request.model_dump()["bboxes"] == BBoxTable.from_dict(raw).to_dict()
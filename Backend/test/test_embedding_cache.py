@@ -0,0 +1,77 @@
+import numpy as np
+
+from EmbeddingCache import EmbeddingCache, ENTRY_OVERHEAD_BYTES
+
+
+class TestEmbeddingCache:
+    def vector(self, value, dim=4):
+        return np.full(dim, value, dtype=np.float32)
+
+    def test_key_depends_on_model_and_text(self):
+        key = EmbeddingCache.make_key("model-a", "<div>")
+
+        assert key == EmbeddingCache.make_key("model-a", "<div>")
+        assert key != EmbeddingCache.make_key("model-b", "<div>")
+        assert key != EmbeddingCache.make_key("model-a", "<span>")
+
+    def test_hit_and_miss(self):
+        cache = EmbeddingCache(max_bytes=10_000)
+        keys = [EmbeddingCache.make_key("m", t) for t in ["a", "b"]]
+
+        cache.put_many(keys[:1], [self.vector(1)])
+        found = cache.get_many(keys)
+
+        np.testing.assert_array_equal(found[0], self.vector(1))
+        assert found[1] is None
+
+        stats = cache.get_stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_rate"] == 0.5
+
+    def test_stores_copy_of_slices(self):
+        cache = EmbeddingCache(max_bytes=10_000)
+        batch = np.zeros((100, 4), dtype=np.float32)
+        key = EmbeddingCache.make_key("m", "a")
+
+        cache.put_many([key], [batch[0]])
+
+        assert cache.get_many([key])[0].base is None
+        assert cache.nbytes == 16 + ENTRY_OVERHEAD_BYTES
+
+    def test_lru_eviction_by_memory(self):
+        entry_bytes = 16 + ENTRY_OVERHEAD_BYTES
+        cache = EmbeddingCache(max_bytes=2 * entry_bytes)
+        keys = [EmbeddingCache.make_key("m", t) for t in ["a", "b", "c"]]
+
+        cache.put_many(keys[:2], [self.vector(0), self.vector(1)])
+        # "a" becomes most recently used
+        cache.get_many(keys[:1])
+        cache.put_many(keys[2:], [self.vector(2)])
+
+        found = cache.get_many(keys)
+        assert found[0] is not None
+        assert found[1] is None
+        assert found[2] is not None
+        assert cache.evictions == 1
+        assert cache.nbytes <= cache.max_bytes
+
+    def test_eviction_by_entries(self):
+        cache = EmbeddingCache(max_bytes=10_000, max_entries=2)
+        keys = [EmbeddingCache.make_key("m", str(i)) for i in range(5)]
+
+        cache.put_many(keys, [self.vector(i) for i in range(5)])
+
+        assert len(cache) == 2
+        assert cache.evictions == 3
+
+    def test_replace_existing_key(self):
+        cache = EmbeddingCache(max_bytes=10_000)
+        key = EmbeddingCache.make_key("m", "a")
+
+        cache.put_many([key], [self.vector(1)])
+        cache.put_many([key], [self.vector(2)])
+
+        assert len(cache) == 1
+        assert cache.nbytes == 16 + ENTRY_OVERHEAD_BYTES
+        np.testing.assert_array_equal(cache.get_many([key])[0], self.vector(2))
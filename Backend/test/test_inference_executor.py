@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+import time
+
+from InferenceExecutor import InferenceExecutor
+from Tracing import span, start_trace
+
+
+class TestInferenceExecutor:
+    def test_run_returns_result(self):
+        executor = InferenceExecutor(stage_workers={"dmr": 1})
+
+        result = asyncio.run(executor.run("dmr", lambda a, b=0: a + b, 1, b=2))
+
+        assert result == 3
+        assert executor.get_stats()["dmr"]["completed"] == 1
+        executor.shutdown()
+
+    def test_unknown_stage(self):
+        executor = InferenceExecutor(stage_workers={"dmr": 1})
+
+        with pytest.raises(KeyError):
+            asyncio.run(executor.run("generation", lambda: None))
+        executor.shutdown()
+
+    def test_event_loop_not_blocked(self):
+        executor = InferenceExecutor(stage_workers={"generation": 1})
+
+        async def main():
+            task = asyncio.create_task(executor.run("generation", time.sleep, 0.2))
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            await task
+            return elapsed
+
+        assert asyncio.run(main()) < 0.1
+        executor.shutdown()
+
+    def test_queue_depth_and_wait(self):
+        executor = InferenceExecutor(stage_workers={"generation": 1})
+
+        async def main():
+            tasks = [
+                asyncio.create_task(executor.run("generation", time.sleep, 0.05))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0.01)
+            depth = executor.get_stats()["generation"]["queue_depth"]
+            await asyncio.gather(*tasks)
+            return depth
+
+        assert asyncio.run(main()) == 2
+
+        stats = executor.get_stats()["generation"]
+        assert stats["queue_depth"] == 0
+        assert stats["completed"] == 3
+        assert stats["max_wait_s"] >= 0.05
+        executor.shutdown()
+
+    def test_failed_task(self):
+        executor = InferenceExecutor(stage_workers={"dmr": 1})
+
+        def fail():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            asyncio.run(executor.run("dmr", fail))
+
+        assert executor.get_stats()["dmr"]["failed"] == 1
+        executor.shutdown()
+
+    def test_spans_join_the_caller_trace(self):
+        executor = InferenceExecutor(stage_workers={"dmr": 1})
+
+        def stage():
+            with span("inner", records=3):
+                pass
+
+        async def main():
+            with start_trace("request") as root:
+                await executor.run("dmr", stage)
+            return root
+
+        root = asyncio.run(main())
+        spans = {s.name: s for s in root.trace.spans}
+
+        assert spans["executor.dmr"].parent_id == root.span_id
+        assert spans["executor.dmr"].attributes["queue_wait_s"] >= 0
+        assert spans["inner"].parent_id == spans["executor.dmr"].span_id
+        assert spans["inner"].attributes == {"records": 3}
+        executor.shutdown()
@@ -0,0 +1,71 @@
+from MemoryPolicy import CACHE_RELEASES, MemoryPressurePolicy
+
+
+class FakeDevice:
+    def __init__(self, reserved, total=1000):
+        self.reserved = reserved
+        self.total = total
+        self.releases = 0
+        self.now = 0.0
+
+    def read_memory(self):
+        return self.reserved, self.total
+
+    def release(self):
+        self.releases += 1
+        self.reserved = 0
+
+    def make_policy(self, name, **kwargs):
+        return MemoryPressurePolicy(
+            device=name,
+            read_memory=self.read_memory,
+            release=self.release,
+            clock=lambda: self.now,
+            **kwargs,
+        )
+
+
+class TestMemoryPressurePolicy:
+    def test_no_release_below_threshold(self):
+        device = FakeDevice(reserved=800)
+        policy = device.make_policy("below", threshold=0.9)
+
+        assert not policy.check()
+        assert device.releases == 0
+        assert policy.get_stats()["checks"] == 1
+
+    def test_release_under_pressure(self):
+        device = FakeDevice(reserved=950)
+        policy = device.make_policy("pressure", threshold=0.9)
+
+        assert policy.check()
+        assert device.releases == 1
+        assert CACHE_RELEASES.get(device="pressure", reason="pressure") == 1
+
+    def test_min_interval(self):
+        device = FakeDevice(reserved=950)
+        policy = device.make_policy("interval", threshold=0.9, min_interval_s=5)
+
+        assert policy.check()
+        device.reserved = 990
+        device.now = 4.0
+        assert not policy.check()
+        device.now = 5.0
+        assert policy.check()
+        assert device.releases == 2
+
+    def test_manual_release(self):
+        device = FakeDevice(reserved=0)
+        policy = device.make_policy("manual")
+
+        policy.release(reason="oom")
+
+        assert device.releases == 1
+        assert policy.get_stats()["releases"] == 1
+        assert CACHE_RELEASES.get(device="manual", reason="oom") == 1
+
+    def test_unknown_total(self):
+        device = FakeDevice(reserved=950, total=0)
+        policy = device.make_policy("unknown")
+
+        assert not policy.check()
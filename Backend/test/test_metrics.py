@@ -0,0 +1,77 @@
+import math
+import pytest
+
+from Metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+class TestMetrics:
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests.", ["path"])
+        counter.inc(path="/a")
+        counter.inc(2, path="/a")
+        counter.inc(path="/b")
+
+        assert counter.get(path="/a") == 3
+        assert counter.get(path="/c") == 0
+        assert counter.render() == [
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{path="/a"} 3',
+            'requests_total{path="/b"} 1',
+        ]
+
+    def test_labels_are_checked(self):
+        counter = Counter("requests_total", "Requests.", ["path"])
+
+        with pytest.raises(ValueError):
+            counter.inc()
+        with pytest.raises(ValueError):
+            counter.inc(path="/a", status=200)
+
+    def test_labels_are_escaped(self):
+        counter = Counter("requests_total", "Requests.", ["path"])
+        counter.inc(path='a"b\\c')
+
+        assert counter.render()[-1] == 'requests_total{path="a\\"b\\\\c"} 1'
+
+    def test_gauge(self):
+        gauge = Gauge("config", "Config.", ["setting"])
+        gauge.set(256, setting="max_out_len")
+        gauge.set(128, setting="max_out_len")
+
+        assert gauge.get(setting="max_out_len") == 128
+        assert gauge.render() == [
+            "# HELP config Config.",
+            "# TYPE config gauge",
+            'config{setting="max_out_len"} 128',
+        ]
+
+    def test_histogram(self):
+        histogram = Histogram("latency_seconds", "Latency.", ["stage"], buckets=[0.1, 1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value, stage="dmr")
+
+        assert histogram.buckets == (0.1, 1, math.inf)
+        assert histogram.get(stage="dmr") == {"sum": 2.65, "count": 4}
+        assert histogram.get(stage="generation") is None
+        assert histogram.render()[2:] == [
+            'latency_seconds_bucket{stage="dmr",le="0.1"} 2',
+            'latency_seconds_bucket{stage="dmr",le="1"} 3',
+            'latency_seconds_bucket{stage="dmr",le="+Inf"} 4',
+            'latency_seconds_sum{stage="dmr"} 2.65',
+            'latency_seconds_count{stage="dmr"} 4',
+        ]
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        counter = registry.register(Counter("a_total", "A."))
+        registry.register(Histogram("b_seconds", "B."))
+        counter.inc()
+
+        with pytest.raises(ValueError):
+            registry.register(Counter("a_total", "Again."))
+
+        text = registry.render()
+        assert text.endswith("\n")
+        assert "a_total 1\n" in text
+        assert "# TYPE b_seconds histogram" in text
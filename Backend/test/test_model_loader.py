@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+import threading
+
+from Metrics import REGISTRY
+from ModelLoader import ModelLoader, ModelNotReadyError, StartupTimer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStartupTimer:
+    def test_phases(self):
+        clock = FakeClock()
+        timer = StartupTimer(clock=clock)
+
+        with timer.phase("config"):
+            clock.now += 1.5
+        clock.now += 2.0
+        timer.mark("ready")
+
+        assert timer.get_stats() == {"config": 1.5, "ready": 3.5}
+        assert 'webassist_startup_phase_seconds{phase="config"} 1.5' in REGISTRY.render()
+
+    def test_failed_phase_is_recorded(self):
+        timer = StartupTimer()
+
+        with pytest.raises(ValueError):
+            with timer.phase("config"):
+                raise ValueError("invalid config")
+
+        assert "config" in timer.get_stats()
+
+
+class TestModelLoader:
+    def test_loads_once(self):
+        calls = []
+        timer = StartupTimer()
+        loader = ModelLoader("test_once", lambda: calls.append(1) or "model", timer=timer)
+
+        assert loader.state == "pending"
+        assert loader.get() == "model"
+        assert loader.get() == "model"
+
+        assert calls == [1]
+        assert loader.ready
+        assert "test_once" in timer.get_stats()
+        assert 'webassist_model_ready{model="test_once"} 1' in REGISTRY.render()
+
+    def test_loads_in_background(self):
+        release = threading.Event()
+
+        def load():
+            release.wait()
+            return "model"
+
+        loader = ModelLoader("test_background", load)
+        loader.start()
+
+        assert loader.state == "loading"
+        with pytest.raises(ModelNotReadyError, match="still loading"):
+            loader.get(timeout=0.01)
+
+        release.set()
+        assert loader.get(timeout=1) == "model"
+        assert loader.get_stats()["state"] == "ready"
+
+    def test_concurrent_gets_share_the_load(self):
+        calls = []
+        release = threading.Event()
+
+        def load():
+            calls.append(1)
+            release.wait()
+            return "model"
+
+        loader = ModelLoader("test_shared", load)
+
+        async def main():
+            waiting = [asyncio.create_task(loader.aget()) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(*waiting)
+
+        assert asyncio.run(main()) == ["model"] * 3
+        assert calls == [1]
+
+    def test_aget_timeout_does_not_cancel_the_load(self):
+        release = threading.Event()
+        loader = ModelLoader("test_timeout", lambda: release.wait() and "model")
+
+        async def main():
+            with pytest.raises(ModelNotReadyError):
+                await loader.aget(timeout=0.01)
+            release.set()
+            return await loader.aget(timeout=1)
+
+        assert asyncio.run(main()) == "model"
+
+    def test_failed_load_is_retried(self):
+        attempts = []
+
+        def load():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise OSError("weights not found")
+            return "model"
+
+        loader = ModelLoader("test_retry", load)
+
+        with pytest.raises(ModelNotReadyError, match="weights not found"):
+            loader.get()
+        assert loader.failed
+        assert "OSError" in loader.get_stats()["error"]
+
+        assert loader.get() == "model"
+        assert loader.get_stats()["error"] is None
+        assert len(attempts) == 2
@@ -0,0 +1,103 @@
+import lxml.html
+import pytest
+
+from PageSnapshot import PageDeltaError, PageSnapshot, hash_page
+from schema import BoundingBox, Metadata, PageDelta, PrevTurn, RequestBody, UserIntent
+
+UID_KEY = "data-webtasks-id"
+
+HTML = (
+    '<html><body data-webtasks-id="1">'
+    '<div data-webtasks-id="2"><span data-webtasks-id="3">0 results</span></div>tail'
+    '<button data-webtasks-id="4">Search</button>'
+    "</body></html>"
+)
+
+BBOX = BoundingBox(bottom=20, height=20, left=0, right=100, top=0, width=100, x=0, y=0)
+
+
+def make_snapshot():
+    return PageSnapshot(html=HTML, bboxes={"2": BBOX, "3": BBOX, "4": BBOX})
+
+
+class TestPageSnapshot:
+    def test_apply_delta(self):
+        snapshot = make_snapshot()
+        delta = PageDelta(
+            base_hash=snapshot.page_hash,
+            subtrees={
+                "2": '<div data-webtasks-id="2"><span data-webtasks-id="5">3 results</span></div>'
+            },
+            bboxes={"3": None, "5": BBOX},
+        )
+
+        new = snapshot.apply_delta(delta, UID_KEY)
+
+        root = lxml.html.document_fromstring(new.html)
+        assert root.xpath(f'//*[@{UID_KEY}="5"]')[0].text == "3 results"
+        assert not root.xpath(f'//*[@{UID_KEY}="3"]')
+        # Text following the replaced element is kept
+        assert root.xpath(f'//*[@{UID_KEY}="2"]')[0].tail == "tail"
+        assert set(new.bboxes) == {"2", "4", "5"}
+        assert new.page_hash == hash_page(new.html)
+
+        # The base snapshot is not modified
+        assert snapshot.html == HTML
+        assert "3" in snapshot.bboxes
+
+    def test_empty_delta_keeps_page(self):
+        snapshot = make_snapshot()
+
+        new = snapshot.apply_delta(PageDelta(base_hash=snapshot.page_hash), UID_KEY)
+
+        assert new.page_hash == snapshot.page_hash
+        assert new.bboxes == snapshot.bboxes
+
+    def test_hash_mismatch(self):
+        with pytest.raises(PageDeltaError):
+            make_snapshot().apply_delta(PageDelta(base_hash="stale"), UID_KEY)
+
+    def test_unknown_uid(self):
+        snapshot = make_snapshot()
+        delta = PageDelta(base_hash=snapshot.page_hash, subtrees={"99": "<p></p>"})
+
+        with pytest.raises(PageDeltaError):
+            snapshot.apply_delta(delta, UID_KEY)
+
+
+class TestRequestBodyPageDelta:
+    metadata = Metadata(
+        mouseX=0,
+        mouseY=0,
+        tabId=1,
+        url="https://example.com",
+        viewportHeight=651,
+        viewportWidth=1366,
+        zoomLevel=1,
+    )
+
+    def make_request(self, **kwargs):
+        return RequestBody(
+            sessionID="1",
+            uid_key=UID_KEY,
+            user_intent=UserIntent(intent="continue"),
+            prev_turn=PrevTurn(intent="scroll", scrollX=1, scrollY=1),
+            metadata=self.metadata,
+            **kwargs,
+        )
+
+    def test_delta_replaces_full_page(self):
+        request = self.make_request(page_delta=PageDelta(base_hash="abc"))
+
+        assert request.html is None
+        assert request.page_delta.base_hash == "abc"
+
+    def test_delta_and_full_page(self):
+        with pytest.raises(ValueError):
+            self.make_request(
+                html=HTML, bboxes={"2": BBOX}, page_delta=PageDelta(base_hash="abc")
+            )
+
+    def test_full_page_still_required_without_delta(self):
+        with pytest.raises(ValueError):
+            self.make_request()
@@ -0,0 +1,78 @@
+import numpy as np
+
+from PrefixCache import PrefixCache, common_prefix_length
+
+
+class TestPrefixCache:
+    def test_common_prefix_length(self):
+        a = np.array([1, 2, 3, 4])
+
+        assert common_prefix_length(a, np.array([1, 2, 5, 4])) == 2
+        assert common_prefix_length(a, np.array([1, 2])) == 2
+        assert common_prefix_length(a, np.array([9])) == 0
+        assert common_prefix_length(a, a) == 4
+
+    def test_reuses_longest_prefix(self):
+        cache = PrefixCache(max_bytes=1000, min_prefix_tokens=2)
+        cache.put("s1", [1, 2, 3, 4, 5, 6], cache="kv", nbytes=100)
+
+        assert cache.take("s1", [1, 2, 3, 9, 9]) == ("kv", 3)
+        # Taken out of the store while the generation runs
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+        assert cache.take("s1", [1, 2, 3]) == (None, 0)
+
+        stats = cache.get_stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["reused_tokens"] == 3
+        assert stats["prefilled_tokens"] == 2 + 3
+
+    def test_leaves_last_token_to_prefill(self):
+        cache = PrefixCache(max_bytes=1000, min_prefix_tokens=2)
+        cache.put("s1", [1, 2, 3, 4, 5], cache="kv", nbytes=100)
+
+        assert cache.take("s1", [1, 2, 3]) == ("kv", 2)
+
+    def test_short_prefix_not_reused(self):
+        cache = PrefixCache(max_bytes=1000, min_prefix_tokens=4)
+        cache.put("s1", [1, 2, 3, 4, 5], cache="kv", nbytes=100)
+
+        assert cache.take("s1", [1, 2, 3, 0, 0]) == (None, 0)
+        assert len(cache) == 0
+
+    def test_sessions_are_separate(self):
+        cache = PrefixCache(max_bytes=1000, min_prefix_tokens=1)
+        cache.put("s1", [1, 2, 3], cache="kv1", nbytes=100)
+
+        assert cache.take("s2", [1, 2, 3]) == (None, 0)
+        assert cache.take("s1", [1, 2, 3]) == ("kv1", 2)
+
+    def test_eviction(self):
+        cache = PrefixCache(max_bytes=250, max_sessions=2)
+        cache.put("s1", [1], cache="kv1", nbytes=100)
+        cache.put("s2", [1], cache="kv2", nbytes=100)
+        cache.put("s3", [1], cache="kv3", nbytes=100)
+
+        assert len(cache) == 2
+        assert cache.nbytes == 200
+        assert cache.get_stats()["evictions"] == 1
+
+        # Bigger than the budget
+        cache.put("s4", [1], cache="kv4", nbytes=300)
+        assert len(cache) == 2
+
+        cache.put("s5", [1], cache="kv5", nbytes=200)
+        assert len(cache) == 1
+        assert cache.nbytes == 200
+
+    def test_replace_and_discard(self):
+        cache = PrefixCache(max_bytes=1000)
+        cache.put("s1", [1], cache="kv1", nbytes=100)
+        cache.put("s1", [1, 2], cache="kv2", nbytes=150)
+
+        assert len(cache) == 1
+        assert cache.nbytes == 150
+
+        cache.discard("s1")
+        assert cache.nbytes == 0
@@ -0,0 +1,78 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from Profiling import TimedTokenizer, collect_timings, timed
+from Tracing import start_trace
+
+
+class FakeTokenizer:
+    model_max_length = 8
+
+    def tokenize(self, text, add_special_tokens=False):
+        return text.split()
+
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": list(range(len(text.split())))}
+
+
+@timed("decorated")
+def decorated(x):
+    return x * 2
+
+
+class TestProfiling:
+    def test_noop_without_collector(self):
+        with timed("stage"):
+            pass
+
+        assert decorated(2) == 4
+
+    def test_collects_stages(self):
+        with collect_timings() as timings:
+            with timed("outer"):
+                with timed("inner"):
+                    pass
+                assert decorated(1) == 2
+            decorated(2)
+
+        assert len(timings["outer"]) == 1
+        assert len(timings["inner"]) == 1
+        assert len(timings["decorated"]) == 2
+        assert timings["outer"][0] >= timings["inner"][0]
+
+        # Nothing is recorded once the block is closed
+        decorated(3)
+        assert len(timings["decorated"]) == 2
+
+    def test_collects_from_threads(self):
+        with collect_timings() as timings:
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(decorated, range(4)))
+
+        assert len(timings["decorated"]) == 4
+
+    def test_nested_collection(self):
+        with collect_timings():
+            with pytest.raises(RuntimeError):
+                with collect_timings():
+                    pass
+
+    def test_timed_tokenizer(self):
+        tokenizer = TimedTokenizer(FakeTokenizer())
+
+        with collect_timings() as timings:
+            with start_trace("request") as root:
+                with timed("prompt_build"):
+                    for _ in range(10):
+                        assert tokenizer.tokenize("a b c") == ["a", "b", "c"]
+                    assert tokenizer("a b")["input_ids"] == [0, 1]
+                    tokenizer.report()
+
+        # One timing & no span per call, the calls are attributes of the enclosing span
+        assert len(timings["tokenization"]) == 1
+        (build,) = root.trace.spans
+        assert build.name == "prompt_build"
+        assert build.attributes["tokenizer_calls"] == 11
+        assert build.attributes["tokenization_s"] == timings["tokenization"][0]
+        assert tokenizer.model_max_length == 8
@@ -0,0 +1,156 @@
+import weblinx.utils.format as wf
+
+from functools import partial
+from weblinx.processing.prompt import (
+    find_turns_with_instructor_chat,
+    format_prev_turns,
+    format_utterances,
+)
+
+from PromptState import PromptState, get_prompt_state
+from schema import PrevTurn, UserIntent
+from WebLinxHelper import InferReplay
+
+format_intent = partial(
+    wf.format_intent_automatically,
+    format_say=partial(wf.format_say, include_timestamp=False),
+    format_scroll=partial(wf.format_scroll, include_timestamp=False),
+)
+
+
+def add_turn(replay, turn):
+    replay.build_add_InferTurn(prev_turn=turn, html=None, bboxes=None, metadata=None)
+
+
+def build_replay(num_turns=12):
+    replay = InferReplay(session_id="test")
+    for i in range(num_turns):
+        if i % 4 == 0:
+            add_turn(replay, UserIntent(intent="say", utterance=f"Utterance {i}"))
+        else:
+            add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=i))
+    return replay
+
+
+def next_turn(replay):
+    return replay.buildInferTurn(
+        turn=UserIntent(intent="say", utterance="Next"),
+        html=None,
+        bboxes=None,
+        metadata=None,
+    )
+
+
+class TestPromptState:
+    def test_matches_weblinx(self):
+        replay = build_replay()
+        state = replay.prompt_state
+
+        for num_turns in range(len(replay) + 1):
+            turn = replay.buildInferTurn(
+                turn=UserIntent(intent="say", utterance="Next"),
+                html=None,
+                bboxes=None,
+                metadata=None,
+            )
+            turn.index = num_turns
+            expected = find_turns_with_instructor_chat(replay, turn)
+            assert state.find_turns_with_instructor_chat(turn) == expected
+
+        turn = next_turn(replay)
+        assert format_prev_turns(
+            replay, turn, format_intent=state.cached_format(format_intent)
+        ) == format_prev_turns(replay, turn, format_intent=format_intent)
+
+    def test_formats_each_turn_once(self):
+        replay = build_replay()
+        calls = []
+
+        def counting_format(turn, return_as=dict):
+            calls.append(turn.index)
+            return format_intent(turn, return_as=return_as)
+
+        cached = replay.prompt_state.cached_format(counting_format)
+        for _ in range(3):
+            format_prev_turns(replay, next_turn(replay), format_intent=cached)
+
+        assert calls == [7, 8, 9, 10, 11]
+
+        # Only the new turn is formatted on the next turn
+        add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=1))
+        format_prev_turns(replay, next_turn(replay), format_intent=cached)
+        assert calls[5:] == [12]
+
+    def test_returns_copies(self):
+        replay = build_replay()
+        cached = replay.prompt_state.cached_format(format_intent)
+
+        cached(replay[1], return_as=dict)["y"] = "edited"
+
+        assert cached(replay[1], return_as=dict)["y"] == 1
+
+    def test_remove_last_turn(self):
+        replay = build_replay(num_turns=9)
+        state = replay.prompt_state
+        cached = state.cached_format(format_intent)
+        turn = next_turn(replay)
+        turn.index = 20
+
+        assert len(state.find_turns_with_instructor_chat(turn)) == 3
+        assert "Utterance 8" in cached(replay[8], return_as=str)
+
+        replay.remove_lastInferTurn()
+        add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=5))
+
+        assert len(state.find_turns_with_instructor_chat(turn)) == 2
+        assert "y=5" in cached(replay[8], return_as=str)
+
+    def test_context_rebuilt_when_chat_changes(self):
+        replay = build_replay(num_turns=9)
+        state = replay.prompt_state
+        builds = []
+
+        def get_context():
+            turns = state.find_turns_with_instructor_chat(next_turn(replay))
+            return state.get_context(
+                "utterances",
+                key=state.chat_key(turns),
+                build=lambda: builds.append(1) or format_utterances(turns),
+            )
+
+        context = get_context()
+        assert get_context() == context
+        assert len(builds) == 1
+
+        # The chat turn at index 4 leaves the window of previous turns
+        add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=1))
+        assert get_context() != context
+        assert len(builds) == 2
+
+        add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=1))
+        get_context()
+        assert len(builds) == 2
+
+        # Any change of the chat turns rebuilds the context (the key is conservative)
+        replay.remove_lastInferTurn()
+        add_turn(replay, UserIntent(intent="say", utterance="Replaced"))
+        get_context()
+        assert len(builds) == 3
+
+    def test_formatted_turns_bounded(self):
+        replay = InferReplay(session_id="test")
+        replay.prompt_state = PromptState(keep_last_n=5)
+        cached = replay.prompt_state.cached_format(format_intent)
+
+        for i in range(10):
+            add_turn(replay, PrevTurn(intent="scroll", scrollX=0, scrollY=i))
+            format_prev_turns(replay, next_turn(replay), format_intent=cached)
+
+        assert replay.prompt_state.get_stats()["formatted_turns"] <= 5
+
+    def test_state_for_plain_replay(self):
+        replay = build_replay()
+        state = get_prompt_state(list(replay))
+
+        assert state.get_stats()["chat_turns"] == 3
+        assert get_prompt_state(replay) is replay.prompt_state
@@ -0,0 +1,85 @@
+from PromptTruncation import (
+    DEFAULT_SECTION_BUDGETS,
+    count_head_tokens,
+    scale_section_budgets,
+    truncate_prompt_tokens,
+)
+
+HEADER = "<s> [INST] <<SYS>>\n"
+
+
+class LlamaChatTokenizer:
+    """
+    Whitespace tokenizer with the Llama 2 chat template.
+    """
+
+    def apply_chat_template(self, prompt, tokenize=False, add_generation_prompt=False):
+        text = HEADER + prompt[0]["content"] + "\n<</SYS>>\n\n"
+        for i, message in enumerate(prompt[1:]):
+            if message["role"] == "user":
+                text += ("" if i == 0 else "<s> [INST] ") + message["content"] + " [/INST]"
+            else:
+                text += " " + message["content"] + " </s>"
+        return text
+
+    def tokenize(self, text):
+        return text.split()
+
+    def convert_tokens_to_string(self, tokens):
+        return " ".join(tokens)
+
+
+def truncate(tokenizer, prompt, max_len):
+    model_input = tokenizer.apply_chat_template(prompt)
+    tokens = tokenizer.tokenize(model_input)
+    num_head_tokens = count_head_tokens(tokenizer, prompt[0]["content"])
+    return truncate_prompt_tokens(tokens, max_len, num_head_tokens)
+
+
+class TestPromptTruncation:
+    def test_header_survives_truncation(self):
+        tokenizer = LlamaChatTokenizer()
+        system = "Predict the next action . Candidates : uid-1 uid-2"
+        prompt = [{"role": "system", "content": system}, {"role": "user", "content": ""}]
+        for i in range(20):
+            prompt.append({"role": "assistant", "content": f"click(uid=turn-{i})"})
+            prompt.append({"role": "user", "content": f"utterance {i}"})
+        prompt[-1]["content"] += " Please select the best action"
+
+        tokens = truncate(tokenizer, prompt, max_len=40)
+        model_input = tokenizer.convert_tokens_to_string(tokens)
+
+        assert len(tokens) == 40
+        assert model_input.startswith("<s> [INST] <<SYS>> " + system + " <</SYS>>")
+        assert model_input.endswith("utterance 19 Please select the best action [/INST]")
+        assert "turn-0" not in model_input
+
+    def test_short_prompt_kept(self):
+        tokenizer = LlamaChatTokenizer()
+        prompt = [
+            {"role": "system", "content": "Predict the next action"},
+            {"role": "user", "content": "Open the calculator"},
+        ]
+        tokens = tokenizer.tokenize(tokenizer.apply_chat_template(prompt))
+
+        assert truncate(tokenizer, prompt, max_len=len(tokens)) == tokens
+
+    def test_head_longer_than_max_len(self):
+        tokens = [str(i) for i in range(10)]
+
+        assert truncate_prompt_tokens(tokens, 4, num_head_tokens=6) == tokens[:4]
+        assert truncate_prompt_tokens(tokens, 4, num_head_tokens=1) == ["0", "7", "8", "9"]
+
+    def test_budgets_kept_when_they_fit(self):
+        total = sum(DEFAULT_SECTION_BUDGETS.values())
+
+        assert scale_section_budgets(total + 300, 300) == DEFAULT_SECTION_BUDGETS
+
+    def test_budgets_scaled_down(self):
+        total = sum(DEFAULT_SECTION_BUDGETS.values())
+        budgets = scale_section_budgets(total // 2 + 300, 300)
+
+        assert sum(budgets.values()) <= total // 2
+        for name, budget in budgets.items():
+            assert budget == DEFAULT_SECTION_BUDGETS[name] // 2
+        assert all(b == 1 for b in scale_section_budgets(100, 300).values())
@@ -0,0 +1,36 @@
+import numpy as np
+
+from Ranking import rank_scores, select_top_k
+
+
+def full_sort(scores):
+    # Ranking of `DMR.rank_records` before the partial selection
+    return sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+
+
+class TestSelectTopK:
+    def test_matches_full_sort(self):
+        rng = np.random.default_rng(0)
+        scores = rng.normal(size=500).astype(np.float32)
+
+        for k in [1, 10, 499, 500, 1000, None]:
+            expected = full_sort(scores)[:k]
+            assert select_top_k(scores, k).tolist() == expected
+
+    def test_ties_keep_record_order(self):
+        scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1, 0.5])
+
+        assert select_top_k(scores, 3).tolist() == [1, 0, 2]
+        assert select_top_k(-np.ones(4), 2).tolist() == [0, 1]
+
+    def test_empty(self):
+        assert select_top_k(np.zeros(0), 10).tolist() == []
+        assert select_top_k(np.ones(3), 0).tolist() == []
+
+
+class TestRankScores:
+    def test_ranks(self):
+        scores = np.array([0.2, 0.9, 0.5, 0.9])
+
+        assert rank_scores(scores).tolist() == [4, 1, 3, 2]
+        assert rank_scores(scores, starts_at=0).tolist() == [3, 0, 2, 1]
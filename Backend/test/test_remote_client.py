@@ -0,0 +1,409 @@
+import asyncio
+import json
+import pytest
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from RemoteClient import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RemoteClient,
+    RemoteError,
+    SentenceSimilarityClient,
+    TextGenerationClient,
+    parse_sse_data,
+)
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out close their connection before the response
+        pass
+
+
+class StubServer:
+    """
+    Local sentence-similarity endpoint: scores each sentence by its length. `failures` status
+    codes are answered first, `delay_s` slows every call down.
+    """
+
+    def __init__(self, failures=(), delay_s=0.0):
+        self.failures = list(failures)
+        self.delay_s = delay_s
+        self.payloads = []
+        self.client_ports = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                status, response = stub.handle(self.client_address, json.loads(body))
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = QuietServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, client_address, payload):
+        with self._lock:
+            self.payloads.append(payload)
+            self.client_ports.add(client_address[1])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            status = self.failures.pop(0) if self.failures else 200
+        try:
+            time.sleep(self.delay_s)
+            if status != 200:
+                return status, {"error": "stub failure"}
+            sentences = payload["inputs"]["sentences"]
+            return 200, [float(len(s)) for s in sentences]
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class GenerationStub:
+    """
+    Local text-generation server: generates `tokens` for every prompt, `/generate_stream`
+    sends them one event at a time every `token_delay_s`. `failures` status codes are answered
+    first.
+    """
+
+    def __init__(self, tokens, failures=(), token_delay_s=0.0):
+        self.tokens = tokens
+        self.failures = list(failures)
+        self.token_delay_s = token_delay_s
+        self.payloads = []
+        self.streamed_tokens = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with stub._lock:
+                    stub.payloads.append(json.loads(body))
+                    status = stub.failures.pop(0) if stub.failures else 200
+                if status != 200:
+                    return self.send_json(status, {"error": "stub failure"})
+                if self.path == "/generate":
+                    return self.send_json(200, {"generated_text": "".join(stub.tokens)})
+                self.stream_tokens()
+
+            def send_json(self, status, response):
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream_tokens(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for i, text in enumerate(stub.tokens + ["</s>"]):
+                    event = {"token": {"id": i, "text": text, "special": text == "</s>"}}
+                    self.wfile.write(f"data:{json.dumps(event)}\n\n".encode())
+                    self.wfile.flush()
+                    with stub._lock:
+                        stub.streamed_tokens += 1
+                    time.sleep(stub.token_delay_s)
+
+        self.server = QuietServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def make_client(url, **kwargs):
+    kwargs = {"backoff_s": 0.001, "max_backoff_s": 0.01, **kwargs}
+    return RemoteClient(name="test", base_url=url, **kwargs)
+
+
+def payload(*sentences):
+    return {"inputs": {"source_sentence": "query", "sentences": list(sentences)}}
+
+
+class TestCircuitBreaker:
+    def test_opens_after_failures_and_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker(
+            failure_threshold=2, reset_timeout_s=10, clock=lambda: now[0]
+        )
+
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == "open"
+        assert not breaker.allow()
+
+        now[0] = 10.0
+        # A single trial call
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == "closed"
+        assert breaker.allow()
+
+    def test_failed_trial_opens_again(self):
+        now = [0.0]
+        breaker = CircuitBreaker(
+            failure_threshold=1, reset_timeout_s=10, clock=lambda: now[0]
+        )
+        breaker.record_failure()
+
+        now[0] = 10.0
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+        assert not breaker.allow()
+        assert breaker.get_stats()["opened"] == 2
+
+
+class TestRemoteClient:
+    def test_post_reuses_connections(self, stub):
+        client = make_client(stub.url)
+
+        for _ in range(5):
+            assert client.post("/", payload("ab", "c")) == [2.0, 1.0]
+
+        assert len(stub.client_ports) == 1
+        assert client.get_stats()["calls"] == 5
+        client.close()
+
+    def test_apost_from_another_loop(self, stub):
+        client = make_client(stub.url)
+
+        async def main():
+            return await asyncio.gather(
+                client.apost("/", payload("a")), client.apost("/", payload("bb"))
+            )
+
+        assert asyncio.run(main()) == [[1.0], [2.0]]
+        client.close()
+
+    def test_retries_server_errors(self):
+        stub = StubServer(failures=[503, 500])
+        client = make_client(stub.url, max_retries=2)
+
+        assert client.post("/", payload("abc")) == [3.0]
+        assert client.get_stats()["retries"] == 2
+        assert client.breaker.state == "closed"
+        client.close()
+        stub.close()
+
+    def test_gives_up_after_retries(self):
+        stub = StubServer(failures=[503] * 3)
+        client = make_client(stub.url, max_retries=1)
+
+        with pytest.raises(RemoteError):
+            client.post("/", payload("abc"))
+        assert len(stub.payloads) == 2
+        assert client.get_stats()["errors"] == 1
+        client.close()
+        stub.close()
+
+    def test_client_errors_are_not_retried(self):
+        stub = StubServer(failures=[400])
+        client = make_client(stub.url, max_retries=2, failure_threshold=1)
+
+        with pytest.raises(RemoteError):
+            client.post("/", payload("abc"))
+        assert len(stub.payloads) == 1
+        assert client.breaker.state == "closed"
+        client.close()
+        stub.close()
+
+    def test_timeout(self):
+        stub = StubServer(delay_s=0.5)
+        client = make_client(stub.url, timeout_s=0.05, max_retries=0)
+
+        with pytest.raises(RemoteError):
+            client.post("/", payload("abc"))
+        client.close()
+        stub.close()
+
+    def test_connection_error_opens_circuit(self):
+        # Nothing listens on the port of a closed server
+        stub = StubServer()
+        stub.close()
+        client = make_client(stub.url, max_retries=0, failure_threshold=2)
+
+        for _ in range(2):
+            with pytest.raises(RemoteError):
+                client.post("/", payload("abc"))
+        with pytest.raises(CircuitOpenError):
+            client.post("/", payload("abc"))
+        assert client.breaker.state == "open"
+        client.close()
+
+    def test_bounded_concurrency(self):
+        stub = StubServer(delay_s=0.05)
+        client = make_client(stub.url, max_concurrency=2)
+
+        client.post_many("/", [payload("a")] * 6)
+
+        assert stub.max_in_flight == 2
+        client.close()
+        stub.close()
+
+
+class TestSentenceSimilarityClient:
+    def test_chunks_are_sent_in_parallel(self):
+        stub = StubServer(delay_s=0.1)
+        client = make_client(stub.url, max_concurrency=4)
+        similarity = SentenceSimilarityClient(client, chunk_size=3)
+        sentences = ["a" * (i + 1) for i in range(10)]
+
+        started = time.perf_counter()
+        scores = similarity.get_scores("query", sentences)
+        elapsed = time.perf_counter() - started
+
+        assert scores == [float(i + 1) for i in range(10)]
+        assert [len(p["inputs"]["sentences"]) for p in stub.payloads] == [3, 3, 3, 1]
+        assert all(p["inputs"]["source_sentence"] == "query" for p in stub.payloads)
+        assert elapsed < 0.35
+        client.close()
+        stub.close()
+
+    def test_no_sentences(self, stub):
+        client = make_client(stub.url)
+
+        assert SentenceSimilarityClient(client).get_scores("query", []) == []
+        assert stub.payloads == []
+        client.close()
+
+    def test_failed_chunk(self):
+        stub = StubServer(failures=[503])
+        client = make_client(stub.url, max_retries=0, max_concurrency=1)
+        similarity = SentenceSimilarityClient(client, chunk_size=1)
+
+        with pytest.raises(RemoteError):
+            similarity.get_scores("query", ["a", "b"])
+        client.close()
+        stub.close()
+
+
+ACTION_TOKENS = ["click", "(", "uid", '="', "12", '")', " and", " more", " text"]
+
+
+class TestTextGenerationClient:
+    def test_generate_batch(self):
+        stub = GenerationStub(ACTION_TOKENS)
+        client = make_client(stub.url)
+        generation = TextGenerationClient(client)
+        parameters = {"max_new_tokens": 16, "do_sample": False}
+
+        preds = generation.generate(["prompt 1", "prompt 2"], parameters)
+
+        assert preds == ["".join(ACTION_TOKENS)] * 2
+        assert sorted(p["inputs"] for p in stub.payloads) == ["prompt 1", "prompt 2"]
+        assert all(p["parameters"] == parameters for p in stub.payloads)
+        client.close()
+        stub.close()
+
+    def test_generate_retries(self):
+        stub = GenerationStub(ACTION_TOKENS, failures=[503])
+        client = make_client(stub.url, max_retries=1)
+
+        preds = TextGenerationClient(client).generate(["prompt"], {})
+
+        assert preds == ["".join(ACTION_TOKENS)]
+        assert len(stub.payloads) == 2
+        client.close()
+        stub.close()
+
+    def test_stream_until_the_end(self):
+        stub = GenerationStub(ACTION_TOKENS)
+        client = make_client(stub.url)
+        texts = []
+
+        def on_text(text):
+            texts.append(text)
+            return False
+
+        text = TextGenerationClient(client).generate_stream("prompt", {}, on_text)
+
+        # The special end token is not part of the text
+        assert text == "".join(ACTION_TOKENS)
+        assert texts[0] == "click" and texts[-1] == text
+        assert stub.payloads == [{"inputs": "prompt", "parameters": {}}]
+        client.close()
+        stub.close()
+
+    def test_stream_is_cancelled(self):
+        stub = GenerationStub(ACTION_TOKENS, token_delay_s=0.02)
+        client = make_client(stub.url)
+
+        text = TextGenerationClient(client).generate_stream(
+            "prompt", {}, on_text=lambda text: text.endswith('")')
+        )
+
+        assert text == 'click(uid="12")'
+        # The server stops writing once the client closed the connection
+        time.sleep(0.2)
+        assert stub.streamed_tokens < len(ACTION_TOKENS)
+        assert client.get_stats()["in_flight"] == 0
+        client.close()
+        stub.close()
+
+    def test_stream_error(self):
+        stub = GenerationStub(ACTION_TOKENS, failures=[500])
+        client = make_client(stub.url, max_retries=0)
+
+        with pytest.raises(RemoteError):
+            TextGenerationClient(client).generate_stream("prompt", {}, lambda t: False)
+        client.close()
+        stub.close()
+
+    def test_parse_sse_data(self):
+        assert parse_sse_data('data: {"token": {"text": "a"}}') == {
+            "token": {"text": "a"}
+        }
+        assert parse_sse_data(": keep-alive") is None
+        assert parse_sse_data("data: [DONE]") is None
+        assert parse_sse_data("") is None
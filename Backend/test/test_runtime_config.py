@@ -0,0 +1,109 @@
+import pytest
+import yaml
+
+from pathlib import Path
+from types import SimpleNamespace
+from pydantic import ValidationError
+
+from Metrics import REGISTRY
+from RuntimeConfig import (
+    OVERRIDES_ENV,
+    RuntimeConfig,
+    encode_config_overrides,
+    read_config_overrides,
+)
+
+CONFIG_PATH = Path(__file__).parents[1] / "src" / "config.yaml"
+
+
+def to_namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: to_namespace(v) for k, v in value.items()})
+    return value
+
+
+def update(cfg, key, value):
+    *path, name = key.split(".")
+    for part in path:
+        cfg = getattr(cfg, part)
+    setattr(cfg, name, value)
+
+
+@pytest.fixture
+def cfg():
+    # Attribute access like the hydra config (interpolations are left as is)
+    return to_namespace(yaml.safe_load(CONFIG_PATH.read_text()))
+
+
+class TestRuntimeConfig:
+    def test_from_cfg(self, cfg):
+        runtime = RuntimeConfig.from_cfg(cfg)
+
+        assert runtime.dmr.max_seq_length == cfg.dmr.max_seq_length
+        assert runtime.candidates.k == cfg.candidates.k
+        assert runtime.action.max_out_len == cfg.action.max_out_len
+        assert runtime.action.max_inp_len is None
+        assert runtime.action.model == cfg.action.model
+        assert runtime.action.max_batch_size == cfg.action.batching.max_batch_size
+
+    def test_batching_limits_only_when_enabled(self, cfg):
+        cfg.action.batching.enabled = False
+
+        assert RuntimeConfig.from_cfg(cfg).action.max_batch_tokens is None
+
+    @pytest.mark.parametrize(
+        "key, value",
+        [
+            ("action.max_out_len", 0),
+            ("action.batch_size_per_device", -1),
+            ("action.dtype", "bf16"),
+            ("dmr.dtype", "float16"),
+            ("dmr.max_seq_length", "long"),
+            ("candidates.k", 0),
+            ("memory.release_threshold", 1.5),
+            ("memory.min_release_interval_s", -1),
+            ("startup.mode", "later"),
+            ("startup.load_timeout_s", 0),
+        ],
+    )
+    def test_invalid_values(self, cfg, key, value):
+        update(cfg, key, value)
+
+        with pytest.raises(ValidationError):
+            RuntimeConfig.from_cfg(cfg)
+
+    def test_batch_fits_a_prompt(self, cfg):
+        cfg.action.max_inp_len = 4096
+        cfg.action.batching.max_batch_tokens = 2048
+
+        with pytest.raises(ValidationError, match="max_batch_tokens"):
+            RuntimeConfig.from_cfg(cfg)
+
+    def test_report(self, cfg):
+        cfg.action.max_out_len = 64
+        RuntimeConfig.from_cfg(cfg).report()
+
+        metrics = REGISTRY.render()
+        assert 'webassist_runtime_config{model="action",setting="max_out_len"} 64' in metrics
+        assert 'webassist_runtime_config{model="candidates",setting="k"} 10' in metrics
+        assert 'setting="max_inp_len"' not in metrics
+        assert 'webassist_runtime_config_info{model="action",name="' in metrics
+
+
+class TestConfigOverrides:
+    def test_round_trip(self, monkeypatch):
+        overrides = ["serving.socket_dir=/tmp/web assist", "action.max_out_len=64"]
+        monkeypatch.setenv(OVERRIDES_ENV, encode_config_overrides(overrides))
+
+        assert read_config_overrides() == overrides
+
+    def test_unset(self, monkeypatch):
+        monkeypatch.delenv(OVERRIDES_ENV, raising=False)
+
+        assert read_config_overrides() == []
+
+    def test_not_a_list(self, monkeypatch):
+        monkeypatch.setenv(OVERRIDES_ENV, '"action.max_out_len=64"')
+
+        with pytest.raises(ValueError, match=OVERRIDES_ENV):
+            read_config_overrides()
@@ -0,0 +1,298 @@
+import pytest
+
+from PageSnapshot import PageSnapshot
+from schema import Metadata, PrevTurn, UserIntent
+from SessionPersistence import (
+    MemoryStore,
+    RedisStore,
+    SessionConflictError,
+    SessionPersistence,
+    SQLiteStore,
+    decode_bboxes,
+    encode_bboxes,
+)
+from SessionStore import Session, SessionStore
+from WebLinxHelper import PayloadRetention
+
+from .demo_data import load_bbox_table, load_page
+
+METADATA = Metadata(
+    mouseX=0,
+    mouseY=0,
+    tabId=2011645173,
+    url="https://www.google.com/search?q=wealthsimple+tax calculator",
+    viewportHeight=651,
+    viewportWidth=1366,
+    zoomLevel=1,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def add_turns(session, num_turns=3, html=None, bboxes=None):
+    html = html if html is not None else load_page()
+    bboxes = bboxes if bboxes is not None else load_bbox_table()
+    session.replay.build_add_InferTurn(
+        prev_turn=UserIntent(intent="say", utterance="Open the calculator"),
+        html=None,
+        bboxes=None,
+        metadata=None,
+    )
+    for _ in range(num_turns - 1):
+        session.replay.build_add_InferTurn(
+            prev_turn=PrevTurn(intent="scroll", scrollX=0, scrollY=100),
+            html=html,
+            bboxes=bboxes,
+            metadata=METADATA,
+        )
+    session.page_snapshot = PageSnapshot(html=html, bboxes=bboxes)
+
+
+class TestStores:
+    @pytest.fixture(params=["memory", "sqlite", "redis"])
+    def store(self, request, tmp_path):
+        clock = FakeClock()
+        if request.param == "memory":
+            store = MemoryStore(clock=clock)
+        elif request.param == "sqlite":
+            store = SQLiteStore(str(tmp_path / "sessions.sqlite3"), clock=clock)
+        else:
+            # The stand-in has the interface of a Redis client
+            store = RedisStore(MemoryStore(clock=clock))
+        return store, clock
+
+    def test_get_set_delete(self, store):
+        store, _ = store
+
+        assert store.get("a") is None
+        store.set("a", b"1")
+        store.set("b", b"2")
+        assert store.get("a") == b"1"
+
+        store.delete("a", "b", "c")
+        assert store.get("a") is None
+        assert store.get("b") is None
+
+    def test_expiry(self, store):
+        store, clock = store
+
+        store.set("a", b"1", ex=10)
+        store.set("b", b"2")
+        clock.now += 5
+        store.expire("a", 10)
+        clock.now += 9
+
+        assert store.get("a") == b"1"
+        clock.now += 2
+        assert store.get("a") is None
+        assert store.get("b") == b"2"
+
+    def test_compare_and_set(self, store):
+        store, clock = store
+        if isinstance(store, RedisStore):
+            pytest.importorskip("redis")
+
+        assert store.compare_and_set("a", b"1", None)
+        assert not store.compare_and_set("a", b"2", None)
+        assert store.compare_and_set("a", b"2", b"1", ex=10)
+        assert not store.compare_and_set("a", b"3", b"1")
+        assert store.get("a") == b"2"
+
+        # An expired value is a missing one
+        clock.now += 20
+        assert not store.compare_and_set("a", b"3", b"2")
+        assert store.compare_and_set("a", b"3", None)
+
+    def test_sqlite_shared_file(self, tmp_path):
+        path = str(tmp_path / "sessions.sqlite3")
+        SQLiteStore(path).set("a", b"1")
+
+        assert SQLiteStore(path).get("a") == b"1"
+
+
+class TestSessionPersistence:
+    def test_bboxes_encoding(self):
+        bboxes = load_bbox_table()
+
+        assert decode_bboxes(encode_bboxes(bboxes)) == bboxes
+
+    def test_round_trip(self):
+        persistence = SessionPersistence(MemoryStore())
+        session = Session("a")
+        add_turns(session)
+        persistence.save(session)
+
+        restored = Session("a")
+        assert persistence.restore(restored)
+
+        assert restored.revision == session.revision == 1
+        assert len(restored.replay) == 3
+        for turn, original in zip(restored.replay, session.replay):
+            assert turn.index == original.index
+            assert turn.intent == original.intent
+            assert turn.speaker == original.speaker
+            assert turn.utterance == original.utterance
+            assert turn.metadata == original.metadata
+            assert turn.args == original.args
+        assert restored.replay[-1].html == load_page()
+        assert restored.replay[-1].bboxes == load_bbox_table()
+        assert restored.replay[0].html is None
+        assert restored.page_snapshot.page_hash == session.page_snapshot.page_hash
+        assert restored.replay.start == session.replay.start
+        # The prompt state is rebuilt from the turns
+        assert restored.replay.prompt_state.get_stats() == (
+            session.replay.prompt_state.get_stats()
+        )
+
+    def test_payloads_stored_once(self):
+        store = MemoryStore()
+        persistence = SessionPersistence(store)
+        session = Session("a")
+        add_turns(session, num_turns=4)
+
+        persistence.save(session)
+        # One record, the page & its bboxes are shared by the turns and the snapshot
+        assert len(store) == 3
+        assert persistence.stats["payloads_written"] == 2
+
+        add_turns(session, num_turns=2)
+        persistence.save(session)
+        assert persistence.stats["payloads_written"] == 2
+        assert session.revision == 2
+
+        # Another session with the same page
+        other = Session("b")
+        add_turns(other)
+        persistence.save(other)
+        assert len(store) == 4
+
+    def test_up_to_date_session_not_reloaded(self):
+        persistence = SessionPersistence(MemoryStore())
+        session = Session("a")
+        add_turns(session)
+        persistence.save(session)
+        replay = session.replay
+
+        assert not persistence.restore(session)
+        assert session.replay is replay
+        assert persistence.stats["loads"] == 1
+        assert persistence.stats["restores"] == 0
+
+    def test_unknown_session(self):
+        persistence = SessionPersistence(MemoryStore())
+        session = Session("a")
+
+        assert not persistence.restore(session)
+        assert len(session.replay) == 0
+
+    def test_another_replica_saved_a_newer_revision(self):
+        store = MemoryStore()
+        first, second = SessionPersistence(store), SessionPersistence(store)
+        session = Session("a")
+        add_turns(session)
+        first.save(session)
+
+        moved = Session("a")
+        second.restore(moved)
+        add_turns(moved, num_turns=2, html=load_page(3), bboxes=load_bbox_table(3))
+        second.save(moved)
+
+        assert first.restore(session)
+        assert len(session.replay) == 5
+        assert session.replay[-1].html == load_page(3)
+        assert session.page_snapshot.html == load_page(3)
+
+    def test_concurrent_saves_of_a_revision_conflict(self):
+        store = MemoryStore()
+        first, second = SessionPersistence(store), SessionPersistence(store)
+        first_sessions, second_sessions = SessionStore(), SessionStore()
+        session = first_sessions.get_or_create("a")
+        add_turns(session)
+        first.save(session)
+
+        # Both replicas hold revision 1 and handle a turn of the session
+        moved = second_sessions.get_or_create("a")
+        assert second.restore(moved)
+        for replica, utterance in [(session, "First"), (moved, "Second")]:
+            replica.replay.build_add_InferTurn(
+                prev_turn=UserIntent(intent="say", utterance=utterance),
+                html=None,
+                bboxes=None,
+                metadata=None,
+            )
+        first.save(session)
+
+        with pytest.raises(SessionConflictError):
+            second.save(moved)
+        assert moved.revision == 1
+        assert second.stats["conflicts"] == 1
+
+        # The second replica follows the history of the first one
+        assert second.restore(moved)
+        assert moved.revision == 2
+        assert [t.utterance for t in moved.replay][-1] == "First"
+        moved.replay.build_add_InferTurn(
+            prev_turn=UserIntent(intent="say", utterance="Second"),
+            html=None,
+            bboxes=None,
+            metadata=None,
+        )
+        second.save(moved)
+
+        assert first.restore(session)
+        assert session.revision == 3
+        assert [t.utterance for t in session.replay][-2:] == ["First", "Second"]
+
+    def test_offloaded_payloads_load_lazily(self):
+        persistence = SessionPersistence(MemoryStore())
+        retention = PayloadRetention(keep_last_n=1, mode="compress")
+        session = Session("a", retention=retention)
+        add_turns(session, num_turns=2, html=load_page(2), bboxes=load_bbox_table(2))
+        add_turns(session, num_turns=2, html=load_page(3), bboxes=load_bbox_table(3))
+        persistence.save(session)
+
+        restored = Session("a", retention=retention)
+        persistence.restore(restored)
+
+        states = [t.payload_state for t in restored.replay]
+        assert states == ["resident", "stored", "resident", "resident"]
+        assert restored.replay[1].has_html()
+        assert restored.replay[1].has_bboxes()
+        assert not restored.replay[0].has_bboxes()
+        assert restored.replay[1].payload_state == "stored"
+        assert restored.replay[1].html == load_page(2)
+        assert restored.replay[1].payload_state == "resident"
+
+    def test_expired_session(self):
+        clock = FakeClock()
+        persistence = SessionPersistence(MemoryStore(clock=clock), ttl_seconds=60)
+        session = Session("a")
+        add_turns(session)
+        persistence.save(session)
+
+        clock.now += 120
+
+        assert not persistence.restore(Session("a"))
+
+    def test_payloads_outlive_the_record(self):
+        clock = FakeClock()
+        store = MemoryStore(clock=clock)
+        persistence = SessionPersistence(store, ttl_seconds=60, clock=clock)
+        session = Session("a")
+        add_turns(session)
+        persistence.save(session)
+
+        # The session keeps being saved, its page must not expire
+        for _ in range(4):
+            clock.now += 40
+            persistence.save(session)
+
+        restored = Session("a")
+        assert persistence.restore(restored)
+        assert restored.replay[-1].html == load_page()
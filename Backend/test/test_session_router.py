@@ -0,0 +1,192 @@
+import asyncio
+import httpx
+import json
+
+from SessionRouter import (
+    SessionRouter,
+    build_router_app,
+    extract_session_id,
+    pick_worker,
+)
+
+
+def body_of(session_id, html="<html></html>"):
+    return json.dumps({"sessionID": session_id, "html": html}).encode()
+
+
+class FakeTransport(httpx.AsyncBaseTransport):
+    """
+    Unlike `httpx.MockTransport`, leaves the response unread like a network transport.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        response = self.handler(request)
+        # A response built from bytes is read right away
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=httpx.ByteStream(response.content),
+        )
+
+
+class FakeProcess:
+    """
+    Mock transport of a worker / the inference process, records the requests it received.
+    """
+
+    def __init__(self, name, ready=True):
+        self.name = name
+        self.ready = ready
+        self.requests = []
+        self.transport = FakeTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/v1/health/ready":
+            status = 200 if self.ready else 503
+            return httpx.Response(status, json={"status": "ready" if self.ready else "x"})
+        self.requests.append(request)
+        if request.url.path == "/v1/stream_next_action":
+            events = b'event: token\ndata: {"text": "click"}\n\n'
+            return httpx.Response(
+                200, content=events, headers={"content-type": "text/event-stream"}
+            )
+        return httpx.Response(
+            200, json={"process": self.name, "body": request.content.decode()}
+        )
+
+
+def make_app(num_workers=3, **kwargs):
+    workers = [FakeProcess(f"worker-{i}") for i in range(num_workers)]
+    inference = FakeProcess("inference", **kwargs)
+    router = SessionRouter(
+        worker_transports=[w.transport for w in workers],
+        inference_transport=inference.transport,
+    )
+    return build_router_app(router), workers, inference
+
+
+def request(app, method, path, **kwargs):
+    async def send():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://router") as c:
+            return await c.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+class TestSessionId:
+    def test_extract(self):
+        assert extract_session_id(body_of("abc-123")) == "abc-123"
+        assert extract_session_id(b'{"html": "", "sessionID" : "x\\"y"}') == 'x"y'
+        assert extract_session_id(b'{"html": ""}') is None
+
+    def test_ignores_the_key_inside_strings(self):
+        html = '<div data-x=\'"sessionID": "fake"\'></div>'
+        body = json.dumps({"html": html, "sessionID": "real"}).encode()
+
+        assert b'sessionID\\": \\"fake' in body
+        assert extract_session_id(body) == "real"
+
+    def test_pick_worker_is_stable(self):
+        workers = [pick_worker(f"session-{i}", 4) for i in range(200)]
+
+        assert workers == [pick_worker(f"session-{i}", 4) for i in range(200)]
+        # Spread over all the workers
+        assert set(workers) == {0, 1, 2, 3}
+
+
+class TestSessionRouter:
+    def test_session_affinity(self):
+        app, workers, _ = make_app()
+
+        for turn in range(3):
+            for session in ["a", "b", "c", "d"]:
+                response = request(
+                    app, "POST", "/v1/get_next_action", content=body_of(session)
+                )
+                assert response.status_code == 200
+                expected = f"worker-{pick_worker(session, 3)}"
+                assert response.json()["process"] == expected
+
+        for worker in workers:
+            sessions = {extract_session_id(r.content) for r in worker.requests}
+            assert all(pick_worker(s, 3) == int(worker.name[-1]) for s in sessions)
+
+    def test_forwards_body_and_query(self):
+        app, workers, _ = make_app(num_workers=1)
+
+        response = request(
+            app, "POST", "/v1/get_next_action?debug=1", content=body_of("a", "<p>é</p>")
+        )
+
+        forwarded = workers[0].requests[0]
+        assert forwarded.url.query == b"debug=1"
+        assert json.loads(forwarded.content)["html"] == "<p>é</p>"
+        assert json.loads(response.json()["body"])["sessionID"] == "a"
+
+    def test_streams_events(self):
+        app, _, _ = make_app()
+
+        response = request(app, "POST", "/v1/stream_next_action", content=body_of("a"))
+
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text == 'event: token\ndata: {"text": "click"}\n\n'
+
+    def test_requests_without_session_round_robin(self):
+        app, workers, _ = make_app()
+
+        for _ in range(6):
+            request(app, "POST", "/v1/hello", json={})
+
+        assert [len(w.requests) for w in workers] == [2, 2, 2]
+
+    def test_direct_routes(self):
+        app, workers, inference = make_app()
+
+        assert request(app, "GET", "/inference/v1/stats").json()["process"] == "inference"
+        assert request(app, "GET", "/workers/2/metrics").json()["process"] == "worker-2"
+        assert inference.requests[0].url.path == "/v1/stats"
+        assert workers[2].requests[0].url.path == "/metrics"
+        assert request(app, "GET", "/workers/5/metrics").status_code == 404
+
+    def test_inference_model_routes_not_exposed(self):
+        app, workers, inference = make_app()
+
+        for method, path in [
+            ("POST", "/inference/generate"),
+            ("POST", "/inference/generate_stream"),
+            ("POST", "/inference/dmr"),
+            ("POST", "/inference/v1/stats"),
+            ("GET", "/inference/generate"),
+        ]:
+            assert request(app, method, path, json={}).status_code == 404
+        assert inference.requests == []
+        assert all(w.requests == [] for w in workers)
+
+    def test_readiness(self):
+        app, _, inference = make_app()
+        assert request(app, "GET", "/v1/health/ready").status_code == 200
+
+        inference.ready = False
+        response = request(app, "GET", "/v1/health/ready")
+        assert response.status_code == 503
+        assert response.json()["status"] == "not_ready"
+        assert len(response.json()["workers"]) == 3
+
+    def test_unavailable_worker(self):
+        def refuse(request):
+            raise httpx.ConnectError("refused", request=request)
+
+        router = SessionRouter(
+            worker_transports=[FakeTransport(refuse)],
+            inference_transport=FakeTransport(refuse),
+        )
+        app = build_router_app(router)
+
+        response = request(app, "POST", "/v1/get_next_action", content=body_of("a"))
+        assert response.status_code == 502
+        assert request(app, "GET", "/v1/health/ready").status_code == 503
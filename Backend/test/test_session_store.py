@@ -0,0 +1,103 @@
+import asyncio
+import json
+import pytest
+
+from SessionStore import SessionEvictedError, SessionStore, hash_session_id
+
+
+async def use_session(store, session_id, nbytes=0):
+    async with store.session(session_id) as session:
+        session.replay.estimate_nbytes = lambda: nbytes
+        return session
+
+
+class TestSessionStore:
+    def test_creates_and_reuses_session(self):
+        store = SessionStore()
+
+        first = asyncio.run(use_session(store, "a"))
+        second = asyncio.run(use_session(store, "a"))
+
+        assert first is second
+        assert first.replay.session_id == "a"
+        assert len(store) == 1
+
+    def test_ttl_eviction(self):
+        store = SessionStore(ttl_seconds=60)
+        session = asyncio.run(use_session(store, "a"))
+        session.last_access -= 120
+
+        store.evict_expired()
+
+        assert "a" not in store
+        assert store.evictions["ttl"] == 1
+        with pytest.raises(SessionEvictedError, match="expired"):
+            store.get_or_create("a")
+
+    def test_max_sessions_evicts_least_recently_used(self):
+        store = SessionStore(max_sessions=2)
+
+        asyncio.run(use_session(store, "a"))
+        asyncio.run(use_session(store, "b"))
+        asyncio.run(use_session(store, "a"))
+        asyncio.run(use_session(store, "c"))
+
+        assert "a" in store
+        assert "b" not in store
+        assert "c" in store
+        with pytest.raises(SessionEvictedError):
+            store.get_or_create("b")
+
+    def test_max_bytes(self):
+        store = SessionStore(max_bytes=100)
+
+        asyncio.run(use_session(store, "a", nbytes=60))
+        asyncio.run(use_session(store, "b", nbytes=60))
+
+        assert "a" not in store
+        assert "b" in store
+        assert store.evictions["max_bytes"] == 1
+
+    def test_active_session_not_evicted(self):
+        store = SessionStore(max_sessions=2)
+
+        async def main():
+            async with store.session("a"):
+                await use_session(store, "b")
+                await use_session(store, "c")
+                # "a" is the least recently used, but has a request in flight
+                assert "a" in store
+                assert "b" not in store
+
+        asyncio.run(main())
+
+        assert "a" in store
+        assert "c" in store
+
+    def test_session_requests_serialized(self):
+        store = SessionStore()
+        order = []
+
+        async def request(name):
+            async with store.session("a"):
+                order.append(f"{name}-start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name}-end")
+
+        async def main():
+            await asyncio.gather(request("1"), request("2"))
+
+        asyncio.run(main())
+
+        assert order == ["1-start", "1-end", "2-start", "2-end"]
+
+    def test_stats(self):
+        store = SessionStore()
+        asyncio.run(use_session(store, "a", nbytes=10))
+
+        stats = store.get_stats()
+
+        assert stats["sessions"] == 1
+        assert stats["bytes"] == 10
+        assert stats["largest_sessions"][0]["session_hash"] == hash_session_id("a")
+        assert "\"a\"" not in json.dumps(stats)
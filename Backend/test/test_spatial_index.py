@@ -0,0 +1,91 @@
+import math
+import pytest
+
+from weblinx.processing.outputs import get_element_uid_by_coords
+from weblinx.utils.html import filter_bboxes
+
+from BBoxTable import BBoxTable
+from SpatialIndex import SpatialIndex
+
+from .demo_data import load_raw_bboxes
+
+BBOXES_INDICES = [0, 1, 3, 4, 8, 10, 16]
+
+
+class FakeTurn:
+    def __init__(self, bboxes):
+        self.bboxes = bboxes
+
+
+def brute_force_rect(raw, left, top, right, bottom):
+    return [
+        uid
+        for uid, b in raw.items()
+        if math.floor(b["left"]) <= right
+        and left <= math.ceil(b["right"])
+        and math.floor(b["top"]) <= bottom
+        and top <= math.ceil(b["bottom"])
+    ]
+
+
+class TestSpatialIndex:
+    @pytest.mark.parametrize("index", BBOXES_INDICES)
+    def test_visible_uids_match_filter_bboxes(self, index):
+        raw = load_raw_bboxes(index)
+        spatial_index = SpatialIndex(BBoxTable.from_dict(raw))
+
+        for viewport_height, viewport_width in [(None, None), (651, 1366), (300, 500)]:
+            assert spatial_index.visible_uids(
+                viewport_height=viewport_height, viewport_width=viewport_width
+            ) == list(
+                filter_bboxes(
+                    raw, viewport_height=viewport_height, viewport_width=viewport_width
+                )
+            )
+
+    @pytest.mark.parametrize("index", BBOXES_INDICES)
+    @pytest.mark.parametrize("cell_size,max_cells_per_box", [(64, 256), (16, 4)])
+    def test_uid_at_matches_weblinx(self, index, cell_size, max_cells_per_box):
+        raw = load_raw_bboxes(index)
+        spatial_index = SpatialIndex(
+            BBoxTable.from_dict(raw),
+            cell_size=cell_size,
+            max_cells_per_box=max_cells_per_box,
+        )
+
+        for x in range(-20, 1420, 41):
+            for y in range(-20, 2400, 59):
+                assert spatial_index.uid_at(x, y) == get_element_uid_by_coords(
+                    FakeTurn(raw), x, y
+                )
+
+    @pytest.mark.parametrize("index", BBOXES_INDICES)
+    def test_uids_in_rect_match_brute_force(self, index):
+        raw = load_raw_bboxes(index)
+        spatial_index = SpatialIndex(BBoxTable.from_dict(raw), max_cells_per_box=16)
+
+        for rect in [(0, 0, 1366, 651), (100, 150, 300, 200), (5000, 5000, 6000, 6000)]:
+            assert spatial_index.uids_in_rect(*rect) == brute_force_rect(raw, *rect)
+
+    def test_tie_and_zero_area(self):
+        table = BBoxTable.validate(
+            {
+                "uids": ["zero", "first", "second"],
+                "values": [
+                    [10, 10, 0, 0, 10, 10, 10, 10],
+                    [0, 0, 20, 20, 0, 20, 0, 20],
+                    [0, 0, 20, 20, 0, 20, 0, 20],
+                ],
+            }
+        )
+        spatial_index = SpatialIndex(table, cell_size=8)
+
+        assert spatial_index.uid_at(10, 10) == "first"
+        assert spatial_index.uid_at(100, 100) is None
+
+    def test_empty(self):
+        spatial_index = SpatialIndex(BBoxTable.from_dict({}))
+
+        assert spatial_index.uid_at(0, 0) is None
+        assert spatial_index.uids_in_rect(0, 0, 10, 10) == []
+        assert spatial_index.visible_uids() == []
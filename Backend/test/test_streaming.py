@@ -0,0 +1,86 @@
+import asyncio
+import json
+import threading
+
+from weblinx.processing.outputs import parse_predicted_output_string
+
+from Streaming import ActionStreamMonitor, EventStream, find_action_end, format_sse
+
+
+def parse_sse(message):
+    event, data = message.strip().split("\n")
+    return event[len("event: ") :], json.loads(data[len("data: ") :])
+
+
+class TestFindActionEnd:
+    def test_incomplete(self):
+        assert find_action_end("") is None
+        assert find_action_end("cli") is None
+        assert find_action_end('click(uid="12') is None
+        assert find_action_end('say(speaker="navigator", utterance="Hi :)') is None
+
+    def test_complete(self):
+        text = 'say(speaker="navigator", utterance="Hi :)") and more'
+
+        end = find_action_end(text)
+
+        assert text[: end + 1] == 'say(speaker="navigator", utterance="Hi :)")'
+        assert parse_predicted_output_string(
+            text[: end + 1]
+        ) == parse_predicted_output_string(text)
+
+
+class TestActionStreamMonitor:
+    def test_emits_new_text_and_stops(self):
+        chunks = []
+        monitor = ActionStreamMonitor(chunks.append)
+
+        assert not monitor.update("click(")
+        assert not monitor.update('click(uid="1')
+        assert not monitor.update('click(uid="1')
+        assert monitor.update('click(uid="12")')
+
+        assert chunks == ["click(", 'uid="1', '2")']
+        assert monitor.complete
+
+    def test_holds_back_partial_characters(self):
+        chunks = []
+        monitor = ActionStreamMonitor(chunks.append)
+
+        monitor.update("say(utterance=\"caf�")
+        monitor.update('say(utterance="café')
+
+        assert "".join(chunks) == 'say(utterance="café'
+        assert "�" not in "".join(chunks)
+
+
+class TestEventStream:
+    def test_events_from_threads(self):
+        async def main():
+            events = EventStream()
+
+            def produce():
+                events.emit("token", {"text": "click("})
+                events.emit("token", {"text": 'uid="1")'})
+
+            thread = threading.Thread(target=produce)
+            thread.start()
+            thread.join()
+            events.emit("action", {"intent": "click"})
+            events.close()
+
+            return [parse_sse(m) async for m in events.stream()], events
+
+        messages, events = asyncio.run(main())
+
+        assert messages == [
+            ("token", {"text": "click("}),
+            ("token", {"text": 'uid="1")'}),
+            ("action", {"intent": "click"}),
+        ]
+        assert events.closed
+
+    def test_format_sse(self):
+        assert format_sse("prompt", {"messages": 3}) == (
+            'event: prompt\ndata: {"messages": 3}\n\n'
+        )
@@ -0,0 +1,120 @@
+from TokenCache import TOKEN_CACHE_LOOKUPS, CachedTokenizer, TokenCache
+
+
+class CountingTokenizer:
+    model_max_length = 8
+
+    def __init__(self):
+        self.calls = []
+
+    def tokenize(self, text, add_special_tokens=False):
+        self.calls.append(text)
+        return text.split()
+
+    def __call__(self, text, add_special_tokens=False, return_length=False, padding=False):
+        self.calls.append(text)
+        texts = [text] if isinstance(text, str) else text
+        encoded = {"input_ids": [list(range(len(t.split()))) for t in texts]}
+        if return_length:
+            encoded["length"] = [len(t.split()) for t in texts]
+        if isinstance(text, str):
+            return {k: v[0] for k, v in encoded.items()}
+        return encoded
+
+
+class TestTokenCache:
+    def test_tokenize_once_per_request(self):
+        base = CountingTokenizer()
+        tokenizer = CachedTokenizer(base)
+
+        assert tokenizer.tokenize("a b c") == ["a", "b", "c"]
+        assert tokenizer.tokenize("a b c") == ["a", "b", "c"]
+        assert tokenizer("a b")["input_ids"] == [0, 1]
+        assert tokenizer("a b")["input_ids"] == [0, 1]
+
+        assert base.calls == ["a b c", "a b"]
+        assert tokenizer.get_stats() == {
+            "request_hits": 2,
+            "session_hits": 0,
+            "misses": 2,
+            "hit_rate": 0.5,
+        }
+        assert tokenizer.model_max_length == 8
+
+    def test_options_are_part_of_the_key(self):
+        base = CountingTokenizer()
+        tokenizer = CachedTokenizer(base)
+
+        tokenizer.tokenize("a b", add_special_tokens=False)
+        tokenizer.tokenize("a b", add_special_tokens=True)
+
+        assert len(base.calls) == 2
+
+    def test_returned_tokens_are_copies(self):
+        tokenizer = CachedTokenizer(CountingTokenizer())
+
+        tokenizer.tokenize("a b").append("c")
+
+        assert tokenizer.tokenize("a b") == ["a", "b"]
+
+    def test_carries_over_between_requests(self):
+        base = CountingTokenizer()
+        session_cache = TokenCache(max_entries=10, max_text_len=5)
+
+        CachedTokenizer(base, session_cache).tokenize("a b")
+        CachedTokenizer(base, session_cache).tokenize("a b c d e f")  # too long to keep
+
+        tokenizer = CachedTokenizer(base, session_cache)
+        tokenizer.tokenize("a b")
+        tokenizer.tokenize("a b c d e f")
+
+        assert base.calls == ["a b", "a b c d e f", "a b c d e f"]
+        assert tokenizer.get_stats()["session_hits"] == 1
+        assert len(session_cache) == 1
+        assert session_cache.get_stats()["hits"] == 1
+
+    def test_batch_call(self):
+        base = CountingTokenizer()
+        tokenizer = CachedTokenizer(base)
+
+        tokenizer("a b", return_length=True)
+        encoded = tokenizer(["a b", "c", "d e f", "c"], return_length=True)
+
+        assert encoded["length"] == [2, 1, 3, 1]
+        assert encoded["input_ids"][2] == [0, 1, 2]
+        # Only the texts not seen yet are tokenized, once
+        assert base.calls == ["a b", ["c", "d e f"]]
+        assert tokenizer(["d e f"], return_length=True)["length"] == [3]
+        assert len(base.calls) == 2
+
+    def test_batch_dependent_calls_are_not_cached(self):
+        base = CountingTokenizer()
+        tokenizer = CachedTokenizer(base)
+
+        tokenizer(["a", "b c"], padding=True)
+        tokenizer(["a", "b c"], padding=True)
+
+        assert len(base.calls) == 2
+        assert tokenizer.get_stats()["hit_rate"] is None
+
+    def test_lru_eviction(self):
+        session_cache = TokenCache(max_entries=2)
+        tokenizer = CachedTokenizer(CountingTokenizer(), session_cache)
+
+        for text in ["a", "b", "c"]:
+            tokenizer.tokenize(text)
+
+        assert len(session_cache) == 2
+        assert session_cache.get_stats()["evictions"] == 1
+        assert session_cache.nbytes > 0
+
+        session_cache.clear()
+        assert session_cache.nbytes == 0
+
+    def test_report(self):
+        before = TOKEN_CACHE_LOOKUPS.get(result="miss")
+        tokenizer = CachedTokenizer(CountingTokenizer())
+        tokenizer.tokenize("a")
+
+        assert tokenizer.report()["misses"] == 1
+        assert TOKEN_CACHE_LOOKUPS.get(result="miss") == before + 1
@@ -0,0 +1,60 @@
+import json
+import logging
+import pytest
+
+from Tracing import (
+    STAGE_DURATION,
+    current_span,
+    set_attributes,
+    set_trace_attributes,
+    span,
+    start_trace,
+)
+
+
+class TestTracing:
+    def test_span_outside_trace(self):
+        before = STAGE_DURATION.get(stage="test_outside") or {"count": 0}
+
+        with span("test_outside") as current:
+            set_attributes(records=2)
+
+        assert current.trace is None
+        assert current.attributes == {"records": 2}
+        assert current_span() is None
+        assert STAGE_DURATION.get(stage="test_outside")["count"] == before["count"] + 1
+
+    def test_nested_spans(self, caplog):
+        with caplog.at_level(logging.INFO, logger="tracing"):
+            with start_trace("request", path="/v1/get_next_action") as root:
+                with span("dmr") as dmr:
+                    with span("build_records"):
+                        set_attributes(elements=10)
+                        set_trace_attributes(session_id="abc")
+                with span("generation"):
+                    pass
+
+        assert dmr.parent_id == root.span_id
+        assert root.attributes == {"path": "/v1/get_next_action", "session_id": "abc"}
+
+        logged = json.loads(caplog.records[-1].getMessage())
+        assert logged["event"] == "trace"
+        assert logged["trace_id"] == root.trace.trace_id
+        assert logged["name"] == "request"
+        assert logged["duration_ms"] >= 0
+        assert [s["name"] for s in logged["spans"]] == ["dmr", "build_records", "generation"]
+
+        build_records = logged["spans"][1]
+        assert build_records["parent_id"] == dmr.span_id
+        assert build_records["attributes"] == {"elements": 10}
+
+    def test_error_status(self, caplog):
+        with caplog.at_level(logging.INFO, logger="tracing"):
+            with pytest.raises(ValueError):
+                with start_trace("request"):
+                    with span("generation"):
+                        raise ValueError()
+
+        logged = json.loads(caplog.records[-1].getMessage())
+        assert logged["status"] == "error"
+        assert logged["spans"][0]["status"] == "error"
@@ -0,0 +1,233 @@
+import lxml.html
+import os
+import pytest
+import re
+import shutil
+
+from schema import Metadata, PrevTurn, UserIntent
+from WebLinxHelper import (
+    InferReplay,
+    ParsedPage,
+    PayloadRetention,
+    get_element_uid_by_coords,
+)
+
+from .demo_data import load_bbox_table, load_bboxes, load_page
+
+UID_KEY = "data-webtasks-id"
+
+METADATA = Metadata(
+    mouseX=0,
+    mouseY=0,
+    tabId=2011645173,
+    url="https://www.google.com/search?q=wealthsimple+tax calculator",
+    viewportHeight=651,
+    viewportWidth=1366,
+    zoomLevel=1,
+)
+
+
+@pytest.fixture
+def browser_turn():
+    replay = InferReplay(session_id="test")
+    return replay.buildInferTurn(
+        turn=PrevTurn(intent="scroll", scrollX=1, scrollY=1),
+        html=load_page(),
+        bboxes=load_bboxes(),
+        metadata=METADATA,
+    )
+
+
+class TestParsedPage:
+    def test_elements_match_xpath(self):
+        html = load_page()
+        page = ParsedPage(html)
+        root = lxml.html.fromstring(html)
+
+        expected = [e.attrib[UID_KEY] for e in root.xpath(f"//*[@{UID_KEY}]")]
+        assert [e.attrib[UID_KEY] for e in page.get_elements(UID_KEY)] == expected
+
+    def test_uid_index(self):
+        html = load_page()
+        page = ParsedPage(html)
+        root_tree = lxml.html.fromstring(html).getroottree()
+
+        for uid in list(page.get_uid_index(UID_KEY))[:50]:
+            elem = root_tree.xpath(f'//*[@{UID_KEY}="{uid}"]')[0]
+            assert page.get_xpath(page.get_element(uid, UID_KEY)) == root_tree.getpath(
+                elem
+            )
+
+    def test_missing_uid(self):
+        page = ParsedPage(load_page())
+        assert page.get_element("does-not-exist", UID_KEY) is None
+
+
+class TestInferTurnParsedPage:
+    def test_parsed_once(self, browser_turn):
+        assert browser_turn.parsed_page is browser_turn.parsed_page
+
+    def test_invalidated_when_html_changes(self, browser_turn):
+        page = browser_turn.parsed_page
+        browser_turn.html = load_page(index=3)
+
+        assert browser_turn.parsed_page is not page
+
+    def test_no_html(self):
+        replay = InferReplay(session_id="test")
+        turn = replay.buildInferTurn(
+            turn=UserIntent(intent="say", utterance="Hello"),
+            html=None,
+            bboxes=None,
+            metadata=None,
+        )
+
+        assert turn.parsed_page is None
+        assert turn.get_element_xpath("abc", UID_KEY) == ""
+
+    def test_xpaths_dict_consistent_with_element_xpath(self, browser_turn):
+        xpaths = browser_turn.get_xpaths_dict(uid_key=UID_KEY)
+
+        assert len(xpaths) > 0
+        for uid, xpath in list(xpaths.items())[:50]:
+            assert browser_turn.get_element_xpath(uid, UID_KEY) == xpath
+
+
+class TestInferTurnSpatialIndex:
+    def test_built_once(self, browser_turn):
+        assert browser_turn.spatial_index is browser_turn.spatial_index
+        assert len(browser_turn.spatial_index) == len(load_bboxes())
+
+    def test_uid_by_coords(self, browser_turn):
+        uid = get_element_uid_by_coords(browser_turn, 300, 160)
+
+        bbox = browser_turn.bboxes[uid]
+        assert bbox["left"] <= 300 <= bbox["right"]
+        assert bbox["top"] <= 160 <= bbox["bottom"]
+        assert get_element_uid_by_coords(browser_turn, -100, -100) is None
+
+    def test_released_with_payload(self, browser_turn):
+        browser_turn.spatial_index
+        browser_turn.offload_payload("drop")
+
+        assert browser_turn.spatial_index is None
+
+
+class TestPayloadRetention:
+    def build_replay(self, retention, num_turns=4, session_id="test"):
+        replay = InferReplay(session_id=session_id, retention=retention)
+        for _ in range(num_turns):
+            replay.build_add_InferTurn(
+                prev_turn=PrevTurn(intent="scroll", scrollX=1, scrollY=1),
+                html=load_page(),
+                bboxes=load_bboxes(),
+                metadata=METADATA,
+            )
+        return replay
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            PayloadRetention(mode="zip")
+
+    def test_no_retention_keeps_everything(self):
+        replay = self.build_replay(retention=None)
+
+        assert all(t.payload_state == "resident" for t in replay)
+        assert all(t.has_html() for t in replay)
+
+    def test_drop(self):
+        replay = self.build_replay(PayloadRetention(keep_last_n=2, mode="drop"))
+
+        assert [t.payload_state for t in replay] == [
+            "dropped",
+            "dropped",
+            "resident",
+            "resident",
+        ]
+        assert replay[0].html is None
+        assert replay[0].bboxes is None
+        assert not replay[0].has_html()
+        assert replay[-1].html == load_page()
+
+        # Turns are still formatted from their intent
+        assert replay[0].intent == "scroll"
+
+    def test_compress_and_rehydrate(self):
+        replay = self.build_replay(PayloadRetention(keep_last_n=1, mode="compress"))
+        turn = replay[0]
+
+        assert turn.payload_state == "compressed"
+        assert turn.has_html()
+        assert turn.has_bboxes()
+        # Checked without rehydrating the payload
+        assert turn.payload_state == "compressed"
+        assert turn.estimate_nbytes() < replay[-1].estimate_nbytes()
+
+        assert turn.html == load_page()
+        assert turn.bboxes == load_bbox_table()
+        assert turn.payload_state == "resident"
+
+    def test_spill_and_rehydrate(self, tmp_path):
+        replay = self.build_replay(
+            PayloadRetention(keep_last_n=1, mode="spill", spill_dir=str(tmp_path))
+        )
+
+        assert len(list(tmp_path.iterdir())) == 3
+        assert replay[0].bboxes == load_bbox_table()
+        assert len(list(tmp_path.iterdir())) == 2
+
+        replay.close()
+        assert len(list(tmp_path.iterdir())) == 0
+
+    def test_spill_file_names_ignore_the_session_id(self, tmp_path):
+        spill_dir = tmp_path / "a" / "spill"
+        retention = PayloadRetention(keep_last_n=1, mode="spill", spill_dir=str(spill_dir))
+        replay = self.build_replay(retention, session_id="../../escaped")
+
+        files = [str(p.relative_to(tmp_path)) for p in tmp_path.rglob("*") if p.is_file()]
+        assert len(files) == 3
+        assert all(re.fullmatch(r"a/spill/[0-9a-f]{32}\.npz", f) for f in files)
+        # Loaded back without pickle
+        assert replay[0].html == load_page()
+
+    def test_default_spill_dir_is_private(self):
+        first, second = PayloadRetention(mode="spill"), PayloadRetention(mode="spill")
+        try:
+            assert os.stat(first.spill_dir).st_mode & 0o777 == 0o700
+            assert first.spill_dir != second.spill_dir
+        finally:
+            shutil.rmtree(first.spill_dir)
+            shutil.rmtree(second.spill_dir)
+
+    def test_memory_stats(self):
+        replay = self.build_replay(PayloadRetention(keep_last_n=1, mode="drop"))
+        full = self.build_replay(retention=None)
+
+        stats = replay.get_memory_stats()
+
+        assert stats["turns"] == 4
+        assert stats["payload_turns"]["resident"] == 1
+        assert stats["payload_turns"]["dropped"] == 3
+        assert stats["resident_bytes"] < full.estimate_nbytes()
+
+    def test_shared_payload_counted_once(self):
+        html, bboxes = load_page(), load_bbox_table()
+        shared = InferReplay(session_id="test")
+        separate = InferReplay(session_id="test")
+        for _ in range(2):
+            shared.build_add_InferTurn(
+                prev_turn=PrevTurn(intent="scroll", scrollX=1, scrollY=1),
+                html=html,
+                bboxes=bboxes,
+                metadata=METADATA,
+            )
+        for turn in shared:
+            separate.addInferTurn(
+                separate.buildInferTurn(
+                    turn.prev_turn, "".join(html), load_bbox_table(), None
+                )
+            )
+
+        assert shared.estimate_nbytes() == (
+            separate.estimate_nbytes() - len(html) - bboxes.nbytes
+        )